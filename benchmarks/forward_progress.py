@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compares the throughput of the input modes of `subprocess_forward_progress`.
+
+By default the consumer is `cat`, which measures the overhead of feeding the process. With --ffmpeg, a synthetic
+WAV file is generated and decoded by ffmpeg instead.
+
+    benchmarks/forward_progress.py --size-mb 1024 --runs 3
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from automedia.ffmpeg_validator import FFMPEG_VERIFY_ARGS
+from automedia.forward_progress import InputMode, subprocess_forward_progress
+
+def make_input(dir, size_mb, use_ffmpeg):
+    if use_ffmpeg:
+        file = os.path.join(dir, 'input.wav')
+        # 48kHz stereo 16-bit PCM is ~11MB per minute
+        seconds = max(1, size_mb * 60 // 11)
+        subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'anoisesrc=d={seconds}:r=48000', '-ac', '2', '-y', file], check=True)
+    else:
+        file = os.path.join(dir, 'input.bin')
+        with open(file, 'wb') as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(size_mb):
+                f.write(chunk)
+    return file
+
+def run(file, mode, use_ffmpeg):
+    if use_ffmpeg:
+        args, executable = ['ffmpeg'] + FFMPEG_VERIFY_ARGS, 'ffmpeg'
+    else:
+        args, executable = ['cat'], shutil.which('cat')
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    errors = subprocess_forward_progress(file, args, executable, input_mode=mode)
+    if errors:
+        raise Exception(f"Benchmark run failed: {errors}")
+    return time.monotonic() - start, time.process_time() - cpu_start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark subprocess_forward_progress input modes")
+    parser.add_argument("--size-mb", type=int, default=512, help="size of the input file in MB (default 512)")
+    parser.add_argument("--runs", type=int, default=3, help="number of runs per mode, the best is reported (default 3)")
+    parser.add_argument("--ffmpeg", action="store_true", help="decode a generated WAV with ffmpeg rather than using cat")
+    parser.add_argument("--dir", help="directory for the temporary input file (default system temp directory)")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        file = make_input(dir, args.size_mb, args.ffmpeg)
+        size = os.stat(file).st_size
+        for mode in InputMode:
+            timings = [run(file, mode, args.ffmpeg) for _ in range(args.runs)]
+            wall, cpu = min(timings)
+            results[mode.value] = {
+                'seconds': round(wall, 4),
+                'mb_per_second': round(size / wall / 1024 / 1024, 1),
+                'python_cpu_seconds': round(cpu, 4),
+            }
+    print(json.dumps({'benchmark': 'forward_progress', 'consumer': 'ffmpeg' if args.ffmpeg else 'cat', 'bytes': size, 'results': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
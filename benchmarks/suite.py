@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Reproducible throughput benchmarks for scanning, verification and transcoding.
+
+A synthetic library is generated with the ffmpeg CLI (a deep tree of many small files, a few large files and some
+corrupt files) and each benchmark is run against it, across the requested job counts. Results are written as JSON so
+that runs can be compared between versions. Benchmarks that need ffmpeg are skipped if it is not installed.
+
+    benchmarks/suite.py --scale small --jobs 1,4,8 --output results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+from automedia import main as automedia_main
+from automedia.forward_progress import InputMode
+from automedia.jobqueue import JobQueue
+from automedia.operation import Operation
+from automedia.path_scan import PathScanner, SymlinkMode
+from pathlib import Path
+import forward_progress
+
+SCALES = {
+    # depth, fanout, small files per leaf directory, large files, large file seconds, corrupt files
+    'tiny': dict(depth=2, fanout=2, small_per_dir=2, large=1, large_seconds=30, corrupt=1),
+    'small': dict(depth=3, fanout=4, small_per_dir=5, large=2, large_seconds=300, corrupt=4),
+    'medium': dict(depth=4, fanout=6, small_per_dir=10, large=4, large_seconds=1200, corrupt=16),
+    'large': dict(depth=5, fanout=8, small_per_dir=10, large=8, large_seconds=3600, corrupt=64),
+}
+SMALL_SECONDS = 5
+
+def has_ffmpeg():
+    return shutil.which('ffmpeg') is not None
+
+def ffmpeg_generate(file, seconds, codec_args):
+    subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}', *codec_args, '-y', str(file)], check=True)
+
+def generate_library(dir, depth, fanout, small_per_dir, large, large_seconds, corrupt):
+    """Generates the library, returning the number of files and the total seconds of valid audio in it."""
+    templates = os.path.join(dir, 'templates')
+    os.makedirs(templates)
+    small = os.path.join(templates, 'small.mp3')
+    big = os.path.join(templates, 'large.flac')
+    if has_ffmpeg():
+        ffmpeg_generate(small, SMALL_SECONDS, ['-c:a', 'mp3', '-b:a', '128k'])
+        ffmpeg_generate(big, large_seconds, ['-c:a', 'flac'])
+    else:
+        # Only the scanning benchmark can run, and it doesn't care about the contents
+        for file in [small, big]:
+            with open(file, 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+
+    library = os.path.join(dir, 'library')
+    files = 0
+    seconds = 0
+    def populate(path, level):
+        nonlocal files, seconds
+        os.makedirs(path)
+        if level == depth:
+            for i in range(small_per_dir):
+                shutil.copyfile(small, os.path.join(path, f'track-{i:03}.mp3'))
+            files += small_per_dir
+            seconds += small_per_dir * SMALL_SECONDS
+            return
+        for i in range(fanout):
+            populate(os.path.join(path, f'dir-{i:02}'), level + 1)
+    populate(os.path.join(library, 'tree'), 0)
+
+    os.makedirs(os.path.join(library, 'large'))
+    for i in range(large):
+        shutil.copyfile(big, os.path.join(library, 'large', f'large-{i:02}.flac'))
+    files += large
+    seconds += large * large_seconds
+
+    os.makedirs(os.path.join(library, 'corrupt'))
+    for i in range(corrupt):
+        file = os.path.join(library, 'corrupt', f'corrupt-{i:02}.mp3')
+        shutil.copyfile(small, file)
+        size = os.stat(file).st_size
+        with open(file, 'r+b') as f:
+            f.seek(size // 2)
+            f.write(os.urandom(min(4096, size // 4)))
+    # Corrupt files fail quickly, so their audio isn't counted towards the realtime factor
+    files += corrupt
+    return library, files, seconds
+
+def run_automedia(args):
+    """Runs automedia quietly, returning the elapsed time and exit code."""
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = automedia_main.do_main([''] + args)
+    return time.monotonic() - start, result
+
+def bench_scan(library, jobs):
+    extension_regex = automedia_main.compile_extension_regex(automedia_main.DEFAULT_EXTENSIONS)
+    ignore_regex = automedia_main.compile_ignore_regex(automedia_main.DEFAULT_IGNORE_FILES)
+    scanner = PathScanner(
+        symlink_mode=SymlinkMode.Ignore,
+        supported_extension_matcher=lambda p: p.suffix and extension_regex.fullmatch(p.suffix),
+        ignored_pattern_matcher=lambda p: ignore_regex.fullmatch(p.name),
+        spam_files_matcher=lambda _: False)
+    class CountEntries(Operation):
+        def __init__(self):
+            self.entries = 0
+            self.lock = Lock()
+        def operate_scan(self, q, dir, results):
+            with self.lock:
+                self.entries += 1 + len(results.media_list) + len(results.directory_list)
+    results = {}
+    for n in jobs:
+        q = JobQueue(jobs=n)
+        op = CountEntries()
+        start = time.monotonic()
+        # Scanned the way a run scans, with each directory as a job on the pool
+        automedia_main.process_dir(q, scanner, Path(library), op)
+        elapsed = time.monotonic() - start
+        q.flush_logs()
+        results[str(n)] = {'seconds': round(elapsed, 4), 'entries': op.entries, 'entries_per_second': round(op.entries / elapsed, 1)}
+    return results
+
+def bench_forward_progress(dir, size_mb, use_ffmpeg):
+    file = forward_progress.make_input(dir, size_mb, use_ffmpeg)
+    size = os.stat(file).st_size
+    results = {}
+    for mode in InputMode:
+        wall, cpu = min(forward_progress.run(file, mode, use_ffmpeg) for _ in range(3))
+        results[mode.value] = {'seconds': round(wall, 4), 'mb_per_second': round(size / wall / 1024 / 1024, 1), 'python_cpu_seconds': round(cpu, 4)}
+    os.unlink(file)
+    return results
+
+def bench_verify(library, files, jobs):
+    results = {}
+    for n in jobs:
+        elapsed, result = run_automedia(['--root', library, '--no-cache', '--jobs', str(n), 'verify'])
+        # Every scale has corrupt files, so a run that passes hasn't verified anything
+        if result != 1:
+            raise RuntimeError(f"Verification with {n} jobs didn't find the corrupt files (exit code {result})")
+        results[str(n)] = {'seconds': round(elapsed, 3), 'files_per_second': round(files / elapsed, 2)}
+    return results
+
+def bench_transcode(library, seconds, jobs, dir):
+    results = {}
+    for n in jobs:
+        output = os.path.join(dir, f'transcode-{n}')
+        # The corrupt files aren't counted towards the realtime factor, so aren't transcoded either
+        elapsed, result = run_automedia(['--root', library, '--no-cache', '--ignore', f'{automedia_main.DEFAULT_IGNORE_FILES},corrupt', '--jobs', str(n),
+            'transcode', '--preset', 'aac-64k', '--output', output])
+        if result != 0:
+            raise RuntimeError(f"Transcoding with {n} jobs failed (exit code {result})")
+        shutil.rmtree(output)
+        results[str(n)] = {'seconds': round(elapsed, 3), 'realtime_factor': round(seconds / elapsed, 1)}
+    return results
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(__file__), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "(unknown)"
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the automedia benchmark suite")
+    parser.add_argument("--scale", default='small', choices=SCALES.keys(), help="size of the generated library (default small)")
+    parser.add_argument("--jobs", default=f"1,{os.cpu_count() or 1}", help="comma-separated job counts to benchmark (default 1 and the CPU count)")
+    parser.add_argument("--pipe-mb", type=int, default=256, help="size of the file used for the forward progress benchmark (default 256)")
+    parser.add_argument("--dir", help="directory to generate the library in (default system temp directory)")
+    parser.add_argument("--output", help="file to write the JSON results to (default stdout)")
+    args = parser.parse_args()
+    jobs = sorted(set(int(x) for x in args.jobs.split(',')))
+
+    results = {
+        'version': version(),
+        'scale': args.scale,
+        'machine': {'cpus': os.cpu_count(), 'platform': platform.platform(), 'python': platform.python_version()},
+        'benchmarks': {},
+    }
+    benchmarks = results['benchmarks']
+    with tempfile.TemporaryDirectory(dir=args.dir) as dir:
+        library, files, seconds = generate_library(dir, **SCALES[args.scale])
+        results['library'] = {'files': files, 'audio_seconds': seconds}
+        benchmarks['scan'] = bench_scan(library, jobs)
+        benchmarks['forward_progress'] = bench_forward_progress(dir, args.pipe_mb, False)
+        if has_ffmpeg():
+            benchmarks['forward_progress_ffmpeg'] = bench_forward_progress(dir, args.pipe_mb, True)
+            benchmarks['verify'] = bench_verify(library, files, jobs)
+            benchmarks['transcode'] = bench_transcode(library, seconds, jobs, dir)
+        else:
+            results['skipped'] = "ffmpeg was not found, so only the scan and forward progress benchmarks were run"
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from threading import Lock
+
+"""
+Identifies a specific version of a file on disk. If any of these change, we assume the contents did too.
+"""
+@dataclass(frozen=True)
+class FileFingerprint:
+    size: int
+    mtime_ns: int
+    inode: int
+
+    def of(file: Path):
+        return FileFingerprint.of_stat(os.stat(file))
+
+    def of_stat(st: os.stat_result):
+        return FileFingerprint(size=st.st_size, mtime_ns=st.st_mtime_ns, inode=st.st_ino)
+
+def default_cache_file(root: Path) -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    key = hashlib.sha1(str(root.resolve()).encode('utf8', errors='surrogateescape')).hexdigest()[:16]
+    return Path(cache_home) / 'automedia' / f'{root.resolve().name or "root"}-{key}.sqlite'
+
+"""
+Verification level of a full decode, the most thorough check.
+"""
+VERIFY_LEVEL_FULL = 2
+
+"""
+SQLite-backed state shared by all jobs in a run. A single connection is shared between threads and guarded by
+a lock, and the database runs in WAL mode so that separate processes can use the same file.
+"""
+class CacheDatabase:
+    def __init__(self, file: Path) -> None:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.file = file
+        self.lock = Lock()
+        self.db = sqlite3.connect(str(file), check_same_thread=False, timeout=60)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            with self.db:
+                return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+"""
+Records the last successful verification of each file (by path relative to the root) along with its fingerprint.
+Verifications can be of different thoroughness, recorded as a `level` where higher is more thorough.
+"""
+class VerificationCache:
+    def __init__(self, db: CacheDatabase, root: Path) -> None:
+        self.db = db
+        self.root = root
+        db.execute('''CREATE TABLE IF NOT EXISTS verified (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            verified_at REAL NOT NULL)''')
+        # Caches written before levels existed only recorded full decodes, so default to the most thorough level
+        if 'level' not in [row[1] for row in db.execute('PRAGMA table_info(verified)')]:
+            db.execute(f'ALTER TABLE verified ADD COLUMN level INTEGER NOT NULL DEFAULT {VERIFY_LEVEL_FULL}')
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def last_verified(self, file: Path, fingerprint: FileFingerprint, level=VERIFY_LEVEL_FULL):
+        """
+        Returns the time the file was last verified at `level` or higher, or None if it was never verified that
+        thoroughly in its current state.
+        """
+        rows = self.db.execute('SELECT size, mtime_ns, inode, verified_at, level FROM verified WHERE path = ?', (self._key(file),))
+        if not rows:
+            return None
+        size, mtime_ns, inode, verified_at, verified_level = rows[0]
+        if FileFingerprint(size=size, mtime_ns=mtime_ns, inode=inode) != fingerprint or verified_level < level:
+            return None
+        return verified_at
+
+    def verified_at(self, file: Path) -> float:
+        """Returns the time the file was last verified in any state, or 0 if it never was."""
+        rows = self.db.execute('SELECT verified_at FROM verified WHERE path = ?', (self._key(file),))
+        return rows[0][0] if rows else 0
+
+    def record_good(self, file: Path, fingerprint: FileFingerprint, level=VERIFY_LEVEL_FULL):
+        self.db.execute('INSERT OR REPLACE INTO verified (path, size, mtime_ns, inode, verified_at, level) VALUES (?, ?, ?, ?, ?, ?)',
+            (self._key(file), fingerprint.size, fingerprint.mtime_ns, fingerprint.inode, time.time(), level))
+
+    def record_bad(self, file: Path):
+        self.db.execute('DELETE FROM verified WHERE path = ?', (self._key(file),))
+
+"""
+Records how many sampled verification passes have been made over each large file (by path relative to the root),
+so that successive runs check different segments. The count is only kept while the file and the way it is divided
+into segments stay the same.
+"""
+class SampleTracker:
+    def __init__(self, db: CacheDatabase, root: Path) -> None:
+        self.db = db
+        self.root = root
+        db.execute('''CREATE TABLE IF NOT EXISTS sampled (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            layout TEXT NOT NULL,
+            passes INTEGER NOT NULL,
+            sampled_at REAL NOT NULL)''')
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def passes(self, file: Path, fingerprint: FileFingerprint, layout: str) -> int:
+        rows = self.db.execute('SELECT size, mtime_ns, layout, passes FROM sampled WHERE path = ?', (self._key(file),))
+        if not rows or rows[0][:3] != (fingerprint.size, fingerprint.mtime_ns, layout):
+            return 0
+        return rows[0][3]
+
+    def last_sampled(self, file: Path) -> float:
+        rows = self.db.execute('SELECT sampled_at FROM sampled WHERE path = ?', (self._key(file),))
+        return rows[0][0] if rows else 0
+
+    def record_pass(self, file: Path, fingerprint: FileFingerprint, layout: str, passes: int):
+        self.db.execute('INSERT OR REPLACE INTO sampled (path, size, mtime_ns, layout, passes, sampled_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (self._key(file), fingerprint.size, fingerprint.mtime_ns, layout, passes, time.time()))
+
+class ChecksumAlgorithm(Enum):
+    Blake2b = "blake2b"
+    Sha256 = "sha256"
+
+    def new(self):
+        return hashlib.new(self.value)
+
+"""
+Records a content digest of each file (by path relative to the root), along with the size and mtime it had when the
+digest was taken. A file whose digest changes while its size and mtime don't has been corrupted on disk (bitrot).
+"""
+class ChecksumManifest:
+    def __init__(self, db: CacheDatabase, root: Path, algorithm: ChecksumAlgorithm) -> None:
+        self.db = db
+        self.root = root
+        self.algorithm = algorithm
+        db.execute('''CREATE TABLE IF NOT EXISTS checksums (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            algorithm TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            checked_at REAL NOT NULL)''')
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def check(self, file: Path, fingerprint: FileFingerprint, digest: str) -> bool:
+        """
+        Compares the digest with the one recorded for the file, returning False if the contents changed without the
+        size or mtime changing. Otherwise the new digest is recorded.
+        """
+        rows = self.db.execute('SELECT size, mtime_ns, algorithm, digest FROM checksums WHERE path = ?', (self._key(file),))
+        if rows and rows[0][:3] == (fingerprint.size, fingerprint.mtime_ns, self.algorithm.value) and rows[0][3] != digest:
+            # Keep the known-good digest, so the file is reported again until it's repaired
+            return False
+        self.db.execute('INSERT OR REPLACE INTO checksums (path, size, mtime_ns, algorithm, digest, checked_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (self._key(file), fingerprint.size, fingerprint.mtime_ns, self.algorithm.value, digest, time.time()))
+        return True
+
+"""
+Records content hashes of each file (by path relative to the root), along with the fingerprint it had when hashed:
+a hash of its head and tail, and a hash of its whole contents where that was needed to tell it apart from other
+files. Written by `dedupe`, so that byte-identical files can share the results of other operations.
+"""
+class ContentIndex:
+    def __init__(self, db: CacheDatabase, root: Path) -> None:
+        self.db = db
+        self.root = root
+        db.execute('''CREATE TABLE IF NOT EXISTS content (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            partial TEXT NOT NULL,
+            full TEXT)''')
+        db.execute('CREATE INDEX IF NOT EXISTS content_full ON content (size, full)')
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def lookup(self, file: Path, fingerprint: FileFingerprint):
+        """Returns the (partial, full) hashes recorded for the file in its current state, either of which may be None."""
+        rows = self.db.execute('SELECT size, mtime_ns, inode, partial, full FROM content WHERE path = ?', (self._key(file),))
+        if not rows or FileFingerprint(*rows[0][:3]) != fingerprint:
+            return None, None
+        return rows[0][3], rows[0][4]
+
+    def record(self, file: Path, fingerprint: FileFingerprint, partial: str, full: str = None):
+        self.db.execute('INSERT OR REPLACE INTO content (path, size, mtime_ns, inode, partial, full) VALUES (?, ?, ?, ?, ?, ?)',
+            (self._key(file), fingerprint.size, fingerprint.mtime_ns, fingerprint.inode, partial, full))
+
+    def duplicates(self, file: Path, fingerprint: FileFingerprint):
+        """
+        Returns the other files recorded with the same contents as the file in its current state, each with the
+        fingerprint it had when hashed (which may have changed since).
+        """
+        _, full = self.lookup(file, fingerprint)
+        if full is None:
+            return []
+        rows = self.db.execute('SELECT path, size, mtime_ns, inode FROM content WHERE size = ? AND full = ? AND path != ?',
+            (fingerprint.size, full, self._key(file)))
+        return [(self.root / path, FileFingerprint(size, mtime_ns, inode)) for path, size, mtime_ns, inode in rows]
+
+"""
+Sidecar manifest stored in a transcode output directory, recording which source file and preset produced each
+output file (all paths relative to their respective roots).
+"""
+class TranscodeManifest:
+    def __init__(self, db: CacheDatabase) -> None:
+        self.db = db
+        db.execute('''CREATE TABLE IF NOT EXISTS transcoded (
+            output TEXT PRIMARY KEY,
+            source TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            preset TEXT NOT NULL,
+            output_size INTEGER NOT NULL)''')
+
+    def is_up_to_date(self, output: str, source: str, fingerprint: FileFingerprint, preset: str, output_size: int):
+        rows = self.db.execute('SELECT source, size, mtime_ns, preset, output_size FROM transcoded WHERE output = ?', (output,))
+        return bool(rows) and rows[0] == (source, fingerprint.size, fingerprint.mtime_ns, preset, output_size)
+
+    def record(self, output: str, source: str, fingerprint: FileFingerprint, preset: str, output_size: int):
+        self.db.execute('INSERT OR REPLACE INTO transcoded (output, source, size, mtime_ns, preset, output_size) VALUES (?, ?, ?, ?, ?, ?)',
+            (output, source, fingerprint.size, fingerprint.mtime_ns, preset, output_size))
+
+    def remove(self, output: str):
+        self.db.execute('DELETE FROM transcoded WHERE output = ?', (output,))
+
+    def outputs_of(self, source: str, fingerprint: FileFingerprint, preset: str):
+        """Returns (output, output_size) for each output recorded for the source in the given state and preset."""
+        return self.db.execute('SELECT output, output_size FROM transcoded WHERE source = ? AND size = ? AND mtime_ns = ? AND preset = ?',
+            (source, fingerprint.size, fingerprint.mtime_ns, preset))
+
+    def entries(self):
+        """Returns (output, source) pairs for every recorded output."""
+        return self.db.execute('SELECT output, source FROM transcoded ORDER BY output')
@@ -0,0 +1,136 @@
+import csv
+import json
+import time
+
+from dataclasses import astuple, fields
+from enum import Enum
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+
+from .cache import CacheDatabase, FileFingerprint
+from .ffmpeg import ffmpeg_supports
+from .ffprobe import MediaInfo, ffprobe
+from .operation import Operation
+
+MEDIA_INFO_FIELDS = [x.name for x in fields(MediaInfo)]
+
+class CatalogFormat(Enum):
+    Csv = "csv"
+    # One JSON object per line
+    Json = "json"
+
+"""
+Media information for each file (by path relative to the root) as last probed, one column per `MediaInfo` field so
+that the catalog can be queried directly. Each entry is only used while the file's fingerprint is unchanged.
+"""
+class MediaCatalog:
+    def __init__(self, db: CacheDatabase, root: Path) -> None:
+        self.db = db
+        self.root = root
+        db.execute('''CREATE TABLE IF NOT EXISTS catalog (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            container TEXT,
+            duration REAL,
+            bitrate INTEGER,
+            audio_codec TEXT,
+            audio_bitrate INTEGER,
+            channels INTEGER,
+            sample_rate INTEGER,
+            video_codec TEXT,
+            width INTEGER,
+            height INTEGER,
+            probed_at REAL NOT NULL)''')
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def lookup(self, file: Path, fingerprint: FileFingerprint) -> Optional[MediaInfo]:
+        rows = self.db.execute(f'SELECT size, mtime_ns, inode, {", ".join(MEDIA_INFO_FIELDS)} FROM catalog WHERE path = ?', (self._key(file),))
+        if not rows or FileFingerprint(*rows[0][:3]) != fingerprint:
+            return None
+        return MediaInfo(*rows[0][3:])
+
+    def record(self, file: Path, fingerprint: FileFingerprint, info: MediaInfo):
+        values = astuple(info)
+        self.db.execute(f'INSERT OR REPLACE INTO catalog (path, size, mtime_ns, inode, {", ".join(MEDIA_INFO_FIELDS)}, probed_at) VALUES ({", ".join("?" * (len(values) + 5))})',
+            (self._key(file), fingerprint.size, fingerprint.mtime_ns, fingerprint.inode, *values, time.time()))
+
+    def paths(self):
+        return [row[0] for row in self.db.execute('SELECT path FROM catalog')]
+
+    def remove(self, path: str):
+        self.db.execute('DELETE FROM catalog WHERE path = ?', (path,))
+
+    def export(self, file: Path, format: CatalogFormat):
+        """Writes every entry to the file, ordered by path."""
+        columns = ['path', 'size'] + MEDIA_INFO_FIELDS
+        rows = self.db.execute(f'SELECT {", ".join(columns)} FROM catalog ORDER BY path')
+        temp = file.with_name(f'.{file.name}.tmp')
+        with open(temp, 'w', newline='') as f:
+            if format == CatalogFormat.Csv:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(rows)
+            else:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(columns, row))) + '\n')
+        temp.replace(file)
+
+"""
+Probes every media file with ffprobe and records the results in the `MediaCatalog`, only probing files that are new
+or changed since they were last probed. Entries for files that no longer exist are removed, and the whole catalog is
+written to `export` (if given) at the end of the run.
+"""
+class CatalogOperation(Operation):
+    def __init__(self, catalog: MediaCatalog, export: Path = None, export_format=CatalogFormat.Csv) -> None:
+        self.catalog = catalog
+        self.export = export
+        self.export_format = export_format
+        self.seen = set()
+        self.stats = { 'probed': 0, 'unchanged': 0, 'failed': 0 }
+        self.lock = Lock()
+
+    def initialize(self, q, dir):
+        self.root = dir
+        q.info(f"Cataloging media files (cache: {self.catalog.db.file})")
+
+    def operate_scan(self, q, dir, results):
+        files = [x for x in results.media_list if ffmpeg_supports(x)]
+        with self.lock:
+            self.seen.update(str(x.relative_to(self.root)) for x in files)
+        for file in files:
+            q.submit(file.name, lambda q, file=file: self._job(q, file, FileFingerprint.of_stat(results.media_stats[file])), device=results.media_stats[file].st_dev)
+        q.wait()
+
+    def operate(self, q, dir, files):
+        pass
+
+    def finalize(self, q, dir):
+        removed = 0
+        for path in self.catalog.paths():
+            if path not in self.seen:
+                self.catalog.remove(path)
+                removed += 1
+        q.info(f"{self.stats['probed']} file(s) probed, {self.stats['unchanged']} unchanged file(s) skipped, {self.stats['failed']} file(s) failed, {removed} removed file(s) dropped")
+        if self.export:
+            self.catalog.export(self.export, self.export_format)
+            q.info(f"Exported the catalog to {self.export}")
+
+    def _job(self, q, file, fingerprint):
+        if self.catalog.lookup(file, fingerprint):
+            result = 'unchanged'
+        else:
+            info, errors = ffprobe(file)
+            if errors:
+                q.error(errors)
+                self.catalog.remove(str(file.relative_to(self.root)))
+                result = 'failed'
+            else:
+                self.catalog.record(file, fingerprint, MediaInfo.of(info))
+                result = 'probed'
+        with self.lock:
+            self.stats[result] += 1
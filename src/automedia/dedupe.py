@@ -0,0 +1,137 @@
+import hashlib
+import os
+
+from collections import defaultdict
+from pathlib import Path
+from threading import Lock
+
+from .cache import ContentIndex, FileFingerprint
+from .operation import Operation
+
+"""
+Bytes read from each of the head and tail of a file for its partial hash. Files with the same size that differ
+usually differ here (ie: in their tags), so most never need to be read in full.
+"""
+PARTIAL_HASH_BYTES = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def partial_hash(file: Path, size: int) -> str:
+    """Hash of the head and tail of a file, which is the hash of its whole contents for small files."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb', buffering=0) as f:
+        if size <= 2 * PARTIAL_HASH_BYTES:
+            h.update(f.read(size))
+        else:
+            h.update(f.read(PARTIAL_HASH_BYTES))
+            h.update(os.pread(f.fileno(), PARTIAL_HASH_BYTES, size - PARTIAL_HASH_BYTES))
+    return h.hexdigest()
+
+def is_small(fingerprint: FileFingerprint):
+    """Whether the partial hash of a file covers its whole contents."""
+    return fingerprint.size <= 2 * PARTIAL_HASH_BYTES
+
+def full_hash(file: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb', buffering=0) as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+"""
+Finds sets of byte-identical media files. Files are grouped by size as the tree is scanned, then files sharing a size
+are grouped by a hash of their head and tail, and only files that still share a group are hashed in full, so that
+as little as possible is read.
+
+If a `ContentIndex` is provided, the hashes are recorded in it, and files that are unchanged since they were last
+hashed aren't read again.
+"""
+class DedupeOperation(Operation):
+    def __init__(self, index: ContentIndex = None) -> None:
+        self.index = index
+        self.lock = Lock()
+        self.by_size = defaultdict(list)
+
+    def initialize(self, q, dir):
+        self.root = dir
+        q.info("Finding duplicate media files")
+
+    def operate(self, q, dir, files):
+        pass
+
+    def operate_scan(self, q, dir, results):
+        with self.lock:
+            for file, st in results.media_stats.items():
+                self.by_size[st.st_size].append((file, st.st_dev, FileFingerprint.of_stat(st)))
+
+    def finalize(self, q, dir):
+        with self.lock:
+            by_size, self.by_size = self.by_size, defaultdict(list)
+        candidates = []
+        links = defaultdict(list)
+        for files in by_size.values():
+            # Hard links already share their storage, so only one path to each is hashed and reported
+            unique = {}
+            for file, dev, fingerprint in files:
+                if (dev, fingerprint.inode) in unique:
+                    links[unique[dev, fingerprint.inode][0]].append(file)
+                else:
+                    unique[dev, fingerprint.inode] = (file, dev, fingerprint)
+            if len(unique) > 1:
+                candidates.append(list(unique.values()))
+        count = sum(len(x) for x in candidates)
+        q.info(f"Hashing {count} of {sum(len(x) for x in by_size.values())} file(s) that share their size with another")
+        q.flush_logs()
+
+        files = [x for group in candidates for x in group]
+        partial = self._hash_all(q, files, lambda file, fingerprint: partial_hash(file, fingerprint.size), False)
+        groups = self._group(candidates, partial)
+        full = self._hash_all(q, [x for group in groups if not is_small(group[0][2]) for x in group], lambda file, _: full_hash(file), True)
+        if self.index:
+            for file, _, fingerprint in files:
+                if file in partial:
+                    for path in [file] + links[file]:
+                        self.index.record(path, fingerprint, partial[file], partial[file] if is_small(fingerprint) else full.get(file))
+        contents = {file: partial[file] if is_small(fingerprint) else full.get(file) for group in groups for file, _, fingerprint in group}
+        self._report(q, self._group(groups, {file: x for file, x in contents.items() if x}))
+
+    def _hash_all(self, q, files, hash, full):
+        """Hashes each file in a separate job, returning the hash of each file that could be read."""
+        hashes = {}
+        lock = Lock()
+        def job(q, file, fingerprint):
+            recorded = self.index.lookup(file, fingerprint)[1 if full else 0] if self.index else None
+            try:
+                value = recorded or hash(file, fingerprint)
+            except OSError as e:
+                q.error(f"Failed to read file ({e})")
+                return
+            if not recorded:
+                q.add_metrics(bytes=fingerprint.size if full else min(fingerprint.size, 2 * PARTIAL_HASH_BYTES))
+            with lock:
+                hashes[file] = value
+        for file, dev, fingerprint in files:
+            q.submit(str(file.relative_to(self.root)), lambda q, file=file, fingerprint=fingerprint: job(q, file, fingerprint), device=dev)
+        q.wait()
+        return hashes
+
+    def _group(self, groups, hashes):
+        """Splits each group by the files' hashes, returning the groups of more than one file."""
+        result = []
+        for group in groups:
+            by_hash = defaultdict(list)
+            for x in group:
+                if x[0] in hashes:
+                    by_hash[hashes[x[0]]].append(x)
+            result += [x for x in by_hash.values() if len(x) > 1]
+        return result
+
+    def _report(self, q, duplicates):
+        duplicates.sort(key=lambda group: group[0][2].size * (len(group) - 1), reverse=True)
+        reclaimable = 0
+        for group in duplicates:
+            size = group[0][2].size
+            reclaimable += size * (len(group) - 1)
+            q.info(f"{len(group)} identical files of {size // 1024}k:")
+            for file, _, _ in sorted(group):
+                q.info(f"  {file.relative_to(self.root)}")
+        q.info(f"{len(duplicates)} set(s) of duplicates, {sum(len(x) - 1 for x in duplicates)} redundant copies, {reclaimable // 1024 // 1024}MB could be reclaimed")
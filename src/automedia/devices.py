@@ -0,0 +1,41 @@
+import os
+
+from threading import Lock
+from typing import Dict, Optional
+
+"""
+Concurrent file jobs allowed per spinning disk by default: enough to overlap one file's I/O with another's
+processing, without the heads seeking back and forth between several streams.
+"""
+ROTATIONAL_DEVICE_JOBS = 2
+
+def is_rotational(dev: int) -> Optional[bool]:
+    """Whether the block device `dev` (an `st_dev`) is a spinning disk, or None if it can't be determined."""
+    base = f'/sys/dev/block/{os.major(dev)}:{os.minor(dev)}'
+    # Partitions don't have their own queue, so look at the disk they belong to
+    for queue in [f'{base}/queue/rotational', f'{base}/../queue/rotational']:
+        try:
+            with open(queue, 'rt') as f:
+                return f.read().strip() == '1'
+        except OSError:
+            pass
+    return None
+
+"""
+Maximum number of concurrent file jobs for each device. If `jobs` is given, every device gets that limit.
+Otherwise spinning disks get `ROTATIONAL_DEVICE_JOBS`, and other devices (SSDs, network and union filesystems,
+which hide the disks underneath) are only limited by the total number of jobs.
+"""
+class DeviceLimits:
+    def __init__(self, jobs: Optional[int] = None) -> None:
+        self.jobs = jobs
+        self.lock = Lock()
+        self.limits: Dict[int, Optional[int]] = {}
+
+    def __call__(self, dev: int) -> Optional[int]:
+        if self.jobs is not None:
+            return self.jobs
+        with self.lock:
+            if dev not in self.limits:
+                self.limits[dev] = ROTATIONAL_DEVICE_JOBS if is_rotational(dev) else None
+            return self.limits[dev]
@@ -1,15 +1,48 @@
+import math
+import os
+import shutil
+
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
+from threading import Lock
 from typing import List
 
+from .cache import CacheDatabase, FileFingerprint, TranscodeManifest
 from .ffmpeg import MediaType, ffmpeg_supports_types
-from .forward_progress import subprocess_forward_progress
+from .ffprobe import MediaInfo, ffprobe, input_arg, run_ffmpeg_tool
+from .forward_progress import InputMode, ProcessStats, subprocess_forward_progress
+from .mirror import CompanionMode, is_identical, place_file
 from .operation import Operation
 
+class CompatibleSource(Enum):
+    # Encode the source like any other
+    Transcode = "transcode"
+    # Copy the audio stream into the preset's container without re-encoding it
+    Remux = "remux"
+    # Hard link the source file as the output, falling back to copying it
+    Link = "link"
+    # Copy the source file as the output
+    Copy = "copy"
+
+"""
+A source's audio bitrate may be this much over the preset's and still count as compatible, as encoders overshoot
+their nominal bitrate.
+"""
+BITRATE_TOLERANCE = 1.1
+
 @dataclass
 class FFMPEGPreset:
     ext: str
     args: List[str]
+    # Whether segments can be joined without re-encoding at all. A FLAC stream's header describes the whole stream (its
+    # length and MD5), and only its last frame may be short, so joined segments would be invalid.
+    splittable: bool = True
+    # Sources whose audio is already in this codec (as named by ffprobe) at no more than this bitrate (None for any)
+    # are handled according to `compatible` instead of being transcoded
+    codec: str = None
+    bitrate: int = None
+    compatible: CompatibleSource = CompatibleSource.Transcode
 
 FFMPEG_TRANSCODE_BASE_ARGS = [
     '-xerror',
@@ -17,39 +50,375 @@ FFMPEG_TRANSCODE_BASE_ARGS = [
     '-y',
     '-i', '-']
 FFMPEG_PRESETS = {
-    'aac-64k': FFMPEGPreset(ext='m4a', args=['-vn', '-c:a', 'aac', '-b:a', '64k', '-f', 'mp4']),
-    'aac-128k': FFMPEGPreset(ext='m4a', args=['-vn', '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4']),
-    'mp3-128k': FFMPEGPreset(ext='mp3', args=['-vn', '-c:a', 'mp3', '-b:a', '128k', '-f', 'mp3']),
-    'mp3-320k': FFMPEGPreset(ext='mp3', args=['-vn', '-c:a', 'mp3', '-b:a', '320k', '-f', 'mp3']),
-    'flac': FFMPEGPreset(ext='flac', args=['-vn', '-c:a', 'flac', '-f', 'flac']),
+    # AAC sources may be in other containers (ie: .aac or .mp4), so are always remuxed
+    'aac-64k': FFMPEGPreset(ext='m4a', args=['-vn', '-c:a', 'aac', '-b:a', '64k', '-f', 'mp4'], codec='aac', bitrate=64000, compatible=CompatibleSource.Remux),
+    'aac-128k': FFMPEGPreset(ext='m4a', args=['-vn', '-c:a', 'aac', '-b:a', '128k', '-f', 'mp4'], codec='aac', bitrate=128000, compatible=CompatibleSource.Remux),
+    'mp3-128k': FFMPEGPreset(ext='mp3', args=['-vn', '-c:a', 'mp3', '-b:a', '128k', '-f', 'mp3'], codec='mp3', bitrate=128000, compatible=CompatibleSource.Copy),
+    'mp3-320k': FFMPEGPreset(ext='mp3', args=['-vn', '-c:a', 'mp3', '-b:a', '320k', '-f', 'mp3'], codec='mp3', bitrate=320000, compatible=CompatibleSource.Copy),
+    'flac': FFMPEGPreset(ext='flac', args=['-vn', '-c:a', 'flac', '-f', 'flac'], splittable=False, codec='flac', compatible=CompatibleSource.Copy),
 }
 
+class SplitMode(Enum):
+    # Split long inputs, accepting a few milliseconds of padding at each join (lossy encoders pad the start and end of
+    # each segment)
+    Always = "always"
+    Never = "never"
+
+"""
+Files smaller or shorter than this are dominated by process startup, and are encoded with a single thread.
+"""
+SMALL_FILE_SIZE = 16 * 1024 * 1024
+SMALL_FILE_SECONDS = 10 * 60
+
+"""
+Inputs at least this long are split into segments of at least `SPLIT_SEGMENT_SECONDS`, one per job slot at most,
+which are encoded in parallel and then concatenated without re-encoding.
+"""
+SPLIT_MIN_SECONDS = 30 * 60
+SPLIT_SEGMENT_SECONDS = 5 * 60
+
+"""
+Segments are encoded from the file by path rather than through the forward-progress watchdog, so a hung process is
+caught by a timeout of this many times the segment's length instead.
+"""
+SPLIT_TIMEOUT_FACTOR = 2
+
+def transcode_threads(size, length, jobs, cpus=None):
+    """ffmpeg threads for one encode, so that `jobs` concurrent encodes share the CPUs without oversubscribing them."""
+    if size < SMALL_FILE_SIZE or length < SMALL_FILE_SECONDS:
+        return 1
+    return max(1, (cpus or os.cpu_count() or 1) // jobs)
+
+def split_segments(length, jobs):
+    """(start, seconds) of the segments to encode a `length` second input in, or a single segment if not worth it."""
+    if jobs < 2 or length < SPLIT_MIN_SECONDS:
+        return [(0, length)]
+    count = max(1, min(jobs, math.floor(length / SPLIT_SEGMENT_SECONDS)))
+    step = length / count
+    return [(i * step, step) for i in range(count)]
+
+def is_compatible(info: MediaInfo, codec: str, bitrate: int = None):
+    """Whether the probed source's audio is already in `codec` at no more than `bitrate` (None for any bitrate)."""
+    if info.audio_codec is None or info.audio_codec != codec:
+        return False
+    if bitrate is None:
+        return True
+    return info.audio_bitrate is not None and info.audio_bitrate <= bitrate * BITRATE_TOLERANCE
+
+def concat_list_entry(file: Path):
+    return "file '" + str(file).replace("'", "'\\''") + "'"
+
+"""
+Name of the manifest in the output directory that records how each output file was produced.
+"""
+TRANSCODE_MANIFEST_NAME = '.automedia-transcode.sqlite'
+
 class FFMPEGTranscoderOperation(Operation):
-    def __init__(self, output_dir: Path, transcode_args: List[str], extension: str) -> None:
+    """
+    When `incremental` is set, outputs whose source file and preset are unchanged since they were last written are
+    skipped. When `prune` is set, outputs whose source file no longer exists are removed at the end of the run.
+
+    Long inputs are encoded as segments in parallel if `split` is `SplitMode.Always`, unless the preset isn't
+    `splittable`.
+
+    Outputs are written under a temporary name and renamed once complete. Files already transcoded by the run
+    recorded in `journal` (if given) are skipped, and files that failed are tried again.
+
+    If a `ContentIndex` is provided as `duplicates`, the output of a byte-identical file (as last found by `dedupe`)
+    transcoded with the same preset is linked or copied rather than transcoding the file again.
+
+    Sources whose audio is already in `compatible_codec` at no more than `compatible_bitrate` (see `is_compatible`)
+    are handled according to `compatible` instead of being encoded again. Linking or copying the source as-is also
+    needs it to be in the output's container and extension without any video, and otherwise falls back to remuxing.
+    Sources are probed to decide this, using the probe recorded in `catalog` (a `MediaCatalog`) if the file is
+    unchanged since.
+
+    Files that aren't transcoded (ie: covers, subtitles) are mirrored into the output tree according to `companions`,
+    skipping those already identical to their source, and are pruned along with the transcoded outputs.
+    """
+    def __init__(self, output_dir: Path, transcode_args: List[str], extension: str, incremental=False, prune=False, input_mode=InputMode.Pipe, split=SplitMode.Never, journal=None, splittable=True,
+            duplicates=None, compatible=CompatibleSource.Transcode, compatible_codec=None, compatible_bitrate=None, catalog=None,
+            companions=CompanionMode.Skip) -> None:
         self.output_dir = output_dir
+        self.preset_args = transcode_args
         self.transcode_args = FFMPEG_TRANSCODE_BASE_ARGS + transcode_args
         self.extension = f'.{extension}'
-        
+        self.split = split
+        self.splittable = splittable
+        self.incremental = incremental
+        self.prune = prune
+        self.input_mode = input_mode
+        self.journal = journal
+        self.duplicates = duplicates
+        self.compatible = compatible if compatible_codec else CompatibleSource.Transcode
+        self.compatible_codec = compatible_codec
+        self.compatible_bitrate = compatible_bitrate
+        self.catalog = catalog
+        self.companions = companions
+        self.format = transcode_args[transcode_args.index('-f') + 1]
+        # Any change to the ffmpeg command line (ie: switching presets) invalidates existing outputs
+        self.preset_key = ' '.join(self.transcode_args)
+        # Outputs not encoded by the preset are recorded with how they were produced instead
+        self.compatible_key = f'{self.preset_key} [{self.compatible.value}]'
+
     def initialize(self, q, dir):
         q.info(f"Transcoding files: ffmpeg {' '.join(self.transcode_args)} [output-file] < [input-file]")
+        if not self.splittable and self.split == SplitMode.Always:
+            q.warning("Segments of this preset cannot be joined without re-encoding, so files are not split")
+            self.split = SplitMode.Never
         self.root = dir
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = TranscodeManifest(CacheDatabase(self.output_dir / TRANSCODE_MANIFEST_NAME))
+
+    def finalize(self, q, dir):
+        if self.prune:
+            self._prune(q)
+        self.manifest.db.close()
 
-    def operate(self, q, dir, files: List[Path]):
+    def operate_scan(self, q, dir, results):
+        if results.media_list:
+            self.operate(q, dir, results.media_list, devices={file: st.st_dev for file, st in results.media_stats.items()})
+
+    def operate(self, q, dir, files: List[Path], devices=None):
+        """`devices` optionally gives the device of each file, to limit concurrent reads from each device."""
+        devices = devices or {}
+        stats = { 'up-to-date': 0, 'duplicate': 0, 'resumed': 0, 'remuxed': 0, 'linked': 0, 'copied': 0, 'mirrored': 0, 'identical': 0 }
+        lock = Lock()
         for file in files:
-            q.submit(file.name, lambda q: self._job(q, file))
+            q.submit(file.name, lambda q, file=file: self._job(q, stats, lock, file), device=devices.get(file))
         q.wait()
+        if stats['up-to-date']:
+            q.info(f"{stats['up-to-date']} up-to-date file(s) skipped")
+        if stats['duplicate']:
+            q.info(f"{stats['duplicate']} file(s) identical to an already transcoded file reused")
+        if stats['resumed']:
+            q.info(f"{stats['resumed']} file(s) already done by the interrupted run skipped")
+        if stats['remuxed'] or stats['linked'] or stats['copied']:
+            q.info(f"{stats['remuxed']} compatible file(s) remuxed, {stats['linked']} linked and {stats['copied']} copied instead of transcoded")
+        if stats['mirrored'] or stats['identical']:
+            q.info(f"{stats['mirrored']} companion file(s) mirrored, {stats['identical']} already identical")
 
-    def _job(self, q, file: Path):
+    def _job(self, q, stats, lock, file: Path):
+        # Files that failed are tried again, so the resumed run still reports them
+        if self.journal and self.journal.outcome(file) == 'good':
+            with lock:
+                stats['resumed'] += 1
+            return
         if ffmpeg_supports_types([MediaType.Video, MediaType.Audio], file):
-            q.info(f"Transcoding...")
             out = self.output_dir / file.with_suffix(self.extension).relative_to(self.root)
+            output_key = str(out.relative_to(self.output_dir))
+            source_key = str(file.relative_to(self.root))
+            try:
+                fingerprint = FileFingerprint.of(file)
+            except OSError as e:
+                # ie: removed since it was scanned
+                q.error(f"Failed to read file ({e})")
+                if self.journal:
+                    self.journal.record(file, 'bad')
+                return
+            if self.incremental and out.exists() and any(self.manifest.is_up_to_date(output_key, source_key, fingerprint, key, out.stat().st_size) for key in {self.preset_key, self.compatible_key}):
+                with lock:
+                    stats['up-to-date'] += 1
+                return
+            self.manifest.remove(output_key)
             out.parent.mkdir(parents=True, exist_ok=True)
-            args = self.transcode_args + [str(out)]
-            errors = subprocess_forward_progress(file, args, "ffmpeg")
+            # A crash must never leave a truncated output that looks complete
+            partial = out.with_name(f'.automedia-partial-{out.name}')
+            if self.duplicates and self._reuse_duplicate(q, file, fingerprint, out, partial):
+                self.manifest.record(output_key, source_key, fingerprint, self.preset_key, out.stat().st_size)
+                if self.journal:
+                    self.journal.record(file, 'good')
+                with lock:
+                    stats['duplicate'] += 1
+                return
+            # Small files are always encoded in one piece with one thread, so are only probed to check if they are compatible
+            info = None
+            if self.compatible != CompatibleSource.Transcode or fingerprint.size >= SMALL_FILE_SIZE:
+                info = self._probe(q, file, fingerprint)
+            if info and is_compatible(info, self.compatible_codec, self.compatible_bitrate):
+                ok, result = self._reuse_compatible(q, file, info, out, partial)
+                if ok:
+                    self.manifest.record(output_key, source_key, fingerprint, self.compatible_key, out.stat().st_size)
+                    with lock:
+                        stats[result] += 1
+                if self.journal:
+                    self.journal.record(file, 'good' if ok else 'bad')
+                return
+            length = (info.duration or 0) if info else 0
+            segments = split_segments(length, q.pool.jobs) if self.split == SplitMode.Always else [(0, length)]
+            if len(segments) > 1:
+                q.info(f"Transcoding in {len(segments)} segments...")
+                errors = self._transcode_segments(q, file, partial, segments)
+            else:
+                threads = transcode_threads(fingerprint.size, length, q.pool.jobs)
+                q.info(f"Transcoding..." if threads == 1 else f"Transcoding with {threads} threads...")
+                args = self.transcode_args + ['-threads', str(threads), str(partial)]
+                process_stats = ProcessStats()
+                errors = subprocess_forward_progress(file, args, "ffmpeg", input_mode=self.input_mode, stats=process_stats)
+                q.add_metrics(bytes=process_stats.bytes_read, cpu_seconds=process_stats.cpu_seconds)
             if errors:
                 q.error(errors)
-            if out.exists():
-                q.info(f"Size: {file.stat().st_size // 1024}k -> {out.stat().st_size // 1024}k")
-            else:
+            ok = False
+            if not partial.exists():
                 q.error("Failed to transcode file")
+            elif errors:
+                partial.unlink()
+            else:
+                os.replace(partial, out)
+                q.info(f"Size: {file.stat().st_size // 1024}k -> {out.stat().st_size // 1024}k")
+                self.manifest.record(output_key, source_key, fingerprint, self.preset_key, out.stat().st_size)
+                ok = True
+            if self.journal:
+                self.journal.record(file, 'good' if ok else 'bad')
+        elif self.companions != CompanionMode.Skip:
+            self._mirror(q, stats, lock, file)
+
+    def _mirror(self, q, stats, lock, file: Path):
+        out = self.output_dir / file.relative_to(self.root)
+        output_key = str(out.relative_to(self.output_dir))
+        if is_identical(file, out):
+            with lock:
+                stats['identical'] += 1
+            return
+        self.manifest.remove(output_key)
+        try:
+            fingerprint = FileFingerprint.of(file)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            method = place_file(file, out, link=self.companions == CompanionMode.Link)
+        except OSError as e:
+            q.error(f"Failed to mirror file ({e})")
+            if self.journal:
+                self.journal.record(file, 'bad')
+            return
+        if method == 'copied':
+            q.add_metrics(bytes=fingerprint.size)
+        q.info(f"Mirrored ({method})")
+        # Recorded so that the mirrored file is pruned once its source is removed
+        self.manifest.record(output_key, output_key, fingerprint, 'mirror', fingerprint.size)
+        if self.journal:
+            self.journal.record(file, 'good')
+        with lock:
+            stats['mirrored'] += 1
+
+    def _probe(self, q, file: Path, fingerprint: FileFingerprint):
+        """Media information for the file, from the catalog if it is unchanged since it was last probed."""
+        info = self.catalog.lookup(file, fingerprint) if self.catalog else None
+        if info is None:
+            probed, _ = ffprobe(file)
+            if probed is None:
+                return None
+            info = MediaInfo.of(probed)
+            if self.catalog:
+                self.catalog.record(file, fingerprint, info)
+        return info
+
+    def _reuse_compatible(self, q, file: Path, info: MediaInfo, out: Path, partial: Path):
+        """Writes a compatible source to `out` without encoding it, returning whether it succeeded and which stat to count it in."""
+        policy = self.compatible
+        if policy in [CompatibleSource.Link, CompatibleSource.Copy] and \
+                (file.suffix.lower() != self.extension or self.format not in (info.container or '').split(',') or info.video_codec):
+            policy = CompatibleSource.Remux
+        if policy == CompatibleSource.Remux:
+            q.info(f"Remuxing compatible {info.audio_codec} file...")
+            args = FFMPEG_TRANSCODE_BASE_ARGS + ['-vn', '-c:a', 'copy', '-f', self.format, str(partial)]
+            process_stats = ProcessStats()
+            errors = subprocess_forward_progress(file, args, "ffmpeg", input_mode=self.input_mode, stats=process_stats)
+            q.add_metrics(bytes=process_stats.bytes_read, cpu_seconds=process_stats.cpu_seconds)
+            if errors or not partial.exists():
+                q.error(errors or "Failed to remux file")
+                partial.unlink(missing_ok=True)
+                return False, None
+            result = 'remuxed'
+        else:
+            try:
+                if policy == CompatibleSource.Link:
+                    try:
+                        os.link(file, partial)
+                        result = 'linked'
+                    except OSError:
+                        shutil.copyfile(file, partial)
+                        result = 'copied'
+                else:
+                    shutil.copyfile(file, partial)
+                    result = 'copied'
+            except OSError as e:
+                q.error(f"Failed to copy compatible file ({e})")
+                partial.unlink(missing_ok=True)
+                return False, None
+            q.info(f"Compatible {info.audio_codec} file {result} as-is")
+        os.replace(partial, out)
+        return True, result
+
+    def _reuse_duplicate(self, q, file: Path, fingerprint: FileFingerprint, out: Path, partial: Path):
+        """Links (or copies) the up-to-date output of a byte-identical file to `out`, returning whether there was one."""
+        for other, other_fingerprint in self.duplicates.duplicates(file, fingerprint):
+            for output_key, output_size in self.manifest.outputs_of(str(other.relative_to(self.root)), other_fingerprint, self.preset_key):
+                existing = self.output_dir / output_key
+                try:
+                    if existing == out or existing.stat().st_size != output_size:
+                        continue
+                    try:
+                        os.link(existing, partial)
+                    except OSError:
+                        shutil.copyfile(existing, partial)
+                    os.replace(partial, out)
+                except OSError:
+                    partial.unlink(missing_ok=True)
+                    continue
+                q.info(f"Reused the output of identical file {other.relative_to(self.root)}")
+                return True
+        return False
+
+    def _transcode_segments(self, q, file: Path, out: Path, segments):
+        """
+        Encodes each segment of the file as a separate job, then joins them into the output without re-encoding.
+        The segment jobs are not limited by device, as this job already holds the file's device slot.
+        """
+        parts = out.parent / f'.{out.name}.parts'
+        shutil.rmtree(parts, ignore_errors=True)
+        parts.mkdir()
+        try:
+            results = [None] * len(segments)
+            for i, (start, seconds) in enumerate(segments):
+                part = parts / f'{i:03}{self.extension}'
+                args = ['ffmpeg'] + FFMPEG_TRANSCODE_BASE_ARGS[:-2] + ['-ss', f'{start:.6f}', '-t', f'{seconds:.6f}', '-i', input_arg(file)] + \
+                    self.preset_args + ['-threads', '1', str(part)]
+                def encode(q, i=i, args=args, seconds=seconds):
+                    results[i] = run_ffmpeg_tool(args, "ffmpeg", max(60, seconds * SPLIT_TIMEOUT_FACTOR))[1]
+                q.submit(f'segment-{i}', encode)
+            q.wait()
+            errors = sum(results, [])
+            if errors:
+                return errors
+            concat = parts / 'concat.txt'
+            concat.write_text(''.join(concat_list_entry(parts / f'{i:03}{self.extension}') + '\n' for i in range(len(segments))))
+            format = self.preset_args[self.preset_args.index('-f') + 1]
+            args = ['ffmpeg'] + FFMPEG_TRANSCODE_BASE_ARGS[:-2] + ['-f', 'concat', '-safe', '0', '-i', input_arg(concat), '-map', '0', '-c', 'copy', '-f', format, str(out)]
+            errors = run_ffmpeg_tool(args, "ffmpeg", max(60, sum(x[1] for x in segments)))[1]
+            q.add_metrics(bytes=file.stat().st_size)
+            return errors
+        finally:
+            shutil.rmtree(parts, ignore_errors=True)
+
+    def _prune(self, q):
+        for output_key, source_key in self.manifest.entries():
+            if (self.root / source_key).exists():
+                continue
+            out = self.output_dir / output_key
+            q.info(f"Pruning orphaned output {output_key}")
+            try:
+                out.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                q.error(f"Failed to prune {output_key} ({e})")
+                continue
+            self.manifest.remove(output_key)
+            # Clean up any directories that are now empty, but never the output directory itself
+            parent = out.parent
+            while parent != self.output_dir:
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+                parent = parent.parent
@@ -1,7 +1,30 @@
+import math
+import time
+
+from dataclasses import dataclass
+from enum import Enum
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from .cache import FileFingerprint, SampleTracker, VERIFY_LEVEL_FULL
 from .ffmpeg import ffmpeg_supports
+from .ffprobe import FFPROBE_ARGS, duration, ffprobe, input_arg, run_ffmpeg_tool
 from .jobqueue import JobQueue
-from .forward_progress import subprocess_forward_progress
+from .forward_progress import InputMode, ProcessStats, subprocess_forward_progress
 from .operation import Operation
+from .schedule import ScheduleOrder, schedule
+
+class VerifyDepth(Enum):
+    # Read the container and stream headers with ffprobe
+    Quick = "quick"
+    # Demux every packet without decoding it
+    Packets = "packets"
+    # Decode every stream
+    Full = "full"
+
+    def level(self):
+        """Thoroughness of this depth, as recorded in the `VerificationCache`."""
+        return list(VerifyDepth).index(self)
 
 FFMPEG_VERIFY_ARGS = [
         "-xerror",
@@ -10,36 +33,451 @@ FFMPEG_VERIFY_ARGS = [
         "-f", "null",
         "-"
     ]
+FFMPEG_PACKET_VERIFY_ARGS = [
+        "-xerror",
+        "-v", "error",
+        "-i", "-",
+        "-map", "0",
+        "-c", "copy",
+        "-f", "null",
+        "-"
+    ]
+
+def ffmpeg_validate(input, timeout=10, executable="ffmpeg", progress_callback=None, input_mode=InputMode.Pipe, stats=None, hasher=None, depth=VerifyDepth.Full):
+    if depth == VerifyDepth.Quick:
+        return ffprobe(input)[1]
+    args = FFMPEG_PACKET_VERIFY_ARGS if depth == VerifyDepth.Packets else FFMPEG_VERIFY_ARGS
+    return subprocess_forward_progress(input, args, executable, timeout=timeout, progress_callback=progress_callback, input_mode=input_mode, stats=stats, hasher=hasher)
+
+"""
+Longest segment decoded by sampled verification, in seconds.
+"""
+SAMPLE_SEGMENT_SECONDS = 10
+
+"""
+Decoding a segment reads the file by path rather than through the forward-progress watchdog, so a hung process is
+caught by this timeout instead.
+"""
+SAMPLE_SEGMENT_TIMEOUT = 120
 
-def ffmpeg_validate(input, timeout=10, executable="ffmpeg", progress_callback=None):
-    return subprocess_forward_progress(input, FFMPEG_VERIFY_ARGS, executable, timeout=timeout, progress_callback=progress_callback)
+"""
+Settings for sampled verification of files of at least `min_size` bytes: each run decodes `segments` evenly spaced
+segments of the file plus its head and tail, stopping once the run has spent `time_budget` seconds or
+`byte_budget` bytes (estimated from the duration decoded) on sampling.
+"""
+@dataclass
+class SamplingPolicy:
+    tracker: SampleTracker
+    segments: int
+    min_size: int
+    time_budget: Optional[float] = None
+    byte_budget: Optional[int] = None
+
+"""
+The segments to decode on one sampled pass over a file. The file is divided into `segments * stride` equal slots,
+each no longer than `SAMPLE_SEGMENT_SECONDS`, and each pass decodes every `stride`th slot starting one slot further
+along than the last, so every slot has been decoded after `stride` passes.
+"""
+@dataclass
+class SamplePlan:
+    layout: str
+    stride: int
+    # (start, seconds) of each segment
+    segments: List[Tuple[float, float]]
+
+    def of(length: float, segments: int, passes: int):
+        stride = max(1, math.ceil(length / (SAMPLE_SEGMENT_SECONDS * segments)))
+        slot = length / (segments * stride)
+        offset = passes % stride
+        edge = min(SAMPLE_SEGMENT_SECONDS, length)
+        planned = {(0, edge), (length - edge, edge)}
+        for i in range(segments):
+            start = (offset + i * stride) * slot
+            # Slots within the head or tail are already covered
+            if start + slot > edge and start < length - edge:
+                planned.add((start, slot))
+        return SamplePlan(layout=f'{segments}x{stride}', stride=stride, segments=sorted(planned))
+
+"""
+Settings for checking small files in batches: files smaller than `max_size` bytes are checked `files` at a time by a
+single ffmpeg process, saving the cost of starting a process for each.
+"""
+@dataclass
+class BatchPolicy:
+    files: int
+    max_size: int
+
+"""
+Batches read their files by path rather than through the forward-progress watchdog, so a hung process is caught by
+a timeout of this many seconds for each file in the batch instead.
+"""
+BATCH_FILE_TIMEOUT = 30
+
+def ffmpeg_validate_batch(inputs, depth=VerifyDepth.Full, executable="ffmpeg"):
+    """Checks several files with one process, mapping each to its own null output. Errors aren't attributed to a file."""
+    args = ['ffmpeg', '-xerror', '-v', 'error']
+    for input in inputs:
+        args += ['-i', input_arg(input)]
+    for i in range(len(inputs)):
+        if depth == VerifyDepth.Packets:
+            args += ['-map', str(i), '-c', 'copy', '-f', 'null', '-']
+        else:
+            # Every audio and video stream is decoded, like the default stream selection of a single input
+            args += ['-map', f'{i}:v?', '-map', f'{i}:a?', '-f', 'null', '-']
+    return run_ffmpeg_tool(args, executable, BATCH_FILE_TIMEOUT * len(inputs))[1]
+
+def ffmpeg_validate_segment(input, start, seconds, executable="ffmpeg"):
+    args = ['ffmpeg', '-xerror', '-v', 'error', '-ss', f'{start:.3f}', '-t', f'{seconds:.3f}', '-i', input_arg(input), '-f', 'null', '-']
+    return run_ffmpeg_tool(args, executable, SAMPLE_SEGMENT_TIMEOUT)[1]
 
 class FFMPEGValidateOperation(Operation):
+    """
+    If a `VerificationCache` is provided, files that were verified to at least `depth` within `max_age` seconds
+    (forever if None) and have not changed since are skipped, unless `force` is set.
+
+    Files are checked to `depth` as they are found, unless they need to be ordered, batched or sampled, in which case
+    they are checked once the whole tree has been scanned. With `headers_first`, every file also gets a quick header
+    check while the tree is scanned, and deeper checks are only run on files that pass, so that broken files across
+    the library are reported early.
+
+    If a `ChecksumManifest` is provided, each file is also hashed as it is piped to ffmpeg, and checked against the
+    digest recorded on a previous run.
+
+    If a `SamplingPolicy` is provided, large files are only decoded in segments rather than in full, rotating
+    through the file over successive runs. A file counts as fully verified once every segment has been decoded.
+
+    Files found good by the run recorded in `journal` (if given) are skipped, and bad files are checked again.
+
+    The deeper checks are run in the given `order`, and no more are started once the run has taken `time_budget`
+    seconds, so that a series of time-limited runs works through the whole library.
+
+    If a `ContentIndex` is provided as `duplicates`, files are also skipped if a byte-identical file (as last found
+    by `dedupe`) was verified in the same way.
+
+    If a `BatchPolicy` is provided, small files are checked in batches. A batch that fails is split in half until
+    the bad files are found, and each of those is checked again on its own so that its errors are reported for it.
+    """
+    def __init__(self, cache=None, max_age=None, force=False, input_mode=InputMode.Pipe, checksums=None, depth=VerifyDepth.Full, sampling: SamplingPolicy = None, journal=None,
+            order=ScheduleOrder.Scan, time_budget=None, batching: BatchPolicy = None, duplicates=None, headers_first=False) -> None:
+        self.cache = cache
+        self.max_age = max_age
+        self.force = force
+        self.input_mode = input_mode
+        self.checksums = checksums
+        self.depth = depth
+        self.sampling = sampling
+        self.journal = journal
+        self.order = order
+        self.time_budget = time_budget
+        self.batching = batching
+        self.duplicates = duplicates
+        self.headers_first = headers_first
+        self.out_of_time = False
+        self.sampled_bytes = 0
+        self.scheduled = []
+        # When each scheduled file was last verified, read before its header check records a new time
+        self.last_verified = {}
+        self.lock = Lock()
+
     def initialize(self, q, dir):
-        q.info(f"Verifying internal consistency of media files: ffmpeg {' '.join(FFMPEG_VERIFY_ARGS)} < [file] > /dev/null")
+        self.root = dir
+        self.started = time.monotonic()
+        if self.depth == VerifyDepth.Quick:
+            q.info(f"Checking headers of media files: ffprobe {' '.join(FFPROBE_ARGS)} [file]")
+        else:
+            args = FFMPEG_PACKET_VERIFY_ARGS if self.depth == VerifyDepth.Packets else FFMPEG_VERIFY_ARGS
+            q.info(f"Verifying internal consistency of media files: ffmpeg {' '.join(args)} < [file] > /dev/null")
+        if self.cache and not self.force:
+            age = f"in the last {self.max_age / 86400:g} day(s)" if self.max_age is not None else "previously"
+            q.info(f"Skipping unchanged files verified {age} (cache: {self.cache.db.file})")
+        if self.checksums:
+            if self.depth == VerifyDepth.Quick:
+                q.warning("Checksums are computed while reading the whole file, so they are not checked in quick mode")
+                self.checksums = None
+            else:
+                q.info(f"Checking {self.checksums.algorithm.value} checksums of verified files")
+                if self.input_mode != InputMode.Pipe:
+                    q.warning(f"Checksums are computed from piped input, so input mode {self.input_mode.value} is ignored")
+                    self.input_mode = InputMode.Pipe
+        if self.sampling:
+            if self.depth != VerifyDepth.Full:
+                q.warning("Sampling replaces full decodes, so it is not used at this depth")
+                self.sampling = None
+            else:
+                q.info(f"Decoding {self.sampling.segments} segment(s) plus the head and tail of files of {self.sampling.min_size // 1024 // 1024}MB or more")
+                if self.checksums:
+                    q.info("Sampled files are not checksummed, as they are not read in full")
+        if self.batching:
+            if self.depth == VerifyDepth.Quick:
+                q.warning("Only files read by ffmpeg are batched, so batches are not used at this depth")
+                self.batching = None
+            elif self.checksums:
+                q.warning("Checksums are computed from piped input, so files are not batched")
+                self.batching = None
+            else:
+                q.info(f"Checking files under {self.batching.max_size // 1024 // 1024}MB in batches of {self.batching.files}")
+        if self.time_budget is not None:
+            q.info(f"No new checks will be started after {self.time_budget:g}s")
+        self.headers_first = self.headers_first and self.depth != VerifyDepth.Quick
+        # Checks that need the whole list of files are deferred until scanning completes
+        self.deferred = self.depth != VerifyDepth.Quick and (self.headers_first or self.order != ScheduleOrder.Scan or self.batching or self.sampling)
+        if self.headers_first:
+            q.info("Headers are checked as files are found, and files are read once scanning completes")
+        elif self.deferred:
+            q.info("Files are read once scanning completes")
 
-    def operate(self, q: JobQueue, dir, files):
-        stats = { 'good': 0, 'bad': 0, 'ignored': 0 }
+    def operate_scan(self, q, dir, results):
+        if results.media_list:
+            self.operate(q, dir, results.media_list, devices={file: st.st_dev for file, st in results.media_stats.items()})
+
+    def operate(self, q: JobQueue, dir, files, devices=None):
+        """`devices` optionally gives the device of each file, to limit concurrent reads from each device."""
+        devices = devices or {}
+        stats = { 'good': 0, 'bad': 0, 'ignored': 0, 'unchanged': 0, 'duplicate': 0, 'scheduled': 0, 'resumed': 0 }
+        lock = Lock()
         for file in files:
-            q.submit(file.name, lambda q: self._job(q, stats, file))
+            device = devices.get(file)
+            q.submit(file.name, lambda q, file=file, device=device: self._job(q, stats, lock, file, device), device=device)
+        q.wait()
+        self._summary(q, stats)
+
+    def finalize(self, q, dir):
+        with self.lock:
+            scheduled, self.scheduled = self.scheduled, []
+        if not scheduled:
+            return
+        q.info(f"Running {self.depth.value} checks on {len(scheduled)} file(s) in {self.order.value} order")
+        q.flush_logs()
+        stats = { 'good': 0, 'bad': 0, 'ignored': 0, 'unchanged': 0, 'scheduled': 0, 'sampled': 0, 'deferred': 0, 'out of time': 0 }
+        lock = Lock()
+        with self.lock:
+            last_verified, self.last_verified = self.last_verified, {}
+        full = schedule([x for x in scheduled if not self._is_sampled(x[1])], self.order, self.root,
+            last_verified=lambda file: last_verified.get(file, 0))
+        # Sample the least recently sampled files first, so that files skipped by the budget get their turn next run
+        sampled = sorted([x for x in scheduled if self._is_sampled(x[1])], key=lambda x: self.sampling.tracker.last_sampled(x[0]))
+        self.sampling_started = time.monotonic()
+        batch = []
+        batches = 0
+        for file, fingerprint, device in full:
+            if self._is_batched(fingerprint):
+                batch.append((file, fingerprint, device))
+                if len(batch) == self.batching.files:
+                    batches += 1
+                    self._submit_batch(q, stats, lock, batch, batches)
+                    batch = []
+                continue
+            q.submit(str(file.relative_to(self.root)), lambda q, file=file, fingerprint=fingerprint:
+                self._within_budget(stats, lock) and self._validate(q, stats, lock, file, fingerprint, self.depth), device=device)
+        if batch:
+            self._submit_batch(q, stats, lock, batch, batches + 1)
+        for file, fingerprint, device in sampled:
+            q.submit(str(file.relative_to(self.root)), lambda q, file=file, fingerprint=fingerprint:
+                self._within_budget(stats, lock) and self._validate_sampled(q, stats, lock, file, fingerprint), device=device)
         q.wait()
+        self._summary(q, stats)
+
+    def is_complete(self):
+        return not self.out_of_time
+
+    def _within_budget(self, stats, lock):
+        """Whether another check can be started, counting the file as left for the next run if not."""
+        if self.time_budget is None or time.monotonic() - self.started < self.time_budget:
+            return True
+        with lock:
+            self.out_of_time = True
+            stats['out of time'] += 1
+        return False
+
+    def _summary(self, q, stats):
+        summary = [f"{stats['good']} good file(s)"]
+        if stats['bad'] or stats['ignored']:
+            summary.append(f"{stats['bad']} bad file(s)")
         if stats['ignored']:
-            q.info(f"{stats['good']} good file(s), {stats['bad']} bad file(s), {stats['ignored']} ignored file(s)")
-        elif stats['bad']:
-            q.info(f"{stats['good']} good file(s), {stats['bad']} bad file(s)")
+            summary.append(f"{stats['ignored']} ignored file(s)")
+        if stats['unchanged']:
+            summary.append(f"{stats['unchanged']} unchanged file(s) skipped")
+        if stats.get('duplicate'):
+            summary.append(f"{stats['duplicate']} file(s) identical to a verified file skipped")
+        if stats['scheduled']:
+            summary.append(f"{stats['scheduled']} file(s) scheduled for a {self.depth.value} check")
+        if stats.get('sampled'):
+            summary.append(f"{stats['sampled']} sampled file(s) without errors")
+        if stats.get('deferred'):
+            summary.append(f"{stats['deferred']} file(s) left for the next run by the sampling budget")
+        if stats.get('out of time'):
+            summary.append(f"{stats['out of time']} file(s) left for the next run by the time budget")
+        if stats.get('resumed'):
+            summary.append(f"{stats['resumed']} file(s) already done by the interrupted run skipped")
+        q.info(', '.join(summary))
+
+    def _job(self, q, stats, lock, file, device=None):
+        # Bad files are checked again, so the resumed run still reports them
+        if self.journal and self.journal.outcome(file) == 'good':
+            with lock:
+                stats['resumed'] += 1
+            return
+        if not ffmpeg_supports(file):
+            with lock:
+                stats['ignored'] += 1
+            return
+        try:
+            fingerprint = FileFingerprint.of(file)
+        except OSError as e:
+            # ie: removed since it was scanned
+            self._record(q, stats, lock, file, None, self.depth, [f"Failed to read file ({e})"])
+            return
+        if self._is_unchanged(file, fingerprint):
+            with lock:
+                stats['unchanged'] += 1
+            return
+        if self._has_verified_duplicate(file, fingerprint):
+            with lock:
+                stats['duplicate'] += 1
+            return
+        if not self.deferred:
+            if self._within_budget(stats, lock):
+                self._validate(q, stats, lock, file, fingerprint, self.depth)
+            return
+        if self.order == ScheduleOrder.LeastRecentlyVerified and self.cache:
+            verified_at = self.cache.verified_at(file)
+            with self.lock:
+                self.last_verified[file] = verified_at
+        # A batch's decode already checks the headers, and a separate check would double the processes it saves
+        check_headers = self.headers_first and not self._is_batched(fingerprint)
+        if not check_headers or self._validate(q, stats, lock, file, fingerprint, VerifyDepth.Quick, final=False):
+            if not check_headers:
+                with lock:
+                    stats['scheduled'] += 1
+            with self.lock:
+                self.scheduled.append((file, fingerprint, device))
+
+    def _submit_batch(self, q, stats, lock, batch, number):
+        devices = set(x[2] for x in batch)
+        q.submit(f"batch {number}", lambda q: self._within_budget(stats, lock) and self._validate_batch(q, stats, lock, batch),
+            device=devices.pop() if len(devices) == 1 else None)
+
+    def _validate_batch(self, q, stats, lock, batch):
+        if len(batch) == 1:
+            # Checked as its own job, so that its errors are reported under its name
+            file, fingerprint, _ = batch[0]
+            q.submit(str(file.relative_to(self.root)), lambda q: self._validate(q, stats, lock, file, fingerprint, self.depth))
+            q.wait()
+            return
+        errors = ffmpeg_validate_batch([x[0] for x in batch], self.depth)
+        if errors:
+            half = len(batch) // 2
+            self._validate_batch(q, stats, lock, batch[:half])
+            self._validate_batch(q, stats, lock, batch[half:])
+            return
+        q.add_metrics(bytes=sum(x[1].size for x in batch))
+        for file, fingerprint, _ in batch:
+            self._record(q, stats, lock, file, fingerprint, self.depth, [])
+
+    def _validate(self, q, stats, lock, file, fingerprint, depth, final=True):
+        """Checks a file to the given depth, returning True if it passed but hasn't been counted yet."""
+        process_stats = ProcessStats()
+        hasher = self.checksums.algorithm.new() if self.checksums and depth != VerifyDepth.Quick else None
+        errors = ffmpeg_validate(file, input_mode=self.input_mode, stats=process_stats, hasher=hasher, depth=depth)
+        if depth != VerifyDepth.Quick:
+            q.add_metrics(bytes=process_stats.bytes_read, cpu_seconds=process_stats.cpu_seconds)
+        if not errors and hasher and not self.checksums.check(file, fingerprint, hasher.hexdigest()):
+            errors = ["Checksum does not match the previous run, although the file's size and modification time are unchanged (possible bitrot)"]
+        return self._record(q, stats, lock, file, fingerprint, depth, errors, final)
+
+    def _record(self, q, stats, lock, file, fingerprint, depth, errors, final=True):
+        if errors:
+            result = 'bad'
+            q.error(errors)
+            if self.cache:
+                self.cache.record_bad(file)
         else:
-            q.info(f"{stats['good']} good file(s)")
+            if self.cache:
+                self.cache.record_good(file, fingerprint, depth.level())
+            result = 'good' if final else 'scheduled'
+        if self.journal and result != 'scheduled':
+            self.journal.record(file, result)
+        with lock:
+            stats[result] += 1
+        return not errors and not final
+
+    def _is_batched(self, fingerprint):
+        return self.batching is not None and fingerprint.size < self.batching.max_size
 
-    def _job(self, q, stats, file):
-        if ffmpeg_supports(file):
-            errors = ffmpeg_validate(file)
-            if errors:
+    def _is_sampled(self, fingerprint):
+        return self.sampling is not None and fingerprint.size >= self.sampling.min_size
+
+    def _over_budget(self):
+        if self.sampling.time_budget is not None and time.monotonic() - self.sampling_started >= self.sampling.time_budget:
+            return True
+        with self.lock:
+            return self.sampling.byte_budget is not None and self.sampled_bytes >= self.sampling.byte_budget
+
+    def _validate_sampled(self, q, stats, lock, file, fingerprint):
+        if self._over_budget():
+            with lock:
+                stats['deferred'] += 1
+            return
+        info, errors = ffprobe(file)
+        length = duration(info) if info else 0
+        if not errors and not length:
+            # Without a duration there's nothing to sample from
+            q.warning("Duration unknown, decoding in full")
+            self._validate(q, stats, lock, file, fingerprint, self.depth)
+            return
+        if not errors:
+            tracker = self.sampling.tracker
+            layout = SamplePlan.of(length, self.sampling.segments, 0).layout
+            passes = tracker.passes(file, fingerprint, layout)
+            plan = SamplePlan.of(length, self.sampling.segments, passes)
+            for start, seconds in plan.segments:
+                errors = ffmpeg_validate_segment(file, start, seconds)
+                if errors:
+                    errors = [f"Segment at {start:.1f}s failed to decode"] + errors
+                    break
+            bytes = int(fingerprint.size * min(1, sum(x[1] for x in plan.segments) / length))
+            q.add_metrics(bytes=bytes)
+            with self.lock:
+                self.sampled_bytes += bytes
+        if errors:
+            q.error(errors)
+            if self.cache:
+                self.cache.record_bad(file)
+            if self.journal:
+                self.journal.record(file, 'bad')
+            with lock:
                 stats['bad'] += 1
-                q.error(errors)
-            else:
-                stats['good'] += 1
+            return
+        # Failed passes aren't recorded, so the same segments are tried again next time
+        passes += 1
+        tracker.record_pass(file, fingerprint, layout, passes)
+        if passes % plan.stride == 0:
+            q.info(f"Every segment has now been decoded, over {plan.stride} run(s)")
+            if self.cache:
+                self.cache.record_good(file, fingerprint, VERIFY_LEVEL_FULL)
         else:
-            stats['ignored'] += 1
+            q.info(f"Decoded {len(plan.segments)} segment(s), {(passes % plan.stride) / plan.stride:.0%} of the file has been decoded over the last {passes % plan.stride} run(s)")
+        if self.journal:
+            self.journal.record(file, 'good')
+        with lock:
+            stats['sampled'] += 1
+
+    def _is_unchanged(self, file, fingerprint):
+        if not self.cache or self.force:
+            return False
+        return self._is_recent(self.cache.last_verified(file, fingerprint, self.depth.level()))
+
+    def _has_verified_duplicate(self, file, fingerprint):
+        if not self.duplicates or not self.cache or self.force:
+            return False
+        # The duplicate must have been verified in the state it was in when found to be identical
+        return any(self._is_recent(self.cache.last_verified(other, other_fingerprint, self.depth.level()))
+            for other, other_fingerprint in self.duplicates.duplicates(file, fingerprint))
+
+    def _is_recent(self, verified_at):
+        if verified_at is None:
+            return False
+        return self.max_age is None or time.time() - verified_at <= self.max_age
 
 if __name__ == '__main__':
     import sys
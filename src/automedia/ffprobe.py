@@ -0,0 +1,99 @@
+import json
+import subprocess
+
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+FFPROBE_ARGS = [
+        "-v", "error",
+        "-show_format",
+        "-show_streams",
+        "-of", "json",
+    ]
+
+def input_arg(file: Path):
+    # The file: prefix stops ffmpeg interpreting anything else in the name as a protocol
+    return f'file:{file}'
+
+"""
+Runs an ffmpeg tool that reads a file by path, returning its output and a list of errors. Any output to the error
+stream counts as an error, as the tools are run with `-v error`.
+"""
+def run_ffmpeg_tool(args: List[str], executable: str, timeout):
+    try:
+        process = subprocess.run(args, executable=executable, stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None, [f"Process timed out after {timeout}s"]
+    except OSError as e:
+        return None, [f"Failed to run {executable} ({e})"]
+    errors = []
+    if process.returncode != 0:
+        errors.append(f"Process failed with exit code {process.returncode}")
+    if process.stderr:
+        errors.append("Process wrote to error stream: " + str(process.stderr, encoding='utf8', errors='replace'))
+    return process.stdout, errors
+
+"""
+Reads a file's container and stream headers with ffprobe, returning the parsed information (None on failure) and a
+list of errors. Only the headers are read, so this is fast even for very large files.
+"""
+def ffprobe(file: Path, timeout=60, executable="ffprobe"):
+    stdout, errors = run_ffmpeg_tool(['ffprobe'] + FFPROBE_ARGS + ['-i', input_arg(file)], executable, timeout)
+    if errors:
+        return None, errors
+    try:
+        info = json.loads(stdout)
+    except ValueError:
+        return None, ["Process wrote invalid JSON"]
+    if not info.get('streams'):
+        return info, ["No streams found"]
+    return info, []
+
+def duration(info) -> float:
+    """Duration in seconds from ffprobe's output, or 0 if it isn't known."""
+    try:
+        return float(info['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+def _number(value, type=int):
+    try:
+        return type(value)
+    except (TypeError, ValueError):
+        return None
+
+"""
+Summary of a file's container and its main audio and video streams, from ffprobe's output. Cover art (attached
+pictures) doesn't count as a video stream. Anything ffprobe didn't report is None.
+"""
+@dataclass
+class MediaInfo:
+    container: Optional[str] = None
+    duration: Optional[float] = None
+    # Bits per second of the whole file
+    bitrate: Optional[int] = None
+    audio_codec: Optional[str] = None
+    audio_bitrate: Optional[int] = None
+    channels: Optional[int] = None
+    sample_rate: Optional[int] = None
+    video_codec: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+
+    def of(info) -> 'MediaInfo':
+        format = info.get('format', {})
+        streams = info.get('streams', [])
+        audio = next((x for x in streams if x.get('codec_type') == 'audio'), {})
+        video = next((x for x in streams if x.get('codec_type') == 'video' and not x.get('disposition', {}).get('attached_pic')), {})
+        return MediaInfo(
+            container=format.get('format_name'),
+            duration=_number(format.get('duration'), float),
+            bitrate=_number(format.get('bit_rate')),
+            audio_codec=audio.get('codec_name'),
+            audio_bitrate=_number(audio.get('bit_rate')),
+            channels=_number(audio.get('channels')),
+            sample_rate=_number(audio.get('sample_rate')),
+            video_codec=video.get('codec_name'),
+            width=_number(video.get('width')),
+            height=_number(video.get('height')))
@@ -1,131 +1,364 @@
+import atexit
 import os
+import selectors
 import time
 import subprocess
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from subprocess import Popen, TimeoutExpired
-from threading import Thread
+from subprocess import Popen
+from threading import Event, Lock, Thread
 from typing import List
 
 BUFFER_SIZE = 128 * 1024
 
-class ClosedException(BaseException):
-    pass
+"""
+Only the tail of a process' error stream is kept, so a chatty process can't use unbounded memory.
+"""
+STDERR_LIMIT = 64 * 1024
 
 """
-We don't need the full complexity of the python streams, so let's work directly off OS file descriptors.
+How often the supervisor wakes up to check for timeouts and direct-mode progress, and how often the progress
+callback is called.
 """
-class BasicStream:
-    def __init__(self, fd) -> None:
-        self.fd = fd
-    def read(self, n):
-        if self.fd == -1:
-            raise ClosedException("Read on closed stream")
-        return os.read(self.fd, n)
-    def write(self, data):
-        if self.fd == -1:
-            raise ClosedException("Write on closed stream")
-        return os.write(self.fd, data)
-    def close(self):
-        if self.fd != -1:
-            try:
-                os.close(self.fd)
-            except OSError:
-                pass
-        self.fd = -1
+TICK_INTERVAL = 0.25
+
+class InputMode(Enum):
+    # Copy the input through a pipe into the process' stdin
+    Pipe = "pipe"
+    # Hand the process the input file itself as stdin, and watch its read offset for progress
+    Direct = "direct"
 
 """
-Create a subprocess and ensure that it's always making forward progress by consuming stdin.
+Resource usage of a finished process, filled in by `subprocess_forward_progress` if requested.
+"""
+@dataclass
+class ProcessStats:
+    bytes_read: int = 0
+    cpu_seconds: float = 0
+
 """
-def subprocess_forward_progress(input: Path, args: List[str], executable: str, timeout=10, progress_callback=None) -> List[str]:
-    process = Popen(args=args, executable=executable, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-    stdin = BasicStream(process.stdin.fileno())
-    stderr = BasicStream(process.stderr.fileno())
-    errors = []
-
-    stderr_buffer = [b'']
-    def stderr_reader(stderr, stderr_buffer):
+Bounded buffer that keeps the last `limit` bytes written to it.
+"""
+class RingBuffer:
+    def __init__(self, limit=STDERR_LIMIT) -> None:
+        self.limit = limit
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    def append(self, data):
+        self.buffer += data
+        excess = len(self.buffer) - self.limit
+        if excess > 0:
+            del self.buffer[:excess]
+            self.dropped += excess
+
+    def __len__(self):
+        return len(self.buffer) + self.dropped
+
+    def getvalue(self) -> bytes:
+        if self.dropped:
+            return f"[{self.dropped} bytes truncated]...".encode('utf8') + bytes(self.buffer)
+        return bytes(self.buffer)
+
+"""
+State for a single process being watched by the `ProcessSupervisor`. Everything but `kill` is only touched from
+the supervisor thread once the process is registered.
+"""
+class SupervisedProcess:
+    def __init__(self, input: Path, args: List[str], executable: str, timeout, input_mode, hasher=None) -> None:
+        if hasher and input_mode != InputMode.Pipe:
+            raise ValueError("Input can only be hashed when it is piped to the process")
+        self.timeout = timeout
+        self.input_mode = input_mode
+        self.errors = []
+        self.stderr_buffer = RingBuffer()
+        self.done = Event()
+        self.timed_out = False
+        self.progress = 0
+        self.offset = 0
+        self.pending = b''
+        self.hasher = hasher
+        # Splicing never brings the data into our address space, so it can't be used while hashing
+        self.splice = hasattr(os, 'splice') and not hasher
+        self.pidfd = None
+        self.cpu_seconds = 0
+        self.input = open(input, 'rb', buffering=0)
         try:
-            while True:
-                r = stderr.read(128)
-                stderr_buffer[0] += r
-        except ClosedException:
-            pass
+            self.size = os.fstat(self.input.fileno()).st_size
+            if input_mode == InputMode.Direct:
+                stdin = self.input.fileno()
+            else:
+                stdin = subprocess.PIPE
+            self.process = Popen(args=args, executable=executable, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
         except:
-            stderr.close()
-    t1 = Thread(target=stderr_reader, args=(stderr, stderr_buffer,))
-    t1.start()
+            self.input.close()
+            raise
+        self.stdin = self.process.stdin
+        self.stderr = self.process.stderr
+        if self.stdin:
+            os.set_blocking(self.stdin.fileno(), False)
+        os.set_blocking(self.stderr.fileno(), False)
+        self.last_progress = time.monotonic()
 
-    last_write = [time.monotonic()]
-    progress = [0]
-    def stdin_writer(stdin, progress, last_write):
+    def write_stdin(self):
         try:
-            with open(input, 'rb') as f:
-                fl = f.seek(0, 2)
-                f.tell()
-                f.seek(0, 0)
-                w = 0
-                while True:
-                    bytes = f.read(BUFFER_SIZE)
-                    if not bytes:
-                        break
-                    w += len(bytes)
-                    stdin.write(bytes)
-                    last_write[0] = time.monotonic()
-                    progress[0] = w / fl
+            if self.splice:
+                try:
+                    n = os.splice(self.input.fileno(), self.stdin.fileno(), BUFFER_SIZE, offset_src=self.offset, flags=os.SPLICE_F_NONBLOCK)
+                    if n == 0:
+                        return False
+                except OSError as e:
+                    if isinstance(e, (BlockingIOError, BrokenPipeError)):
+                        raise
+                    # Not every filesystem supports splicing, so fall back to copying for this file
+                    self.splice = False
+                    return True
+            else:
+                if not self.pending:
+                    self.pending = memoryview(os.pread(self.input.fileno(), BUFFER_SIZE, self.offset + len(self.pending)))
+                    if not self.pending:
+                        return False
+                    if self.hasher:
+                        self.hasher.update(self.pending)
+                n = os.write(self.stdin.fileno(), self.pending)
+                self.pending = self.pending[n:]
+        except BlockingIOError:
+            return True
         except BrokenPipeError:
-            errors.append("Process failed to read the entire input")
-        except ClosedException:
-            pass
-        finally:
-            stdin.close()
-    t2 = Thread(target=stdin_writer, args=(stdin, progress, last_write,))
-    t2.start()
+            self.errors.append("Process failed to read the entire input")
+            return False
+        self.offset += n
+        self.last_progress = time.monotonic()
+        self.progress = self.offset / self.size if self.size else 1
+        return True
 
-    try:
+    def read_stderr(self):
+        """Reads everything currently available on stderr, returning False at end-of-stream."""
         while True:
+            try:
+                r = os.read(self.stderr.fileno(), BUFFER_SIZE)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            if not r:
+                return False
+            self.stderr_buffer.append(r)
+
+    def poll_offset(self):
+        if self.input_mode == InputMode.Direct:
+            offset = os.lseek(self.input.fileno(), 0, os.SEEK_CUR)
+            if offset != self.offset:
+                self.offset = offset
+                self.last_progress = time.monotonic()
+                self.progress = offset / self.size if self.size else 1
+
+    def check_timeout(self, now):
+        if not self.timed_out and now - self.last_progress > self.timeout:
+            self.timed_out = True
+            self.errors.append("Process timed out reading from input stream")
+            self.kill()
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def reap(self, block=True):
+        """Waits for the process with wait4 so that its CPU usage is known, returning False if it's still running."""
+        try:
+            pid, status, rusage = os.wait4(self.process.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped by Popen itself (ie: while being killed), so the usage is lost
+            self.process.wait()
+            return True
+        if pid == 0:
+            return False
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        self.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+        return True
+
+    def finish(self):
+        if self.process.returncode is None:
+            self.reap()
+        ret = self.process.returncode
+        self.poll_offset()
+        if not self.timed_out:
+            if self.input_mode == InputMode.Direct:
+                incomplete = self.offset < self.size
+            else:
+                incomplete = self.stdin is not None
+            if incomplete and not self.errors:
+                self.errors.append("Process failed to read the entire input")
+            if ret != 0:
+                self.errors.append(f"Process failed with exit code {ret}")
+        # Anything a process wrote before exiting is already in the pipe, but don't wait for end-of-stream as a
+        # grandchild may still be holding it open
+        self.read_stderr()
+        self.close()
+        if len(self.stderr_buffer) > 0:
+            self.errors.append("Process wrote to error stream: " + str(self.stderr_buffer.getvalue(), encoding='utf8', errors='replace'))
+        self.done.set()
+
+    def close_stdin(self):
+        if self.stdin:
+            try:
+                self.stdin.close()
+            except OSError:
+                pass
+            self.stdin = None
+
+    def close(self):
+        self.close_stdin()
+        self.stderr.close()
+        self.input.close()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+"""
+Watches every running process from a single thread: feeding stdin, collecting stderr, noticing exits (via pidfd
+where available) and enforcing forward-progress timeouts, instead of using threads and polling per process.
+"""
+class ProcessSupervisor:
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.lock = Lock()
+        self.posted = deque()
+        self.children = set()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, self._drain_posted)
+        self.thread = Thread(target=self._loop, name="process-supervisor", daemon=True)
+        self.thread.start()
+        atexit.register(self._kill_all)
+
+    def run(self, input: Path, args: List[str], executable: str, timeout=10, progress_callback=None, input_mode=InputMode.Pipe, stats: ProcessStats = None, hasher=None) -> List[str]:
+        try:
+            child = SupervisedProcess(input, args, executable, timeout, input_mode, hasher)
+        except OSError as e:
+            # ie: the file was removed since it was scanned, which only fails this file
+            return [f"Failed to start process ({e})"]
+        self._post(lambda: self._add(child))
+        try:
+            while not child.done.wait(TICK_INTERVAL if progress_callback else None):
+                try:
+                    progress_callback(child.progress)
+                except:
+                    pass
+        except KeyboardInterrupt as e:
+            child.errors.append("Interrupted by user")
+            self._post(child.kill)
+            raise e
+        finally:
             if progress_callback:
                 try:
-                    progress_callback(progress[0])
+                    progress_callback(child.progress)
                 except:
                     pass
-            if time.monotonic() - last_write[0] > timeout:
-                errors.append("Process timed out reading from input stream")
-                break
-            if t1:
-                t1.join(timeout=0)
-                if not t1.is_alive():
-                    t1 = None
-            if t2:
-                t2.join(timeout=0)
-                if not t2.is_alive():
-                    t2 = None
-            try:
-                ret = process.wait(timeout=0.01)
-                if ret != 0:
-                    errors.append(f"Process failed with exit code {ret}")
-                break
-            except TimeoutExpired:
-                pass
-            except KeyboardInterrupt as e:
-                errors.append("Interrupted by user")
-                raise e
-            except:
-                errors.append("Failed for unknown reason")
-                break
-    finally:
-        stdin.close()
-        stderr.close()
-        Thread(target=lambda: process.kill()).start()
-        if t1:
-            t1.join()
-        if t2:
-            t2.join()
-        if progress_callback:
-            try:
-                progress_callback(progress[1])
-            except:
+            if stats:
+                stats.bytes_read = child.offset
+                stats.cpu_seconds = child.cpu_seconds
+        return child.errors
+
+    def _post(self, fn):
+        with self.lock:
+            self.posted.append(fn)
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the supervisor is already going to wake up
+            pass
+
+    def _drain_posted(self, _):
+        try:
+            while os.read(self.wakeup_read, 4096):
                 pass
-        if len(stderr_buffer[0]) > 0:
-            errors.append("Process wrote to error stream: " + str(stderr_buffer[0], encoding='utf8', errors='replace'))
+        except BlockingIOError:
+            pass
+        with self.lock:
+            posted, self.posted = self.posted, deque()
+        for fn in posted:
+            fn()
 
-    return errors
+    def _add(self, child: SupervisedProcess):
+        self.children.add(child)
+        if child.stdin:
+            self.selector.register(child.stdin, selectors.EVENT_WRITE, lambda _: self._on_stdin(child))
+        self.selector.register(child.stderr, selectors.EVENT_READ, lambda _: self._on_stderr(child))
+        try:
+            child.pidfd = os.pidfd_open(child.process.pid)
+            self.selector.register(child.pidfd, selectors.EVENT_READ, lambda _: self._on_exit(child))
+        except (AttributeError, OSError):
+            # No pidfd support, so exits are picked up by polling on each tick
+            child.pidfd = None
+
+    def _on_stdin(self, child: SupervisedProcess):
+        if not child.write_stdin():
+            self.selector.unregister(child.stdin)
+            child.close_stdin()
+
+    def _on_stderr(self, child: SupervisedProcess):
+        if not child.read_stderr():
+            self.selector.unregister(child.stderr)
+            if child.pidfd is None:
+                self._poll_exit(child)
+
+    def _poll_exit(self, child: SupervisedProcess):
+        if child.reap(block=False):
+            self._on_exit(child)
+
+    def _on_exit(self, child: SupervisedProcess):
+        for f in [child.stdin, child.stderr, child.pidfd]:
+            if f is not None:
+                try:
+                    self.selector.unregister(f)
+                except (KeyError, ValueError):
+                    pass
+        self.children.discard(child)
+        child.finish()
+
+    def _loop(self):
+        while True:
+            for key, mask in self.selector.select(TICK_INTERVAL if self.children else None):
+                try:
+                    key.data(mask)
+                except Exception as e:
+                    # Never let one misbehaving process take down the supervisor for everyone else
+                    child = next((c for c in self.children if key.fileobj in (c.stdin, c.stderr, c.pidfd)), None)
+                    if child:
+                        child.errors.append(f"Failed for unknown reason ({e})")
+                        child.kill()
+            now = time.monotonic()
+            for child in list(self.children):
+                child.poll_offset()
+                child.check_timeout(now)
+                if child.pidfd is None:
+                    self._poll_exit(child)
+
+    def _kill_all(self):
+        for child in list(self.children):
+            child.kill()
+
+_supervisor = None
+_supervisor_lock = Lock()
+
+def supervisor() -> ProcessSupervisor:
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcessSupervisor()
+        return _supervisor
+
+"""
+Create a subprocess and ensure that it's always making forward progress by consuming stdin.
+
+If a `hashlib` object is given as `hasher` (pipe mode only), every byte sent to the process is also fed to it, so
+the file is checksummed in the same read pass. The digest only covers the whole file if no errors are returned.
+"""
+def subprocess_forward_progress(input: Path, args: List[str], executable: str, timeout=10, progress_callback=None, input_mode=InputMode.Pipe, stats: ProcessStats = None, hasher=None) -> List[str]:
+    return supervisor().run(input, args, executable, timeout=timeout, progress_callback=progress_callback, input_mode=input_mode, stats=stats, hasher=hasher)
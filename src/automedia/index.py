@@ -0,0 +1,131 @@
+import json
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List
+
+from .cache import CacheDatabase, FileFingerprint
+from .operation import Operation
+
+"""
+A directory modified this soon before it was indexed may have changed again within the same mtime tick, so its
+listing is not trusted on the next run.
+"""
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+@dataclass
+class IndexedDir:
+    mtime_ns: int
+    indexed_ns: int
+    # Whether the listing can be reused without re-reading the directory
+    reusable: bool
+    subdirs: List[str]
+    media: Dict[str, FileFingerprint]
+    unknown_extensions: List[str]
+
+    def is_current(self, mtime_ns):
+        return self.reusable and self.mtime_ns == mtime_ns and self.indexed_ns - self.mtime_ns > RACY_WINDOW_NS
+
+"""
+On-disk index of the scanned tree: each directory's mtime, along with its subdirectories and the fingerprint of each
+media file as of the last scan. Directories are keyed by path relative to the root. `config` identifies the scanner
+settings (extensions, ignored files, symlink mode), and listings made with different settings are not reused.
+"""
+class PathIndex:
+    def __init__(self, db: CacheDatabase, root: Path, config: str) -> None:
+        self.db = db
+        self.root = root
+        self.config = config
+        db.execute('''CREATE TABLE IF NOT EXISTS indexed_dirs (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            indexed_ns INTEGER NOT NULL,
+            config TEXT NOT NULL,
+            reusable INTEGER NOT NULL,
+            subdirs TEXT NOT NULL,
+            media TEXT NOT NULL,
+            unknown_extensions TEXT NOT NULL)''')
+
+    def _key(self, dir: Path):
+        key = str(dir.relative_to(self.root))
+        return '' if key == '.' else key
+
+    def is_empty(self):
+        return not self.db.execute('SELECT 1 FROM indexed_dirs LIMIT 1')
+
+    def lookup(self, dir: Path):
+        rows = self.db.execute('SELECT mtime_ns, indexed_ns, config, reusable, subdirs, media, unknown_extensions FROM indexed_dirs WHERE path = ?', (self._key(dir),))
+        if not rows:
+            return None
+        mtime_ns, indexed_ns, config, reusable, subdirs, media, unknown_extensions = rows[0]
+        return IndexedDir(
+            mtime_ns=mtime_ns,
+            indexed_ns=indexed_ns,
+            reusable=bool(reusable) and config == self.config,
+            subdirs=json.loads(subdirs),
+            media={name: FileFingerprint(*fingerprint) for name, fingerprint in json.loads(media).items()},
+            unknown_extensions=json.loads(unknown_extensions))
+
+    def store(self, dir: Path, mtime_ns: int, reusable: bool, results):
+        media = {file.name: [st.st_size, st.st_mtime_ns, st.st_ino] for file, st in results.media_stats.items()}
+        self.db.execute('INSERT OR REPLACE INTO indexed_dirs (path, mtime_ns, indexed_ns, config, reusable, subdirs, media, unknown_extensions) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self._key(dir), mtime_ns, time.time_ns(), self.config, int(reusable),
+                json.dumps([x.name for x in results.directory_list]), json.dumps(media), json.dumps(results.unknown_extensions)))
+
+    def remove_tree(self, dir: Path) -> List[Path]:
+        """Removes a directory and everything below it from the index, returning the media files it contained."""
+        key = self._key(dir)
+        prefix = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+        rows = self.db.execute("SELECT path, media FROM indexed_dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (key, prefix))
+        self.db.execute("DELETE FROM indexed_dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (key, prefix))
+        removed = []
+        for path, media in rows:
+            removed += [self.root / path / name for name in json.loads(media)]
+        removed.sort()
+        return removed
+
+"""
+Reports media files that were added, modified or removed since the index was last updated.
+"""
+class ChangesOperation(Operation):
+    def __init__(self, index: PathIndex) -> None:
+        self.index = index
+        self.stats = { 'added': 0, 'modified': 0, 'removed': 0 }
+        self.lock = Lock()
+
+    def initialize(self, q, dir):
+        # With nothing to compare against, just build the index rather than reporting every file as added
+        self.baseline = self.index.is_empty()
+        if self.baseline:
+            q.info("No index found, indexing all files")
+        else:
+            q.info("Reporting changes since the index was last updated")
+
+    def operate(self, q, dir, files):
+        pass
+
+    def operate_scan(self, q, dir, results):
+        previous = results.previous_media or {}
+        stats = { 'added': 0, 'modified': 0, 'removed': 0 }
+        for file in results.media_list:
+            if file not in previous:
+                stats['added'] += 1
+                if not self.baseline:
+                    q.info(f"Added: {file.name}")
+            elif previous[file] != FileFingerprint.of_stat(results.media_stats[file]):
+                stats['modified'] += 1
+                q.info(f"Modified: {file.name}")
+        for file in sorted(set(previous.keys()) - set(results.media_list)) + results.removed:
+            stats['removed'] += 1
+            q.info(f"Removed: {file.relative_to(dir)}")
+        with self.lock:
+            for k, v in stats.items():
+                self.stats[k] += v
+
+    def finalize(self, q, dir):
+        if self.baseline:
+            q.info(f"Indexed {self.stats['added']} file(s)")
+        else:
+            q.info(f"{self.stats['added']} added, {self.stats['modified']} modified, {self.stats['removed']} removed file(s)")
@@ -1,20 +1,228 @@
+import json
+import sys
+import time
+
+from collections import deque
 from dataclasses import dataclass
+from enum import Enum
+from threading import Condition, Lock, Thread
+
+from .metrics import JobMetrics, MetricsCollector
+
+"""
+A job's log lines are buffered so that they are printed together, but a job that logs more than this many lines has
+them printed in batches rather than holding them all in memory.
+"""
+LOG_BUFFER_LINES = 1000
+
+LOG_LEVEL_NAMES = { 'E': 'error', 'W': 'warning', 'I': 'info' }
+
+class LogFormat(Enum):
+    Text = "text"
+    # One JSON object per line, for machine consumption
+    Json = "json"
 
 @dataclass
 class JobResults:
     errors: int = 0
 
 """
-Single-threaded job queue. This should be turned into a parallel job queue at some point.
+Jobs waiting to start, in submission order. Jobs are queued per device, so that the jobs for a device at its limit
+can be passed over without looking at each of them in turn.
+"""
+class PendingJobs:
+    def __init__(self) -> None:
+        self.queues = {}
+        self.sequence = 0
+
+    def append(self, sub):
+        self.sequence += 1
+        self.queues.setdefault(sub.device, deque()).append((self.sequence, sub))
+
+    def take(self, available):
+        """Removes and returns the first job that isn't started and whose device is `available`, or None."""
+        best = None
+        for device, queue in list(self.queues.items()):
+            # Jobs are queued both globally and on their parent, so skip any that were already started elsewhere
+            while queue and queue[0][1].started:
+                queue.popleft()
+            if not queue:
+                del self.queues[device]
+            elif (device is None or available(device)) and (best is None or queue[0][0] < best[0][0]):
+                best = queue
+        return best.popleft()[1] if best else None
+
+    def clear(self):
+        self.queues.clear()
+
+def json_message(msg):
+    """A log message as a string for JSON logs, with the lines of a list of messages (ie: errors) joined."""
+    if isinstance(msg, (list, tuple)):
+        return '\n'.join(str(x) for x in msg)
+    return str(msg)
+
+"""
+Bounded pool of worker threads shared by every queue in a job tree.
+
+At most `jobs` jobs run at once. A job that calls `wait()` gives up its slot while it is blocked, and runs its
+own not-yet-started children inline when a slot is free, so nested waits can never deadlock the pool. With
+`jobs=1` no worker threads are started and every job runs inline from `wait()`.
+
+Jobs can be submitted with the device they read from, and `device_limit(device)` gives the most jobs that may run
+at once for that device (None for no limit). Jobs for a device at its limit are passed over for later ones. Jobs
+with a device must not wait on children with the same device, or they could wait forever.
+"""
+class JobPool:
+    def __init__(self, jobs=1, log_format=LogFormat.Text, device_limit=None) -> None:
+        if jobs < 1:
+            raise Exception(f"Job count must be at least one (was {jobs})")
+        self.jobs = jobs
+        self.log_format = log_format
+        self.cond = Condition()
+        self.output_lock = Lock()
+        self.metrics = MetricsCollector()
+        self.pending = PendingJobs()
+        self.pending_count = 0
+        self.active = 0
+        self.idle_workers = 0
+        self.device_limit = device_limit
+        self.device_active = {}
+
+    def submit(self, sub):
+        sub.submitted = time.monotonic()
+        with self.cond:
+            self.pending.append(sub)
+            self.pending_count += 1
+            sub.parent.pending.append(sub)
+            sub.parent.outstanding += 1
+            self._dispatch()
+
+    def wait(self, q):
+        with self.cond:
+            if q.running:
+                self.active -= 1
+                self._dispatch()
+            try:
+                while q.outstanding:
+                    sub = self._take(q.pending) if self.active < self.jobs else None
+                    if sub:
+                        self.active += 1
+                        self.cond.release()
+                        try:
+                            self._run(sub)
+                        finally:
+                            self.cond.acquire()
+                            self.active -= 1
+                            self._dispatch()
+                    else:
+                        self.cond.wait()
+            finally:
+                if q.running:
+                    self.active += 1
+
+    def _take(self, pending: PendingJobs):
+        sub = pending.take(self._device_available)
+        if sub:
+            sub.started = True
+            self.pending_count -= 1
+            if sub.device is not None:
+                self.device_active[sub.device] = self.device_active.get(sub.device, 0) + 1
+        return sub
+
+    def _device_available(self, device):
+        limit = self.device_limit(device) if self.device_limit else None
+        return limit is None or self.device_active.get(device, 0) < limit
+
+    def _dispatch(self):
+        # Start enough workers to fill any free slots, then wake up everyone who might be able to take a job
+        free = self.jobs - self.active - self.idle_workers
+        while free > 0 and self.pending_count > self.idle_workers and self.jobs > 1:
+            self.idle_workers += 1
+            Thread(target=self._worker, daemon=True).start()
+            free -= 1
+        self.cond.notify_all()
+
+    def _worker(self):
+        with self.cond:
+            while True:
+                if not self.pending_count:
+                    self.idle_workers -= 1
+                    return
+                sub = self._take(self.pending) if self.active < self.jobs else None
+                if not sub:
+                    self.cond.wait()
+                    continue
+                self.idle_workers -= 1
+                self.active += 1
+                self.cond.release()
+                try:
+                    self._run(sub)
+                finally:
+                    self.cond.acquire()
+                    self.active -= 1
+                    self.idle_workers += 1
+                    self._dispatch()
+
+    def _run(self, sub):
+        sub.running = True
+        started = time.monotonic()
+        try:
+            sub.job(sub)
+        except BaseException as e:
+            sub.exception = e
+        finally:
+            sub.running = False
+            sub.job = None
+            if sub.job_metrics:
+                self.metrics.record(sub.full_name, time.monotonic() - started, started - sub.submitted, sub.job_metrics)
+            try:
+                sub.flush_logs()
+            except BaseException as e:
+                # ie: stdout was closed. The parent must still be told that this job finished, or it will wait forever.
+                sub.exception = sub.exception or e
+            with self.cond:
+                if sub.device is not None:
+                    self.device_active[sub.device] -= 1
+                sub.parent.outstanding -= 1
+                if sub.exception and not sub.parent.exception:
+                    sub.parent.exception = sub.exception
+                self.cond.notify_all()
+
+    def write_logs(self, name, logs):
+        if self.log_format == LogFormat.Json:
+            lines = [json.dumps({'time': t, 'level': LOG_LEVEL_NAMES[level], 'job': name, 'message': json_message(msg)}) + '\n' for t, level, msg in logs]
+        else:
+            lines = [f'{level}[{name}]: {msg}\n' for _, level, msg in logs]
+        with self.output_lock:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+
+"""
+Hierarchical job queue. Jobs submitted to a queue run on the shared `JobPool`, and each job's log lines are
+buffered and printed together once the job completes.
 """
 class JobQueue:
-    def __init__(self, name=None, parent=None) -> None:
+    def __init__(self, name=None, parent=None, jobs=1, log_format=LogFormat.Text, device_limit=None) -> None:
         self.name = name
         self.parent = parent
+        if self.is_root():
+            self.full_name = '(root)'
+        else:
+            self.full_name = f'{parent.full_name}/{name}'
         self.waited = False
         self.subs = []
         self.logs = []
         self.results = parent.results if parent else JobResults()
+        self.pool = parent.pool if parent else JobPool(jobs, log_format, device_limit)
+        self.job = None
+        self.pending = PendingJobs()
+        self.outstanding = 0
+        self.started = False
+        self.running = False
+        self.exception = None
+        self.submitted = None
+        self.job_metrics = None
+        self.device = None
 
     def __del__(self):
         if not self.waited and len(self.subs) > 0:
@@ -22,21 +230,24 @@ class JobQueue:
         if self.logs:
             print(f'X[{self._name()}]: Failed to print logs!', flush=True)
 
-    def submit(self, name, job):
+    def submit(self, name, job, device=None):
+        """Queues a job to run on the pool. `device` is the device the job reads from, if it should be limited."""
         if name is None and self.name is not None:
             raise Exception('Queue must have a name if parent queue has a name')
         sub = JobQueue(name=name, parent=self)
+        sub.job = job
+        sub.device = device
         self.subs.append(sub)
-        job(sub)
-        sub.flush_logs()
+        self.pool.submit(sub)
 
     def flush_logs(self):
-        for level, msg in self.logs:
-            print(f'{level}[{self._name()}]: {msg}', flush=True)
-        self.logs = []
+        logs, self.logs = self.logs, []
+        if logs:
+            self.pool.write_logs(self.full_name, logs)
 
     def error(self, msg):
-        self.results.errors += 1
+        with self.pool.output_lock:
+            self.results.errors += 1
         self._log("E", msg)
 
     def info(self, msg):
@@ -45,18 +256,31 @@ class JobQueue:
     def warning(self, msg):
         self._log("W", msg)
 
+    def add_metrics(self, bytes=0, cpu_seconds=0):
+        """Records work done by this job, which is included in the run's metrics summary."""
+        if not self.job_metrics:
+            self.job_metrics = JobMetrics()
+        self.job_metrics.bytes += bytes
+        self.job_metrics.cpu_seconds += cpu_seconds
+
     def _log(self, level, msg):
-        self.logs.append((level, msg))
+        self.logs.append((time.time(), level, msg))
+        if len(self.logs) >= LOG_BUFFER_LINES:
+            self.flush_logs()
 
     def wait(self):
         self.waited = True
+        self.pool.wait(self)
+        self.pending.clear()
+        # Drop finished children so a long-lived queue doesn't hold on to every job it ever ran
+        self.subs = []
+        if self.exception:
+            e, self.exception = self.exception, None
+            raise e
         return self.results
 
     def is_root(self):
         return self.parent is None or self.name is None
 
     def _name(self):
-        if self.is_root():
-            return '(root)'
-        else:
-            return f'{self.parent._name()}/{self.name}'
+        return self.full_name
@@ -0,0 +1,83 @@
+import json
+import os
+import time
+
+from pathlib import Path
+from threading import Lock
+from typing import Dict
+
+"""
+Append-only record of each file finished by the current run and its outcome, so that an interrupted run can be
+resumed without redoing that work. The first line identifies the run's configuration (`config`), and a journal
+written with a different configuration is never resumed. Each later line is a JSON object for one file (by path
+relative to the root). The journal is removed once the run completes.
+"""
+class RunJournal:
+    def __init__(self, file: Path, root: Path, config: str, resume=False) -> None:
+        self.file = file
+        self.root = root
+        self.config = config
+        self.lock = Lock()
+        self.done: Dict[str, str] = {}
+        self.resumed_from = None
+        if resume:
+            self._read()
+        file.parent.mkdir(parents=True, exist_ok=True)
+        if self.resumed_from is not None:
+            self.f = open(file, 'at')
+            # Finish a line cut short by the interruption, so the next entry isn't lost with it
+            if self.f.tell() > 0 and not self._ends_with_newline():
+                self.f.write('\n')
+        else:
+            self.f = open(file, 'wt')
+            self._write({'config': config, 'started': time.time()})
+
+    def _read(self):
+        try:
+            with open(self.file, 'rt') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return
+        if header.get('config') != self.config:
+            return
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short when the run was interrupted
+                continue
+            self.done[entry['file']] = entry['outcome']
+        self.resumed_from = header.get('started')
+
+    def _ends_with_newline(self):
+        with open(self.file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _write(self, entry):
+        self.f.write(json.dumps(entry) + '\n')
+        self.f.flush()
+
+    def _key(self, file: Path):
+        return str(file.relative_to(self.root))
+
+    def outcome(self, file: Path):
+        """
+        Returns the outcome recorded for the file by the run being resumed, or None if it wasn't finished. Only files
+        that were 'good' should be skipped, so that failures are reported again by the resumed run.
+        """
+        return self.done.get(self._key(file))
+
+    def record(self, file: Path, outcome: str):
+        with self.lock:
+            self._write({'file': self._key(file), 'outcome': outcome, 'time': time.time()})
+
+    def close(self, completed=False):
+        with self.lock:
+            self.f.close()
+            if completed:
+                os.unlink(self.file)
@@ -6,14 +6,25 @@ import shlex
 import sys
 import importlib.metadata
 
+from .cache import CacheDatabase, ChecksumAlgorithm, ChecksumManifest, ContentIndex, SampleTracker, VerificationCache, default_cache_file
+from .catalog import CatalogFormat, CatalogOperation, MediaCatalog
+from .dedupe import DedupeOperation
 from .docker import Docker
+from .forward_progress import InputMode
+from .devices import ROTATIONAL_DEVICE_JOBS, DeviceLimits
+from .index import ChangesOperation, PathIndex
+from .journal import RunJournal
+from .metrics import MetricsFormat
 from .path_scan import PathScanner, SymlinkMode
-from .jobqueue import JobQueue
+from .jobqueue import JobQueue, LogFormat
 from .ffmpeg import FFMPEG_SUPPORTED_EXTENSIONS
-from .ffmpeg_validator import FFMPEGValidateOperation
-from .ffmpeg_transcoder import FFMPEG_PRESETS, FFMPEGTranscoderOperation
+from .ffmpeg_validator import BatchPolicy, FFMPEGValidateOperation, SamplingPolicy, VerifyDepth
+from .schedule import ScheduleOrder
+from .mirror import CompanionMode
+from .ffmpeg_transcoder import FFMPEG_PRESETS, CompatibleSource, FFMPEGTranscoderOperation, SplitMode
 from .par2 import CreatePar2Operation, VerifyPar2Operation, DEFAULT_PAR2_CREATE_ARGS, DEFAULT_PAR2_VERIFY_ARGS
 from .operation import Operation, PrintFilesOperation
+from .watch import DEFAULT_DEBOUNCE_SECONDS, DEFAULT_RECONCILE_HOURS, Watcher
 
 """
 Default precious extensions that we want to preserve w/PAR2.
@@ -25,17 +36,40 @@ DEFAULT_EXTENSIONS = ','.join(FFMPEG_SUPPORTED_EXTENSIONS + [
     "srt", "idx", "sub",
     # Chiptunes
     "d64", "mod", "s3m"])
-DEFAULT_IGNORE_FILES = ','.join([r"\.DS_Store", r"Thumbs\.db", r"\._.*", r".*\.par2", r".*\.filelist"])
+DEFAULT_IGNORE_FILES = ','.join([r"\.DS_Store", r"Thumbs\.db", r"\._.*", r".*\.par2", r".*\.filelist", r"\.automedia-.*"])
 DEFAULT_SPAM_FILES =','.join(["RARBG.txt", "RARBG_DO_NOT_MIRROR.exe", "WWW.YIFY-TORRENTS.COM.jpg", "www.YTS.AM.jpg", "WWW.YTS.TO.jpg", "www.YTS.LT.jpg"])
+"""
+By default, unchanged files are re-verified monthly so that bitrot (which doesn't touch the file's metadata) is
+still caught.
+"""
+DEFAULT_VERIFY_MAX_AGE_DAYS = 30
+DEFAULT_SAMPLE_MIN_SIZE_MB = 1024
+DEFAULT_BATCH_MAX_SIZE_MB = 16
+WATCH_COMMANDS = ['verify', 'transcode', 'par2-create']
 
 def process_dir(q: JobQueue, scanner: PathScanner, dir: Path, op: Operation):
     results = scanner.scan(q, dir)
     if results.unknown_extensions:
         q.warning(f"Unknown extensions found in path: {' '.join(results.unknown_extensions)}")
-    if results.media_list:
-        op.operate(q, dir, results.media_list)
+    op.operate_scan(q, dir, results)
     for dir in results.directory_list:
-        q.submit(dir.name, lambda q: process_dir(q, scanner, dir, op))
+        q.submit(dir.name, lambda q, dir=dir: process_dir(q, scanner, dir, op))
+    q.wait()
+
+def process_changed_dir(q: JobQueue, scanner: PathScanner, dir: Path, names, op: Operation):
+    """Processes only the named media files in a directory, or all of them if the operation works on whole directories."""
+    results = scanner.scan(q, dir)
+    if not op.whole_directories:
+        results.media_list = [x for x in results.media_list if x.name in names]
+        results.media_stats = {x: results.media_stats[x] for x in results.media_list}
+    op.operate_scan(q, dir, results)
+
+def process_changes(q: JobQueue, scanner: PathScanner, root: Path, trees, changes, op: Operation):
+    for dir in trees:
+        q.submit(str(dir.relative_to(root)), lambda q, dir=dir: process_dir(q, scanner, dir, op))
+    for dir, names in changes.items():
+        name = str(dir.relative_to(root)) if dir != root else None
+        q.submit(name, lambda q, dir=dir, names=names: process_changed_dir(q, scanner, dir, names, op))
     q.wait()
 
 def compile_extension_regex(extensions):
@@ -56,18 +90,64 @@ def do_main(args):
     parser.add_argument("--symlinks", dest="symlink_mode", default=SymlinkMode.Warn.value, choices=[e.value for e in SymlinkMode], action="store", help="sets the symlink-following behavior (silently ignore, allow in all or some cases, or error)")
     parser.add_argument("--extensions", default=DEFAULT_EXTENSIONS, help=f"file extensions to include in processing (default {DEFAULT_EXTENSIONS})")
     parser.add_argument("--ignore", default=DEFAULT_IGNORE_FILES, help=f"file regular expressions to completely exclude in processing (default {DEFAULT_IGNORE_FILES})")
+    parser.add_argument("--cache-file", dest="cache_file", action="store", help="file used to remember state between runs (default is a per-root file under $XDG_CACHE_HOME/automedia)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="do not read or write the cache file")
+    parser.add_argument("--index", dest="use_index", action="store_true", help="keep an index of the tree in the cache file, and only re-read directories that changed since the last run")
+    parser.add_argument("--input-mode", dest="input_mode", default=InputMode.Pipe.value, choices=[e.value for e in InputMode], help="how ffmpeg reads input files: copied through a pipe, or directly from the file (default pipe)")
+    parser.add_argument("--log-format", dest="log_format", default=LogFormat.Text.value, choices=[e.value for e in LogFormat], help="output human-readable log lines, or one JSON object per line (default text)")
+    parser.add_argument("--metrics-file", dest="metrics_file", action="store", help="write a summary of per-file timings and throughput to this file at the end of the run")
+    parser.add_argument("--metrics-format", dest="metrics_format", default=MetricsFormat.Json.value, choices=[e.value for e in MetricsFormat], help="format of the metrics file: JSON, or a Prometheus textfile (default json)")
+    parser.add_argument("--resume", action="store_true", help="skip files already finished by the last run of the same verify or transcode command, if it was interrupted")
+    parser.add_argument("--journal-file", dest="journal_file", action="store", help="file recording the files finished by a verify or transcode run, for --resume (default is next to the cache file)")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int, default=1, help="maximum number of files or directories to process in parallel (default 1)")
+    parser.add_argument("--watch", action="store_true", help=f"stay running and process media as it is added or changed under the root, for {', '.join(WATCH_COMMANDS)}")
+    parser.add_argument("--watch-debounce", dest="watch_debounce", type=float, default=DEFAULT_DEBOUNCE_SECONDS, help=f"with --watch, wait until nothing has changed for this many seconds before processing changes (default {DEFAULT_DEBOUNCE_SECONDS})")
+    parser.add_argument("--watch-reconcile", dest="watch_reconcile", type=float, default=DEFAULT_RECONCILE_HOURS, help=f"with --watch, process the whole root this often in hours, to pick up any changes that were missed (default {DEFAULT_RECONCILE_HOURS})")
+    parser.add_argument("--device-jobs", dest="device_jobs", default="auto", help=f"maximum number of files to read at once from each disk: 'auto' for {ROTATIONAL_DEVICE_JOBS} on spinning disks and no limit on others, a number for every disk, or 0 for no limit (default auto)")
     commands = parser.add_subparsers(dest="command", required=True, help="sub-command help (use sub-command --help for more info)")
     verify_cmd = commands.add_parser("verify", help="verify media files are corruption-free with FFMPEG")
+    verify_cmd.add_argument("--max-age", dest="max_age", type=float, default=DEFAULT_VERIFY_MAX_AGE_DAYS, help=f"re-verify unchanged files if they were last verified more than this many days ago (default {DEFAULT_VERIFY_MAX_AGE_DAYS})")
+    verify_cmd.add_argument("--force", action="store_true", help="verify all files, even if they are unchanged since they were last verified")
+    verify_cmd.add_argument("--depth", default=VerifyDepth.Full.value, choices=[e.value for e in VerifyDepth], help="how thoroughly to check files: headers only, every packet without decoding, or a full decode (default full)")
+    verify_cmd.add_argument("--headers-first", dest="headers_first", action="store_true", help="check the headers of every file as the tree is scanned, and only run the deeper checks once scanning completes, so that broken files are reported early")
+    verify_cmd.add_argument("--checksum", choices=[e.value for e in ChecksumAlgorithm], help="also checksum each file while it is read for verification, and report files whose contents changed since the last run without their modification time changing")
+    verify_cmd.add_argument("--sample", dest="sample_segments", type=int, default=0, help="decode only this many evenly spaced segments (plus the head and tail) of large files, checking different segments on each run (default 0, decode in full)")
+    verify_cmd.add_argument("--sample-min-size", dest="sample_min_size", type=int, default=DEFAULT_SAMPLE_MIN_SIZE_MB, help=f"size in MB from which files are sampled (default {DEFAULT_SAMPLE_MIN_SIZE_MB})")
+    verify_cmd.add_argument("--sample-time-budget", dest="sample_time_budget", type=float, help="stop sampling further files after this many seconds, leaving them for the next run")
+    verify_cmd.add_argument("--sample-byte-budget", dest="sample_byte_budget", type=int, help="stop sampling further files after reading about this many MB, leaving them for the next run")
+    verify_cmd.add_argument("--batch", dest="batch_files", type=int, default=0, help="check this many small files at a time with each ffmpeg process, to save starting a process for each file (default 0, one file per process)")
+    verify_cmd.add_argument("--batch-max-size", dest="batch_max_size", type=int, default=DEFAULT_BATCH_MAX_SIZE_MB, help=f"size in MB below which files are batched (default {DEFAULT_BATCH_MAX_SIZE_MB})")
+    verify_cmd.add_argument("--reuse-duplicates", dest="reuse_duplicates", action="store_true", help="skip files identical to a file already verified in the same way, as last found by dedupe")
+    verify_cmd.add_argument("--order", default=ScheduleOrder.Scan.value, choices=[e.value for e in ScheduleOrder], help="order to run the full or packet checks in (default scan)")
+    verify_cmd.add_argument("--time-budget", dest="time_budget", type=float, help="stop starting new checks after this many seconds; the files left over can be picked up with --resume, or come first with --order least-recently-verified")
     transcode_cmd = commands.add_parser("transcode", help="transcode media files with FFMPEG")
     transcode_cmd.add_argument("--preset", required=True, choices=FFMPEG_PRESETS.keys(), help=f"output format preset (one of {' '.join(FFMPEG_PRESETS.keys())})")
     transcode_cmd.add_argument("--output", required=True, help=f"output directory")
+    transcode_cmd.add_argument("--incremental", action="store_true", help="skip files that were already transcoded with the same preset and have not changed since")
+    transcode_cmd.add_argument("--prune", action="store_true", help="remove previously transcoded files whose source file no longer exists")
+    transcode_cmd.add_argument("--split", default=SplitMode.Never.value, choices=[e.value for e in SplitMode], help="encode long files as segments in parallel (across --jobs) and join them, which pads each join by a few milliseconds for every preset, so is only done if asked for (default never)")
+    transcode_cmd.add_argument("--reuse-duplicates", dest="reuse_duplicates", action="store_true", help="reuse the output of files identical to a file already transcoded with the same preset, as last found by dedupe")
+    transcode_cmd.add_argument("--compatible", choices=[e.value for e in CompatibleSource], help="what to do with files already in the preset's codec at no more than its bitrate: transcode them anyway, remux them without re-encoding, or link or copy them as-is (default depends on the preset)")
+    transcode_cmd.add_argument("--companions", default=CompanionMode.Skip.value, choices=[e.value for e in CompanionMode], help="what to do with files that are not transcoded (ie: covers, subtitles): leave them out, copy them (with reflinks where supported), or hard link them when on the same filesystem (default skip)")
     print_cmd = commands.add_parser("print", help="print all media files")
+    catalog_cmd = commands.add_parser("catalog", help="probe media files with ffprobe and record their format, codecs, duration and bitrate in the cache file")
+    catalog_cmd.add_argument("--export", help="also write the whole catalog to this file")
+    catalog_cmd.add_argument("--export-format", dest="export_format", default=CatalogFormat.Csv.value, choices=[e.value for e in CatalogFormat], help="format of the exported catalog: CSV, or one JSON object per line (default csv)")
+    dedupe_cmd = commands.add_parser("dedupe", help="find sets of identical media files, and record them for --reuse-duplicates")
+    changes_cmd = commands.add_parser("changes", help="print media files added, modified or removed since the index was last updated, and update the index")
     par2_create_cmd = commands.add_parser("par2-create", help="create a PAR2 archive in each directory")
     par2_create_cmd.add_argument("--par2-args", default=DEFAULT_PAR2_CREATE_ARGS, help=f"arguments to pass to PAR2 (default {DEFAULT_PAR2_CREATE_ARGS})")
     par2_create_cmd.add_argument("--name", dest="par2_name", default="recovery", help="recovery filename (for .par2 and .filelist files)")
+    par2_create_cmd.add_argument("--threads", dest="par2_threads", type=int, help="total number of threads shared by all running par2 processes (default CPU count)")
+    par2_create_cmd.add_argument("--processes", dest="par2_processes", type=int, help="maximum number of par2 processes to run at once (default limited only by --jobs)")
+    par2_create_cmd.add_argument("--hash", dest="par2_hash", action="store_true", help="record a hash of each file in the file list, so that files whose metadata changed without their contents changing don't cause the PAR2 files to be recreated")
     par2_verify_cmd = commands.add_parser("par2-verify", help="verify the PAR2 archive in each directory")
     par2_verify_cmd.add_argument("--par2-args", default=DEFAULT_PAR2_VERIFY_ARGS, help=f"arguments to pass to PAR2 (default {DEFAULT_PAR2_VERIFY_ARGS})")
     par2_verify_cmd.add_argument("--name", dest="par2_name", default="recovery", help="recovery filename (for .par2 and .filelist files)")
+    par2_verify_cmd.add_argument("--threads", dest="par2_threads", type=int, help="total number of threads shared by all running par2 processes (default CPU count)")
+    par2_verify_cmd.add_argument("--processes", dest="par2_processes", type=int, help="maximum number of par2 processes to run at once (default limited only by --jobs)")
+    par2_verify_cmd.add_argument("--max-age", dest="max_age", type=float, default=DEFAULT_VERIFY_MAX_AGE_DAYS, help=f"re-verify unchanged directories if they were last verified more than this many days ago (default {DEFAULT_VERIFY_MAX_AGE_DAYS})")
+    par2_verify_cmd.add_argument("--force", action="store_true", help="verify all directories, even if they are unchanged since they were last verified")
 
     args = parser.parse_args(args[1:])
     if args.container_pwd and args.container_prefix:
@@ -82,40 +162,186 @@ def do_main(args):
 
     extension_regex = compile_extension_regex(args.extensions)
     ignore_regex = compile_ignore_regex(args.ignore)
-    if args.command == 'verify':
-        operation = FFMPEGValidateOperation()
-    elif args.command == 'transcode':
-        preset = FFMPEG_PRESETS[args.preset]
-        operation = FFMPEGTranscoderOperation(docker.dockerize_path(args.output), preset.args, preset.ext)
-    elif args.command == 'print':
-        operation = PrintFilesOperation()
-    elif args.command == 'par2-create':
-        operation = CreatePar2Operation(shlex.split(args.par2_args), args.par2_name)
-    elif args.command == 'par2-verify':
-        operation = VerifyPar2Operation(shlex.split(args.par2_args), args.par2_name)
+    if args.no_cache:
+        cache = None
     else:
-        print("Unexpected operation")
+        cache = CacheDatabase(docker.dockerize_path(args.cache_file) if args.cache_file else default_cache_file(root))
+    index = None
+    if args.use_index or args.command == 'changes':
+        if not cache:
+            print("The index is stored in the cache file, and cannot be used with --no-cache")
+            sys.exit(1)
+        index = PathIndex(cache, root, '|'.join([args.extensions, args.ignore, args.symlink_mode]))
+    if args.command == 'catalog' and not cache:
+        print("The catalog is stored in the cache file, and cannot be used with --no-cache")
+        sys.exit(1)
+    if args.command in ['verify', 'transcode'] and args.reuse_duplicates and not cache:
+        print("Duplicates are found by dedupe and stored in the cache file, and cannot be used with --no-cache")
+        sys.exit(1)
+    if args.command == 'verify' and args.checksum and not cache:
+        print("Checksums are stored in the cache file, and cannot be used with --no-cache")
+        sys.exit(1)
+    if args.command == 'verify' and args.order == ScheduleOrder.LeastRecentlyVerified.value and not cache:
+        print("Verification times are stored in the cache file, and cannot be used with --no-cache")
+        sys.exit(1)
+    if args.command == 'verify' and args.sample_segments and not cache:
+        print("Sampled segments are tracked in the cache file, and cannot be used with --no-cache")
+        sys.exit(1)
+    if args.watch and args.command not in WATCH_COMMANDS:
+        print(f"Only {', '.join(WATCH_COMMANDS)} can be run with --watch")
         sys.exit(1)
-    q = JobQueue()
+    if args.watch and args.resume:
+        print("A watch never finishes a run to resume, so --resume cannot be used with --watch")
+        sys.exit(1)
+    if args.resume and args.no_cache and not args.journal_file:
+        print("The journal is kept next to the cache file, so --resume needs --journal-file when used with --no-cache")
+        sys.exit(1)
+    # A watch runs a fresh operation for each batch of changes
+    def make_operation():
+        if args.command == 'verify':
+            sampling = None
+            if args.sample_segments > 0:
+                sampling = SamplingPolicy(SampleTracker(cache, root), args.sample_segments, args.sample_min_size * 1024 * 1024,
+                    time_budget=args.sample_time_budget,
+                    byte_budget=args.sample_byte_budget * 1024 * 1024 if args.sample_byte_budget is not None else None)
+            return FFMPEGValidateOperation(
+                cache=VerificationCache(cache, root) if cache else None,
+                max_age=args.max_age * 86400,
+                force=args.force,
+                input_mode=InputMode(args.input_mode),
+                checksums=ChecksumManifest(cache, root, ChecksumAlgorithm(args.checksum)) if args.checksum else None,
+                depth=VerifyDepth(args.depth),
+                sampling=sampling,
+                journal=journal,
+                order=ScheduleOrder(args.order),
+                time_budget=args.time_budget,
+                batching=BatchPolicy(args.batch_files, args.batch_max_size * 1024 * 1024) if args.batch_files > 1 else None,
+                duplicates=ContentIndex(cache, root) if args.reuse_duplicates else None,
+                headers_first=args.headers_first)
+        elif args.command == 'transcode':
+            preset = FFMPEG_PRESETS[args.preset]
+            return FFMPEGTranscoderOperation(docker.dockerize_path(args.output), preset.args, preset.ext, incremental=args.incremental, prune=args.prune, input_mode=InputMode(args.input_mode),
+                split=SplitMode(args.split), splittable=preset.splittable, journal=journal,
+                duplicates=ContentIndex(cache, root) if args.reuse_duplicates else None,
+                compatible=CompatibleSource(args.compatible) if args.compatible else preset.compatible, compatible_codec=preset.codec, compatible_bitrate=preset.bitrate,
+                catalog=MediaCatalog(cache, root) if cache else None, companions=CompanionMode(args.companions))
+        elif args.command == 'print':
+            return PrintFilesOperation()
+        elif args.command == 'changes':
+            return ChangesOperation(index)
+        elif args.command == 'catalog':
+            return CatalogOperation(MediaCatalog(cache, root), docker.dockerize_path(args.export) if args.export else None, CatalogFormat(args.export_format))
+        elif args.command == 'dedupe':
+            return DedupeOperation(ContentIndex(cache, root) if cache else None)
+        elif args.command == 'par2-create':
+            return CreatePar2Operation(shlex.split(args.par2_args), args.par2_name, threads=args.par2_threads, processes=args.par2_processes, hash=args.par2_hash)
+        elif args.command == 'par2-verify':
+            return VerifyPar2Operation(shlex.split(args.par2_args), args.par2_name, threads=args.par2_threads, processes=args.par2_processes,
+                max_age=args.max_age * 86400, force=args.force)
+        else:
+            print("Unexpected operation")
+            sys.exit(1)
+    if args.jobs < 1:
+        print(f"Job count must be at least one: {args.jobs}")
+        sys.exit(1)
+    if args.device_jobs == 'auto':
+        device_limit = DeviceLimits()
+    elif args.device_jobs.isdigit():
+        device_limit = DeviceLimits(int(args.device_jobs)) if int(args.device_jobs) > 0 else None
+    else:
+        print(f"Device job count must be 'auto' or a number: {args.device_jobs}")
+        sys.exit(1)
+    q = JobQueue(jobs=args.jobs, log_format=LogFormat(args.log_format), device_limit=device_limit)
 
     scanner = PathScanner(
         symlink_mode=SymlinkMode(args.symlink_mode),
         supported_extension_matcher=lambda p: p.suffix and extension_regex.fullmatch(p.suffix),
         ignored_pattern_matcher=lambda p: ignore_regex.fullmatch(p.name),
-        spam_files_matcher=lambda _: False)
+        spam_files_matcher=lambda _: False,
+        index=index)
+    watcher = None
+    if args.watch:
+        try:
+            watcher = Watcher(root, scanner, debounce=args.watch_debounce, reconcile_interval=args.watch_reconcile * 3600)
+        except OSError as e:
+            print(f"Unable to watch for changes: {e}")
+            sys.exit(1)
 
-    # Allow the operation to initalize and log if needed
-    operation.initialize(q, root)
-    q.flush_logs()
+    # Opening the journal replaces the one from any interrupted run, so it's only opened once everything is validated.
+    # Nothing is written next to the cache file with --no-cache, so there is only a journal if one is asked for
+    journal = None
+    if args.command in ['verify', 'transcode'] and not args.watch and (args.journal_file or not args.no_cache):
+        if args.journal_file:
+            journal_file = docker.dockerize_path(args.journal_file)
+        else:
+            cache_file = docker.dockerize_path(args.cache_file) if args.cache_file else default_cache_file(root)
+            journal_file = cache_file.with_name(f'{cache_file.stem}-{args.command}.journal')
+        if args.command == 'verify':
+            config = f'verify {args.depth}'
+        else:
+            config = f'transcode {args.preset} {docker.dockerize_path(args.output).resolve()}'
+        journal = RunJournal(journal_file, root, config, resume=args.resume)
+        if args.resume and journal.resumed_from is None:
+            print("No interrupted run found to resume, starting from the beginning")
+
+    def run(operation, process):
+        # Allow the operation to initalize and log if needed
+        operation.initialize(q, root)
+        q.flush_logs()
+        q.submit(None, lambda q: process(q, operation))
+        results = q.wait()
+        operation.finalize(q, root)
+        if not args.watch:
+            # Timings are kept for the whole time a watch is running, so are only summarised for a single run
+            for line in q.pool.metrics.summary_lines(results.errors):
+                q.info(line)
+        q.flush_logs()
+        if args.metrics_file:
+            q.pool.metrics.write(docker.dockerize_path(args.metrics_file), MetricsFormat(args.metrics_format), results.errors)
+        return results
 
-    q.submit(None, lambda q: process_dir(q, scanner, root, operation))
-    results = q.wait()
+    completed = False
+    try:
+        operation = make_operation()
+        if watcher:
+            watch(q, root, scanner, watcher, operation, make_operation, run)
+        results = run(operation, lambda q, operation: process_dir(q, scanner, root, operation))
+        completed = operation.is_complete()
+    finally:
+        # The journal is only kept for an interrupted (or time-limited) run, to be resumed
+        if journal:
+            journal.close(completed)
+        if cache:
+            cache.close()
     if results.errors:
         return 1
     return 0
 
+def watch(q: JobQueue, root: Path, scanner: PathScanner, watcher: Watcher, operation: Operation, make_operation, run):
+    """Processes the whole root, then each batch of changes under it as they settle. Only returns if interrupted."""
+    # Watch before the first run, so nothing that changes during it is missed
+    q.info("Watching for changes")
+    watcher.watch_tree(q, root)
+    q.flush_logs()
+    batch = None
+    while True:
+        if batch is None or batch.reconcile:
+            if batch:
+                q.info("Processing the whole root to pick up any missed changes")
+                # Directories that failed to be watched before (or were missed) are picked up here
+                watcher.watch_tree(q, root)
+            run(operation, lambda q, operation: process_dir(q, scanner, root, operation))
+        else:
+            trees = watcher.watch_new_trees(q, batch)
+            if trees or batch.changes:
+                q.info(f"Processing changes in {len(trees) + len(batch.changes)} directories")
+                run(operation, lambda q, operation: process_changes(q, scanner, root, trees, batch.changes, operation))
+        q.flush_logs()
+        batch = watcher.next_batch()
+        operation = make_operation()
+
 def main(args=sys.argv):
     try:
         sys.exit(do_main(args))
     except KeyboardInterrupt:
-        print("Interrupted by user!")
+        print("Interrupted by user! Run verify or transcode again with --resume to continue where it stopped.")
@@ -0,0 +1,135 @@
+import heapq
+import json
+import time
+
+from array import array
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from threading import Lock
+
+PERCENTILES = [50, 90, 99]
+
+"""
+Number of slowest jobs kept for the summary.
+"""
+SLOWEST_COUNT = 10
+
+class MetricsFormat(Enum):
+    Json = "json"
+    # Prometheus textfile collector format
+    Prometheus = "prometheus"
+
+"""
+Work done by a single job, as reported by the operation through `JobQueue.add_metrics`.
+"""
+@dataclass
+class JobMetrics:
+    bytes: int = 0
+    cpu_seconds: float = 0
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already-sorted sequence."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+"""
+Collects timings for every job that reported metrics. Only the numbers needed for the summary are kept per job
+(plus a small heap of the slowest), so memory stays small on very large runs.
+"""
+class MetricsCollector:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.started = time.monotonic()
+        self.wall = array('d')
+        self.slot_wait = array('d')
+        self.cpu = array('d')
+        self.throughput = array('d')
+        self.bytes = 0
+        self.slowest = []
+
+    def record(self, name: str, wall: float, slot_wait: float, metrics: JobMetrics):
+        with self.lock:
+            self.wall.append(wall)
+            self.slot_wait.append(slot_wait)
+            self.cpu.append(metrics.cpu_seconds)
+            self.bytes += metrics.bytes
+            if metrics.bytes and wall > 0:
+                self.throughput.append(metrics.bytes / wall / 1024 / 1024)
+            entry = (wall, name, metrics.bytes)
+            if len(self.slowest) < SLOWEST_COUNT:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def summary(self, errors=0):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            def distribution(values):
+                values = sorted(values)
+                return {
+                    'sum': sum(values),
+                    **{f'p{p}': percentile(values, p) for p in PERCENTILES},
+                    'max': values[-1] if values else 0,
+                }
+            return {
+                'jobs': len(self.wall),
+                'errors': errors,
+                'elapsed_seconds': elapsed,
+                'bytes': self.bytes,
+                'mb_per_second': self.bytes / elapsed / 1024 / 1024 if elapsed > 0 else 0,
+                'wall_seconds': distribution(self.wall),
+                'slot_wait_seconds': distribution(self.slot_wait),
+                'cpu_seconds': distribution(self.cpu),
+                'job_mb_per_second': distribution(self.throughput),
+                'slowest': [{'job': name, 'wall_seconds': wall, 'bytes': bytes} for wall, name, bytes in sorted(self.slowest, reverse=True)],
+            }
+
+    def summary_lines(self, errors=0):
+        summary = self.summary(errors)
+        if not summary['jobs']:
+            return []
+        def quantiles(d, unit):
+            return ', '.join([f"p{p} {d[f'p{p}']:.2f}{unit}" for p in PERCENTILES] + [f"max {d['max']:.2f}{unit}"])
+        lines = [
+            f"Processed {summary['jobs']} file(s), {summary['bytes'] // 1024 // 1024}MB in {summary['elapsed_seconds']:.1f}s ({summary['mb_per_second']:.1f}MB/s), {summary['cpu_seconds']['sum']:.1f}s process CPU time",
+            f"Time per file: {quantiles(summary['wall_seconds'], 's')}",
+            f"Waiting for a slot: {quantiles(summary['slot_wait_seconds'], 's')}",
+            f"Throughput per file: {quantiles(summary['job_mb_per_second'], 'MB/s')}",
+            "Slowest files:",
+        ]
+        for slow in summary['slowest']:
+            lines.append(f"  {slow['wall_seconds']:.2f}s {slow['bytes'] // 1024}k {slow['job']}")
+        return lines
+
+    def write(self, file: Path, format: MetricsFormat, errors=0):
+        summary = self.summary(errors)
+        if format == MetricsFormat.Json:
+            content = json.dumps(summary, indent=2) + '\n'
+        else:
+            content = prometheus_text(summary)
+        # Write atomically, as textfile collectors may read the file at any time
+        temp = file.with_name(f'.{file.name}.tmp')
+        temp.write_text(content)
+        temp.replace(file)
+
+def prometheus_text(summary):
+    lines = []
+    def metric(name, type, help, samples):
+        lines.append(f'# HELP automedia_{name} {help}')
+        lines.append(f'# TYPE automedia_{name} {type}')
+        for labels, value in samples:
+            lines.append(f'automedia_{name}{labels} {value}')
+    metric('jobs_total', 'counter', 'Files processed', [('', summary['jobs'])])
+    metric('errors_total', 'counter', 'Errors reported', [('', summary['errors'])])
+    metric('bytes_total', 'counter', 'Bytes processed', [('', summary['bytes'])])
+    metric('elapsed_seconds', 'gauge', 'Duration of the run', [('', summary['elapsed_seconds'])])
+    for name, help in [
+        ('wall_seconds', 'Time taken per file'),
+        ('slot_wait_seconds', 'Time each file waited for a free job slot'),
+        ('cpu_seconds', 'Subprocess CPU time per file')]:
+        d = summary[name]
+        metric(f'job_{name}', 'summary', help,
+            [(f'{{quantile="{p / 100}"}}', d[f'p{p}']) for p in PERCENTILES] + [('_sum', d['sum']), ('_count', summary['jobs'])])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,94 @@
+import errno
+import fcntl
+import os
+import shutil
+
+from enum import Enum
+from pathlib import Path
+
+class CompanionMode(Enum):
+    # Leave files that aren't transcoded out of the output tree
+    Skip = "skip"
+    # Copy them, sharing the source's storage with a reflink where the filesystem supports it
+    Copy = "copy"
+    # Hard link them when on the same filesystem as the source, otherwise copy them
+    Link = "link"
+
+"""
+ioctl to make a file share the storage of another (a reflink), on filesystems that support it (ie: btrfs, XFS).
+"""
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024
+
+"""
+Errors meaning the kernel can't copy between the two files, rather than that the copy failed.
+"""
+UNSUPPORTED_COPY_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+def is_identical(source: Path, target: Path):
+    """
+    Whether `target` is already a placed copy of `source`: the same file, or one with the same size and modification
+    time (which `place_file` copies), as for rsync.
+    """
+    try:
+        src, dst = source.stat(), target.stat()
+    except FileNotFoundError:
+        return False
+    return (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino) or (src.st_size == dst.st_size and src.st_mtime_ns == dst.st_mtime_ns)
+
+def _copy_contents(src, dst, size):
+    """Copies `size` bytes between open files as cheaply as the kernel allows, returning whether it was a reflink."""
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        pass
+    copied = 0
+    # Both copy in the kernel, without passing the data through this process
+    copies = [lambda n: os.sendfile(dst.fileno(), src.fileno(), copied, n)]
+    if hasattr(os, 'copy_file_range'):
+        copies.insert(0, lambda n: os.copy_file_range(src.fileno(), dst.fileno(), n, copied, copied))
+    for copy in copies:
+        try:
+            while copied < size and (n := copy(size - copied)):
+                copied += n
+        except OSError as e:
+            # Only fall back if nothing was written yet
+            if e.errno not in UNSUPPORTED_COPY_ERRORS or copied:
+                raise
+            continue
+        if copied == size:
+            return False
+        # Some filesystems stop short (returning 0) rather than failing, so copy the rest by hand
+        break
+    while chunk := os.pread(src.fileno(), COPY_CHUNK_SIZE, copied):
+        os.pwrite(dst.fileno(), chunk, copied)
+        copied += len(chunk)
+    if copied < size:
+        raise OSError(errno.EIO, f"Only {copied} of {size} bytes could be read")
+    return False
+
+def place_file(source: Path, target: Path, link=False) -> str:
+    """
+    Places a copy of `source` at `target`, returning how: 'linked' (a hard link, if `link` is set and both are on the
+    same filesystem), 'reflinked' or 'copied'. The copy is written under a temporary name and renamed into place.
+    """
+    partial = target.with_name(f'.automedia-partial-{target.name}')
+    partial.unlink(missing_ok=True)
+    try:
+        method = None
+        if link:
+            try:
+                os.link(source, partial)
+                method = 'linked'
+            except OSError:
+                pass
+        if method is None:
+            with open(source, 'rb') as src, open(partial, 'wb') as dst:
+                method = 'reflinked' if _copy_contents(src, dst, os.fstat(src.fileno()).st_size) else 'copied'
+            shutil.copystat(source, partial)
+        os.replace(partial, target)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    return method
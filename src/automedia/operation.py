@@ -1,6 +1,9 @@
 from abc import abstractmethod
 
 class Operation:
+    # Whether the operation works on whole directories (ie: par2), so must always be given every file in one
+    whole_directories = False
+
     @abstractmethod
     def operate(self, q, dir, files):
         pass
@@ -9,6 +12,19 @@ class Operation:
     def initialize(self, q, dir):
         pass
 
+    def operate_scan(self, q, dir, results):
+        """Called with the full scan results for each directory. By default, operates on any media files found."""
+        if results.media_list:
+            self.operate(q, dir, results.media_list)
+
+    def finalize(self, q, dir):
+        """Called once after every directory has been processed."""
+        pass
+
+    def is_complete(self):
+        """Whether the run did all of its work, rather than stopping early (ie: at a time budget)."""
+        return True
+
 class PrintFilesOperation(Operation):
     def operate(self, q, _, files):
         q.info(f"{len(files)} file(s)")
@@ -1,45 +1,157 @@
+import hashlib
 import os
 import subprocess
+import time
 
+from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import List
+from threading import Condition, Lock
+from typing import Dict, List, Optional
 from subprocess import Popen
 
 from .operation import Operation
+from .path_scan import PathScanResults
 
 DEFAULT_PAR2_CREATE_ARGS = ' '.join(['-u', '-n3', '-r10'])
 DEFAULT_PAR2_VERIFY_ARGS = ' '.join(['-N'])
 
-RECOVERY_LIST_HEADER = "[media-tools-v1]"
+RECOVERY_LIST_HEADER_V1 = "[media-tools-v1]"
+RECOVERY_LIST_HEADER = "[media-tools-v2]"
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(file: Path) -> str:
+    """Fast content hash of a file, read in streaming chunks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb', buffering=0) as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+"""
+A file covered by the PAR2 files. v1 lists only record the name.
+"""
+@dataclass
+class RecoveryEntry:
+    name: str
+    size: Optional[int] = None
+    mtime_ns: Optional[int] = None
+    hash: Optional[str] = None
+
+    def has_fingerprint(self):
+        return self.size is not None and self.mtime_ns is not None
+
+"""
+The .filelist written alongside the PAR2 files. v2 lists record each file's size and mtime (and optionally a content
+hash) as of when the PAR2 files were created, along with the time they were last successfully verified:
+
+    [media-tools-v2]
+    verified<TAB>1700000000.0
+    file<TAB>size<TAB>mtime_ns<TAB>hash (or -)<TAB>name
+
+v1 lists (just the header and one name per line) are still read.
+"""
 class RecoveryList:
-    def __init__(self, files) -> None:
-        self.files = files
+    def __init__(self, entries: List[RecoveryEntry], verified_at: Optional[float] = None) -> None:
+        self.entries = {x.name: x for x in entries}
+        self.verified_at = verified_at
+
+    @property
+    def files(self):
+        return sorted(self.entries.keys())
+
+    def of_stats(stats: Dict[Path, os.stat_result]):
+        return RecoveryList([RecoveryEntry(file.name, st.st_size, st.st_mtime_ns) for file, st in stats.items()])
+
+    def modified(self, current: 'RecoveryList') -> List[str]:
+        """Names of files whose recorded fingerprint differs from the current one (always empty for v1 lists)."""
+        return [name for name, x in sorted(self.entries.items())
+            if x.has_fingerprint() and name in current.entries and (x.size, x.mtime_ns) != (current.entries[name].size, current.entries[name].mtime_ns)]
 
     def read(file: Path):
         with open(file, 'rt') as f:
-            header = f.readline()
-            if header.rstrip() != RECOVERY_LIST_HEADER:
+            header = f.readline().rstrip()
+            if header == RECOVERY_LIST_HEADER_V1:
+                return RecoveryList([RecoveryEntry(x.rstrip()) for x in f.readlines() if x.rstrip()])
+            if header != RECOVERY_LIST_HEADER:
                 raise Exception(f"Invalid {file.name} found (header was {header}), cannot create parity files")
-            old_files = [x.rstrip() for x in f.readlines()]
-            old_files.sort()
-        return RecoveryList(old_files)
+            entries = []
+            verified_at = None
+            for line in f.read().splitlines():
+                fields = line.split('\t', 4)
+                if fields[0] == 'verified' and len(fields) == 2:
+                    verified_at = float(fields[1])
+                elif fields[0] == 'file' and len(fields) == 5:
+                    _, size, mtime_ns, hash, name = fields
+                    entries.append(RecoveryEntry(name, int(size), int(mtime_ns), None if hash == '-' else hash))
+                elif line:
+                    raise Exception(f"Invalid {file.name} found (unexpected line {line})")
+        return RecoveryList(entries, verified_at)
 
     def write(self, file: Path):
-        with open(file, 'wt') as f:
-            f.write("[media-tools-v1]\n")
-            f.write('\n'.join([x.name for x in self.files]))
+        lines = [RECOVERY_LIST_HEADER]
+        if self.verified_at is not None:
+            lines.append(f'verified\t{self.verified_at}')
+        for x in sorted(self.entries.values(), key=lambda x: x.name):
+            lines.append(f'file\t{x.size}\t{x.mtime_ns}\t{x.hash or "-"}\t{x.name}')
+        temp = file.with_name(f'.automedia-partial-{file.name}')
+        temp.write_text('\n'.join(lines) + '\n')
+        temp.replace(file)
 
 class RecoveryListState(Enum):
     MISSING = 0
     UP_TO_DATE = 1
     ERROR = 2
+    # Files were added or removed since the PAR2 files were created
+    OUT_OF_DATE = 3
+    # The same files exist, but some have a different size or mtime
+    MODIFIED = 4
 
+"""
+Directories are given one par2 thread per this many bytes of files, up to the thread budget.
+"""
+PAR2_BYTES_PER_THREAD = 256 * 1024 * 1024
+
+"""
+A fixed number of units (ie: threads or processes) shared between concurrent jobs.
+"""
+class ResourceBudget:
+    def __init__(self, total) -> None:
+        self.total = total
+        self.available = total
+        self.cond = Condition()
+
+    def acquire(self, n=1):
+        """Blocks until `n` units are free (clamped to the total), returning the number acquired."""
+        n = max(1, min(n, self.total))
+        with self.cond:
+            self.cond.wait_for(lambda: self.available >= n)
+            self.available -= n
+        return n
+
+    def release(self, n=1):
+        with self.cond:
+            self.available += n
+            self.cond.notify_all()
+
+"""
+PAR2 operations check each directory's recovery list while the tree is scanned, but only run par2 once the whole
+tree has been scanned. The directories are then run concurrently, largest first so that the run doesn't finish on a
+single huge straggler, with the total par2 threads and processes limited by budgets.
+"""
 class Par2Operation(Operation):
-    def __init__(self, args, recovery_name) -> None:
+    whole_directories = True
+
+    def __init__(self, args, recovery_name, threads=None, processes=None) -> None:
         self.args = list(args)
         self.recovery_name = recovery_name
+        self.threads = ResourceBudget(threads or os.cpu_count() or 1)
+        self.processes = ResourceBudget(processes) if processes else None
+        # Respect any thread count the user passed to par2 themselves
+        self.set_threads = not any(x.startswith('-t') for x in self.args)
+        self.scheduled = []
+        self.lock = Lock()
 
     def recovery_list(self, dir):
         return dir / f'{self.recovery_name}.filelist'
@@ -47,25 +159,34 @@ class Par2Operation(Operation):
     def par2_index(self, dir):
         return dir / f'{self.recovery_name}.par2'
 
-    def validate_recovery_list(self, q, dir: Path, files: List[Path]) -> RecoveryListState:
+    def validate_recovery_list(self, q, dir: Path, current: RecoveryList):
+        """Compares the recovery list with the files now in the directory, returning the state and the list read."""
         if not self.par2_index(dir).exists():
             if self.recovery_list(dir).exists():
                 q.warning("File list exists, but PAR2 does not exist")
-            return RecoveryListState.MISSING
-        if self.recovery_list(dir).exists():
-            try:
-                list = RecoveryList.read(self.recovery_list(dir))
-                if list.files != [x.name for x in files]:
-                    q.warning("PAR2 exists, but is out-of-date")
-                    q.warning(list.files)
-                    q.warning([x.name for x in files])
-                else:
-                    q.info("PAR2 exists, and is up-to-date")
-                    return RecoveryListState.UP_TO_DATE
-            except Exception as e:
-                q.error(str(e))
-                return RecoveryListState.ERROR
-        return RecoveryListState.MISSING
+            return RecoveryListState.MISSING, None
+        if not self.recovery_list(dir).exists():
+            return RecoveryListState.MISSING, None
+        try:
+            previous = RecoveryList.read(self.recovery_list(dir))
+        except Exception as e:
+            q.error(str(e))
+            return RecoveryListState.ERROR, None
+        if previous.files != current.files:
+            q.warning("PAR2 exists, but is out-of-date")
+            q.warning(previous.files)
+            q.warning(current.files)
+            return RecoveryListState.OUT_OF_DATE, previous
+        modified = previous.modified(current)
+        if modified:
+            q.info(f"PAR2 exists, but {len(modified)} file(s) were modified since it was created")
+            return RecoveryListState.MODIFIED, previous
+        q.info("PAR2 exists, and is up-to-date")
+        return RecoveryListState.UP_TO_DATE, previous
+
+    def par2_args(self, files, threads, recovery_name=None):
+        thread_args = [f'-t{threads}'] if self.set_threads else []
+        return ['par2', self.COMMAND] + self.args + thread_args + ['--', f'{recovery_name or self.recovery_name}'] + [x.name for x in files]
 
     def run_par2(self, q, dir, args):
         # q.info(args)
@@ -82,33 +203,149 @@ class Par2Operation(Operation):
         return False
 
     def initialize(self, q, dir):
-        self.root_args = args = ['par2', self.COMMAND] + self.args + ['--', f'{self.recovery_name}']
+        self.root = dir
+        self.root_args = ['par2', self.COMMAND] + self.args + ['--', f'{self.recovery_name}']
         q.info(f"{self.VERB} par2 files: {' '.join(self.root_args + ['[files...]'])}")
+        limits = f"{self.threads.total} par2 thread(s)"
+        if self.processes:
+            limits += f" and {self.processes.total} par2 process(es)"
+        q.info(f"Directories will be processed largest first once scanning completes, using up to {limits}")
+
+    def operate(self, q, dir, files):
+        self.operate_scan(q, dir, PathScanResults(directory_list=[], media_list=files, unknown_extensions=[],
+            media_stats={x: x.stat() for x in files}))
+
+    def operate_scan(self, q, dir, results):
+        if not results.media_list:
+            return
+        # Fingerprints are taken from the scan, so files changing while par2 runs are noticed next time
+        current = RecoveryList.of_stats(results.media_stats)
+        if not self.should_run(q, dir, current):
+            return
+        size = sum(st.st_size for st in results.media_stats.values())
+        device = next(iter(results.media_stats.values())).st_dev
+        with self.lock:
+            self.scheduled.append((size, dir, results.media_list, current, device))
+
+    def finalize(self, q, dir):
+        with self.lock:
+            scheduled, self.scheduled = self.scheduled, []
+        scheduled.sort(key=lambda x: x[0], reverse=True)
+        for size, dir, files, current, device in scheduled:
+            name = str(dir.relative_to(self.root)) if dir != self.root else None
+            q.submit(name, lambda q, size=size, dir=dir, files=files, current=current: self._job(q, size, dir, files, current), device=device)
+        q.wait()
+
+    def _job(self, q, size, dir, files, current):
+        if self.processes:
+            self.processes.acquire()
+        threads = self.threads.acquire(-(-size // PAR2_BYTES_PER_THREAD))
+        try:
+            self.run_dir(q, dir, files, threads, current)
+        finally:
+            self.threads.release(threads)
+            if self.processes:
+                self.processes.release()
+        q.add_metrics(bytes=size)
 
 class CreatePar2Operation(Par2Operation):
     COMMAND = 'create'
     VERB = 'Creating'
-    def operate(self, q, dir, files):
-        if self.validate_recovery_list(q, dir, files) != RecoveryListState.MISSING:
+    def __init__(self, args, recovery_name, threads=None, processes=None, hash=False) -> None:
+        super().__init__(args, recovery_name, threads=threads, processes=processes)
+        self.hash = hash
+
+    def should_run(self, q, dir, current):
+        state, previous = self.validate_recovery_list(q, dir, current)
+        if state == RecoveryListState.MODIFIED and self.same_contents(dir, previous, current):
+            # Only the metadata changed (ie: the files were touched or copied), so the PAR2 files are still good
+            for x in current.entries.values():
+                x.hash = previous.entries[x.name].hash
+            current.verified_at = previous.verified_at
+            current.write(self.recovery_list(dir))
+            q.info("Modified files have the same contents, updated the file list")
+            return False
+        return state in (RecoveryListState.MISSING, RecoveryListState.OUT_OF_DATE, RecoveryListState.MODIFIED)
+
+    def same_contents(self, dir, previous, current):
+        for name in previous.modified(current):
+            hash = previous.entries[name].hash
+            if not hash or previous.entries[name].size != current.entries[name].size or hash_file(dir / name) != hash:
+                return False
+        return True
+
+    def par2_files(self, dir, recovery_name):
+        """The PAR2 index and volume files in the directory for the given recovery name."""
+        return [Path(file.path) for file in os.scandir(dir) if file.name == f'{recovery_name}.par2' or
+            (file.name.startswith(f'{recovery_name}.vol') and file.name.endswith('.par2'))]
+
+    def run_dir(self, q, dir, files, threads, current):
+        # The new PAR2 files are created under a temporary name and only replace the previous ones once complete, so
+        # a failed create never leaves the directory without any parity data
+        new_name = f'{self.recovery_name}.automedia-new'
+        for file in self.par2_files(dir, new_name):
+            file.unlink()
+        if self.hash:
+            for x in current.entries.values():
+                x.hash = hash_file(dir / x.name)
+        if not self.run_par2(q, dir, self.par2_args(files, threads, new_name)):
+            for file in self.par2_files(dir, new_name):
+                file.unlink()
+            return
+        if not (dir / f'{new_name}.par2').exists():
+            q.warning("No PAR2 files were generated")
+            return
+        if not self.recovery_list(dir).exists() and self.par2_index(dir).exists():
+            # Without our file list, the PAR2 files present weren't created by us, so leave them alone
+            q.error(f"{self.par2_index(dir).name} already exists, but was not created by automedia")
+            for file in self.par2_files(dir, new_name):
+                file.unlink()
             return
-        args = self.root_args + [x.name for x in files]
-        if self.run_par2(q, dir, args):
-            if self.par2_index(dir).exists():
-                RecoveryList(files).write(self.recovery_list(dir))
-                q.info("Done")
-            else:
-                q.warning("No PAR2 files were generated")
+        previous = set(self.par2_files(dir, self.recovery_name)) if self.recovery_list(dir).exists() else set()
+        # Replace the previous files first, then remove any left over (ie: volumes of a different size)
+        for file in self.par2_files(dir, new_name):
+            target = dir / (self.recovery_name + file.name[len(new_name):])
+            os.replace(file, target)
+            previous.discard(target)
+        for file in previous:
+            file.unlink()
+        current.write(self.recovery_list(dir))
+        q.info("Done")
 
+"""
+Directories whose files all match the fingerprints in the file list, and which were verified less than `max_age`
+seconds ago, are skipped unless `force` is set.
+"""
 class VerifyPar2Operation(Par2Operation):
     COMMAND = 'verify'
     VERB = 'Verifying'
-    def operate(self, q, dir, files):
-        if self.validate_recovery_list(q, dir, files) != RecoveryListState.UP_TO_DATE:
+    def __init__(self, args, recovery_name, threads=None, processes=None, max_age=None, force=False) -> None:
+        super().__init__(args, recovery_name, threads=threads, processes=processes)
+        self.max_age = max_age
+        self.force = force
+
+    def should_run(self, q, dir, current):
+        state, previous = self.validate_recovery_list(q, dir, current)
+        if state not in (RecoveryListState.UP_TO_DATE, RecoveryListState.MODIFIED):
             q.warning("Unable to verify directory")
-            return
-        args = self.root_args + [x.name for x in files]
-        if self.run_par2(q, dir, args):
+            return False
+        if state == RecoveryListState.UP_TO_DATE and not self.force and previous.verified_at is not None and \
+                (self.max_age is None or time.time() - previous.verified_at < self.max_age):
+            q.info("Unchanged since it was last verified, skipping")
+            return False
+        return True
+
+    def run_dir(self, q, dir, files, threads, current):
+        started = time.time()
+        if self.run_par2(q, dir, self.par2_args(files, threads)):
             # If the user requested removal of PAR2 files, we should unlink our recovery list too
             if not self.par2_index(dir).exists():
                 q.warning("PAR2 files were removed after verification")
                 os.unlink(self.recovery_list(dir))
+                return
+            # The contents match the PAR2 files, so any recorded hashes are still correct. This also upgrades v1 lists.
+            previous = RecoveryList.read(self.recovery_list(dir))
+            for x in current.entries.values():
+                x.hash = previous.entries[x.name].hash if x.name in previous.entries else None
+            current.verified_at = started
+            current.write(self.recovery_list(dir))
@@ -1,11 +1,13 @@
-from ntpath import realpath
 import os
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from stat import S_ISDIR, S_ISREG, S_ISLNK
-from typing import Callable, List
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Dict, List, Optional
+
+from .cache import FileFingerprint
+from .index import PathIndex
 
 class EntryType(Enum):
     DIR = 0
@@ -26,74 +28,157 @@ class PathScanResults:
     directory_list: List[Path]
     media_list: List[Path]
     unknown_extensions: List[str]
+    # The stat of each media file, as seen while scanning (following symlinks)
+    media_stats: Dict[Path, os.stat_result] = field(default_factory=dict)
+    # When scanning with an index: the fingerprints of this directory's media files when it was last indexed (None
+    # if it has never been indexed), and the media files under subdirectories that have since disappeared
+    previous_media: Optional[Dict[Path, FileFingerprint]] = None
+    removed: List[Path] = field(default_factory=list)
 
 class PathScanner:
     def __init__(self,
         symlink_mode = SymlinkMode.Warn,
         supported_extension_matcher: Callable[[Path], bool] = None,
         ignored_pattern_matcher: Callable[[Path], bool] = None,
-        spam_files_matcher: Callable[[Path], bool] = None) -> None:
+        spam_files_matcher: Callable[[Path], bool] = None,
+        index: PathIndex = None) -> None:
 
         self.symlink_warned = False
+        self.index = index
         self.symlink_mode = symlink_mode
         self.supported_extension_matcher = supported_extension_matcher
         self.ignored_pattern_matcher = ignored_pattern_matcher
         self.spam_files_matcher = spam_files_matcher
 
     def scan(self, q, dir):
+        if self.index:
+            return self._scan_indexed(q, dir)
+        return self._scan(q, dir)[0]
+
+    def subdirectories(self, q, dir):
+        """The subdirectories that a scan of `dir` would visit, without reading or updating the index."""
+        return self._scan(q, dir)[0].directory_list
+
+    def _scan_indexed(self, q, dir):
+        try:
+            mtime_ns = os.stat(dir).st_mtime_ns
+        except OSError:
+            return self._scan(q, dir)[0]
+        indexed = self.index.lookup(dir)
+        results = None
+        if indexed and indexed.is_current(mtime_ns):
+            results = self._reuse(dir, indexed)
+        if results:
+            reusable = True
+        else:
+            results, reusable = self._scan(q, dir)
+        if indexed:
+            results.previous_media = {dir / name: fingerprint for name, fingerprint in indexed.media.items()}
+            for name in sorted(set(indexed.subdirs) - set(x.name for x in results.directory_list)):
+                results.removed += self.index.remove_tree(dir / name)
+        self.index.store(dir, mtime_ns, reusable, results)
+        return results
+
+    def _reuse(self, dir, indexed):
+        """Rebuilds the results of a scan from the index, only re-reading the stats of media files."""
+        stats = {}
+        for name in indexed.media:
+            try:
+                stats[dir / name] = os.stat(dir / name)
+            except OSError:
+                # The directory changed without its mtime changing, so fall back to a full scan
+                return None
+        return PathScanResults(
+            directory_list=[dir / name for name in indexed.subdirs],
+            media_list=sorted(stats.keys()),
+            unknown_extensions=list(indexed.unknown_extensions),
+            media_stats=stats)
+
+    def _scan(self, q, dir):
+        """Scans a directory, returning its results and whether they can be reused later from an index."""
+        reusable = True
         files = []
         dirs = []
+        stats = {}
         unknown_extensions = set()
-        for f in os.listdir(dir):
-            filename = dir / f
-            if self.ignored_pattern_matcher(filename):
-                continue
-            try:
-                st = os.lstat(filename)
-            except Exception as e:
-                q.error(f"Unrecoverable filesystem error while trying to read {f} ({e})")
-                continue
-
-            if S_ISLNK(st.st_mode):
-                if self.symlink_mode == SymlinkMode.Error:
-                    q.error(f"Found unexpected symlink: {filename}")
+        try:
+            entries = os.scandir(dir)
+        except OSError as e:
+            q.error(f"Unrecoverable filesystem error while trying to list {dir} ({e})")
+            return PathScanResults(directory_list=[], media_list=[], unknown_extensions=[]), False
+        with entries:
+            for entry in entries:
+                filename = dir / entry.name
+                if self.ignored_pattern_matcher(filename):
                     continue
-                elif self.symlink_mode == SymlinkMode.Warn:
-                    if not self.symlink_warned:
-                        q.warning(f"Ignoring symlinks, pass --symlinks=allow to allow this behavior")
-                        self.symlink_warned = True
-                    continue
-                elif self.symlink_mode in [SymlinkMode.Allow, SymlinkMode.AllowDir, SymlinkMode.AllowFile]:
-                    pass
-                elif self.symlink_mode == SymlinkMode.Ignore:
-                    continue
-                else:
-                    raise Exception(f"Unexpected symlink mode: {self.symlink_mode}")
-                # Stat the underlying file or directory
-                st = os.stat(filename)
-                # Assume that the user only wanted the symlink type specified
-                if S_ISREG(st.st_mode) and self.symlink_mode == SymlinkMode.AllowDir:
-                    q.error(f"File symlink found and only directories are allowed: {filename}")
-                    continue
-                elif S_ISDIR(st.st_mode) and self.symlink_mode == SymlinkMode.AllowFile:
-                    q.error(f"Directory symlink found and only files are allowed: {filename}")
+                try:
+                    if entry.is_symlink():
+                        # Symlinks may log, and their targets can change without this directory changing
+                        reusable = False
+                        st = self._follow_symlink(q, filename)
+                        if st is None:
+                            continue
+                        is_dir, is_file = S_ISDIR(st.st_mode), S_ISREG(st.st_mode)
+                    else:
+                        # The directory entry's type is usually known without a stat call
+                        is_dir, is_file = entry.is_dir(follow_symlinks=False), entry.is_file(follow_symlinks=False)
+                        st = None
+                    if is_dir:
+                        # Ignore zero-length directories (only possible on some filesystems, and always empty)
+                        if st is None or st.st_size != 0:
+                            dirs.append(filename)
+                        continue
+                    if not is_file:
+                        continue
+                    is_media = self.supported_extension_matcher(filename)
+                    if not is_media and (not filename.suffix or filename.suffix in unknown_extensions):
+                        # Nothing more to learn about this file, so avoid the stat
+                        continue
+                    if st is None:
+                        st = entry.stat(follow_symlinks=False)
+                except Exception as e:
+                    q.error(f"Unrecoverable filesystem error while trying to read {entry.name} ({e})")
+                    reusable = False
                     continue
 
-            # Ignore zero-length files
-            if st.st_size == 0:
-                continue
-            if S_ISREG(st.st_mode):
-                if self.supported_extension_matcher(filename):
+                # Ignore zero-length files
+                if st.st_size == 0:
+                    continue
+                if is_media:
                     files.append(filename)
+                    stats[filename] = st
                 else:
-                    if filename.suffix:
-                        unknown_extensions.add(filename.suffix)
-            elif S_ISDIR(st.st_mode):
-                dirs.append(filename)
-            pass
+                    unknown_extensions.add(filename.suffix)
         unknown_extensions = list(unknown_extensions)
         unknown_extensions.sort()
         files.sort()
         dirs.sort()
 
-        return PathScanResults(directory_list=dirs, media_list=files, unknown_extensions=unknown_extensions)
+        return PathScanResults(directory_list=dirs, media_list=files, unknown_extensions=unknown_extensions, media_stats=stats), reusable
+
+    def _follow_symlink(self, q, filename):
+        """Applies the symlink mode to a symlink, returning the stat of its target if it should be processed."""
+        if self.symlink_mode == SymlinkMode.Error:
+            q.error(f"Found unexpected symlink: {filename}")
+            return None
+        elif self.symlink_mode == SymlinkMode.Warn:
+            if not self.symlink_warned:
+                q.warning(f"Ignoring symlinks, pass --symlinks=allow to allow this behavior")
+                self.symlink_warned = True
+            return None
+        elif self.symlink_mode in [SymlinkMode.Allow, SymlinkMode.AllowDir, SymlinkMode.AllowFile]:
+            pass
+        elif self.symlink_mode == SymlinkMode.Ignore:
+            return None
+        else:
+            raise Exception(f"Unexpected symlink mode: {self.symlink_mode}")
+        # Stat the underlying file or directory
+        st = os.stat(filename)
+        # Assume that the user only wanted the symlink type specified
+        if S_ISREG(st.st_mode) and self.symlink_mode == SymlinkMode.AllowDir:
+            q.error(f"File symlink found and only directories are allowed: {filename}")
+            return None
+        elif S_ISDIR(st.st_mode) and self.symlink_mode == SymlinkMode.AllowFile:
+            q.error(f"Directory symlink found and only files are allowed: {filename}")
+            return None
+        return st
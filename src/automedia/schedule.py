@@ -0,0 +1,48 @@
+import random
+
+from enum import Enum
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from .cache import FileFingerprint
+
+class ScheduleOrder(Enum):
+    # The order files were found in while scanning
+    Scan = "scan"
+    # Files never verified first, then those verified longest ago
+    LeastRecentlyVerified = "least-recently-verified"
+    # Biggest files first, so the run doesn't end waiting on one large straggler
+    LargestFirst = "largest-first"
+    Random = "random"
+    # Random order, spread so that each top-level directory is checked in proportion to its number of files
+    Stratified = "stratified"
+
+def stratum(file: Path, root: Path):
+    parts = file.relative_to(root).parts
+    return parts[0] if len(parts) > 1 else ''
+
+"""
+Orders (file, fingerprint, ...) tuples according to `order`. `last_verified(file)` returns the time a file was last
+verified (0 if never), and is only needed for `ScheduleOrder.LeastRecentlyVerified`.
+"""
+def schedule(files: List[Tuple[Path, FileFingerprint]], order: ScheduleOrder, root: Path, last_verified: Callable[[Path], float] = None, rng=random):
+    if order == ScheduleOrder.LeastRecentlyVerified:
+        return sorted(files, key=lambda x: last_verified(x[0]))
+    if order == ScheduleOrder.LargestFirst:
+        return sorted(files, key=lambda x: x[1].size, reverse=True)
+    if order == ScheduleOrder.Random:
+        files = list(files)
+        rng.shuffle(files)
+        return files
+    if order == ScheduleOrder.Stratified:
+        strata = {}
+        for x in files:
+            strata.setdefault(stratum(x[0], root), []).append(x)
+        keyed = []
+        for group in strata.values():
+            rng.shuffle(group)
+            # Spread each group evenly (with jitter) across the whole schedule
+            keyed += [((i + rng.random()) / len(group), x) for i, x in enumerate(group)]
+        keyed.sort(key=lambda x: x[0])
+        return [x for _, x in keyed]
+    return list(files)
@@ -0,0 +1,231 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Condition, Thread
+from typing import Dict, Set
+
+from .path_scan import PathScanner
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+"""
+Events watched on every directory. Modifications don't mark a file as changed (that waits for it to be closed), but
+they do hold back the batch, so a slow copy isn't processed half-written.
+"""
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+"""
+How often the event thread checks whether it has been stopped.
+"""
+POLL_INTERVAL = 0.5
+
+DEFAULT_DEBOUNCE_SECONDS = 30
+DEFAULT_RECONCILE_HOURS = 24
+
+"""
+Minimal inotify binding through ctypes, as the standard library has none.
+"""
+class Inotify:
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError("inotify is not available on this platform")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, f"Failed to start watching for changes ({os.strerror(e)})")
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        # Fails harmlessly if the watch was already removed by the kernel
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Returns the available events as (watch, mask, name) tuples, waiting up to `timeout` for any to arrive."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            events.append((wd, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+"""
+Changes seen since the last batch: directories whose media files changed (with the names of the files written, which
+may be none if files were only removed), and new directories whose whole tree needs processing. `reconcile` is set
+when the whole tree must be processed instead, either because it is due or because events were lost.
+"""
+@dataclass
+class WatchBatch:
+    changes: Dict[Path, Set[str]] = field(default_factory=dict)
+    trees: Set[Path] = field(default_factory=set)
+    reconcile: bool = False
+
+"""
+Watches every directory under the root that the scanner would visit (so the ignore patterns and symlink mode apply),
+collecting changes into batches. A batch is handed out once no events have arrived for `debounce` seconds, and a
+full reconcile is asked for every `reconcile_interval` seconds, to pick up anything the watches missed.
+
+Events are read on a background thread so that the kernel's event queue doesn't overflow during a long run, while
+directories are only ever scanned from the caller's thread.
+"""
+class Watcher:
+    def __init__(self, root: Path, scanner: PathScanner, debounce=DEFAULT_DEBOUNCE_SECONDS, reconcile_interval=DEFAULT_RECONCILE_HOURS * 3600) -> None:
+        self.root = root
+        self.scanner = scanner
+        self.debounce = debounce
+        self.reconcile_interval = reconcile_interval
+        self.inotify = Inotify()
+        self.cond = Condition()
+        self.watches: Dict[int, Path] = {}
+        self.batch = WatchBatch()
+        self.last_event = 0
+        self.next_reconcile = time.monotonic() + reconcile_interval
+        self.watch_failed = False
+        self.stopped = False
+        self.thread = Thread(target=self._loop, name="watch", daemon=True)
+        self.thread.start()
+
+    def watch_tree(self, q, dir: Path):
+        """Watches the directory and every directory below it. Directories that are already watched are skipped over."""
+        dirs = [dir]
+        while dirs:
+            dir = dirs.pop()
+            try:
+                wd = self.inotify.add_watch(dir, WATCH_MASK)
+            except OSError as e:
+                # Usually the fs.inotify.max_user_watches limit; the periodic reconcile still covers these directories
+                if not self.watch_failed:
+                    q.warning(f"Failed to watch {dir} for changes, changes to it will only be picked up by the periodic reconcile ({e})")
+                    self.watch_failed = True
+                continue
+            with self.cond:
+                self.watches[wd] = dir
+            dirs += self.scanner.subdirectories(q, dir)
+
+    def watch_new_trees(self, q, batch: WatchBatch):
+        """
+        Watches the new directories in the batch, and returns those that a scan of their parent would visit. Trees
+        inside other new trees, and changes inside any of them, are dropped as they are covered by processing the tree.
+        """
+        trees = []
+        for tree in sorted(batch.trees):
+            if any(x == tree or x in tree.parents for x in trees):
+                continue
+            if tree.is_dir() and tree in self.scanner.subdirectories(q, tree.parent):
+                self.watch_tree(q, tree)
+                trees.append(tree)
+        batch.changes = {dir: names for dir, names in batch.changes.items() if not any(x == dir or x in dir.parents for x in trees)}
+        return trees
+
+    def next_batch(self) -> WatchBatch:
+        """Waits until the changes seen have settled for the debounce time, or a reconcile is due."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if now >= self.next_reconcile:
+                    self.batch.reconcile = True
+                pending = self.batch.changes or self.batch.trees
+                if self.batch.reconcile or (pending and now - self.last_event >= self.debounce):
+                    break
+                deadline = min(self.next_reconcile, self.last_event + self.debounce) if pending else self.next_reconcile
+                self.cond.wait(deadline - now)
+            batch, self.batch = self.batch, WatchBatch()
+            if batch.reconcile:
+                self.next_reconcile = now + self.reconcile_interval
+            return batch
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+        self.inotify.close()
+
+    def _loop(self):
+        while not self.stopped:
+            events = self.inotify.read(POLL_INTERVAL)
+            if not events:
+                continue
+            with self.cond:
+                for wd, mask, name in events:
+                    self._on_event(wd, mask, name)
+                self.cond.notify_all()
+
+    def _on_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.batch.reconcile = True
+            return
+        dir = self.watches.get(wd)
+        if dir is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        self.last_event = time.monotonic()
+        # A directory that is removed or moved is handled through the event on its parent
+        if not name:
+            return
+        path = dir / name
+        if self.scanner.ignored_pattern_matcher(path):
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.batch.trees.add(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+                self.batch.changes.setdefault(dir, set())
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.batch.changes.setdefault(dir, set()).add(name)
+        elif mask & IN_CREATE and path.is_symlink():
+            # Symlinks are never written to, so they are complete as soon as they are created. Whether they are
+            # followed is up to the scanner.
+            if path.is_dir():
+                self.batch.trees.add(path)
+            else:
+                self.batch.changes.setdefault(dir, set()).add(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.batch.changes.setdefault(dir, set())
+
+    def _unwatch_tree(self, path: Path):
+        # Watches follow a directory when it moves, so stop watching a tree that was moved away
+        for wd, dir in list(self.watches.items()):
+            if dir == path or path in dir.parents:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
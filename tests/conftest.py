@@ -0,0 +1,6 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keeps the default cache file and run journals of every test out of the user's real cache directory."""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
@@ -0,0 +1,53 @@
+from automedia.cache import CacheDatabase, ChecksumAlgorithm, ChecksumManifest, FileFingerprint, VerificationCache
+import os
+
+def test_verification_cache(tmp_path):
+    file = tmp_path / 'media' / 'file.mp3'
+    file.parent.mkdir()
+    file.write_bytes(b'1234')
+    cache = VerificationCache(CacheDatabase(tmp_path / 'cache.sqlite'), tmp_path / 'media')
+    fingerprint = FileFingerprint.of(file)
+    assert cache.last_verified(file, fingerprint) is None
+    cache.record_good(file, fingerprint)
+    assert cache.last_verified(file, fingerprint) is not None
+
+    # Re-opening the cache should see the same state
+    cache.db.close()
+    cache = VerificationCache(CacheDatabase(tmp_path / 'cache.sqlite'), tmp_path / 'media')
+    assert cache.last_verified(file, fingerprint) is not None
+
+    # Any change to the file invalidates the entry
+    os.utime(file, ns=(0, 0))
+    assert cache.last_verified(file, FileFingerprint.of(file)) is None
+
+    cache.record_bad(file)
+    assert cache.last_verified(file, fingerprint) is None
+
+def test_checksum_manifest(tmp_path):
+    file = tmp_path / 'file.mp3'
+    file.write_bytes(b'1234')
+    checksums = ChecksumManifest(CacheDatabase(tmp_path / 'cache.sqlite'), tmp_path, ChecksumAlgorithm.Blake2b)
+    fingerprint = FileFingerprint.of(file)
+    assert checksums.check(file, fingerprint, 'aaaa')
+    assert checksums.check(file, fingerprint, 'aaaa')
+    # Same metadata, different contents
+    assert not checksums.check(file, fingerprint, 'bbbb')
+    assert not checksums.check(file, fingerprint, 'bbbb')
+    # A legitimate modification changes the metadata too
+    os.utime(file, ns=(0, 0))
+    assert checksums.check(file, FileFingerprint.of(file), 'bbbb')
+
+def test_verification_levels(tmp_path):
+    file = tmp_path / 'file.mp3'
+    file.write_bytes(b'1234')
+    fingerprint = FileFingerprint.of(file)
+    db = CacheDatabase(tmp_path / 'cache.sqlite')
+    # A cache from before levels were recorded only contains full verifications
+    db.execute('CREATE TABLE verified (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, verified_at REAL NOT NULL)')
+    db.execute('INSERT INTO verified VALUES (?, ?, ?, ?, ?)', ('file.mp3', fingerprint.size, fingerprint.mtime_ns, fingerprint.inode, 1.0))
+    cache = VerificationCache(db, tmp_path)
+    assert cache.last_verified(file, fingerprint) == 1.0
+
+    cache.record_good(file, fingerprint, level=0)
+    assert cache.last_verified(file, fingerprint, level=0) is not None
+    assert cache.last_verified(file, fingerprint) is None
@@ -0,0 +1,53 @@
+from automedia import catalog, main
+from automedia.ffprobe import MediaInfo
+import csv
+import pytest
+
+PROBE = {
+    'format': {'format_name': 'mov,mp4,m4a,3gp,3g2,mj2', 'duration': '95.5', 'bit_rate': '65432'},
+    'streams': [
+        {'codec_type': 'video', 'codec_name': 'mjpeg', 'width': 500, 'height': 500, 'disposition': {'attached_pic': 1}},
+        {'codec_type': 'audio', 'codec_name': 'aac', 'bit_rate': '64000', 'channels': 2, 'sample_rate': '44100'},
+    ],
+}
+
+@pytest.fixture
+def fake_ffprobe(monkeypatch):
+    probed = []
+    def ffprobe(file):
+        probed.append(file.name)
+        if file.name.startswith('bad'):
+            return None, ["Invalid data found when processing input"]
+        return PROBE, []
+    monkeypatch.setattr(catalog, 'ffprobe', ffprobe)
+    return probed
+
+def test_media_info():
+    info = MediaInfo.of(PROBE)
+    assert info.container.startswith('mov')
+    assert info.duration == 95.5
+    assert (info.audio_codec, info.audio_bitrate, info.channels, info.sample_rate) == ('aac', 64000, 2, 44100)
+    # Cover art isn't a video stream
+    assert info.video_codec is None
+    assert MediaInfo.of({}) == MediaInfo()
+
+def test_catalog(tmp_path, fake_ffprobe):
+    root = tmp_path / 'root'
+    root.mkdir()
+    for name in ['a.m4a', 'b.m4a', 'bad.mp3', 'notes.pdf']:
+        (root / name).write_bytes(b'data')
+    export = tmp_path / 'catalog.csv'
+    args = ['', '--root', str(root), '--cache-file', str(tmp_path / 'cache.sqlite'), 'catalog', '--export', str(export)]
+    assert main.do_main(args) == 1
+    assert sorted(fake_ffprobe) == ['a.m4a', 'b.m4a', 'bad.mp3']
+
+    # Only new and changed files are probed again
+    fake_ffprobe.clear()
+    (root / 'b.m4a').write_bytes(b'changed')
+    (root / 'a.m4a').unlink()
+    (root / 'bad.mp3').unlink()
+    assert main.do_main(args) == 0
+    assert fake_ffprobe == ['b.m4a']
+    with open(export, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [(x['path'], x['size'], x['audio_codec']) for x in rows] == [('b.m4a', '7', 'aac')]
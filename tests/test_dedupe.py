@@ -0,0 +1,32 @@
+from automedia import main
+from automedia.cache import CacheDatabase, ContentIndex, FileFingerprint
+from automedia.dedupe import PARTIAL_HASH_BYTES
+import os
+
+def test_dedupe(tmp_path, capsys):
+    root = tmp_path / 'root'
+    (root / 'a').mkdir(parents=True)
+    (root / 'b').mkdir()
+    data = os.urandom(4 * PARTIAL_HASH_BYTES)
+    (root / 'a/1.mp3').write_bytes(data)
+    (root / 'b/1.mp3').write_bytes(data)
+    os.link(root / 'a/1.mp3', root / 'a/link.mp3')
+    # Same size, head and tail, but different in the middle
+    (root / 'b/2.mp3').write_bytes(data[:PARTIAL_HASH_BYTES * 2] + b'x' + data[PARTIAL_HASH_BYTES * 2 + 1:])
+    (root / 'a/small.flac').write_bytes(b'small')
+    (root / 'b/small.flac').write_bytes(b'small')
+    cache_file = tmp_path / 'cache.sqlite'
+
+    assert main.do_main(['', '--root', str(root), '--cache-file', str(cache_file), 'dedupe']) == 0
+    out = capsys.readouterr().out
+    assert '2 set(s) of duplicates, 2 redundant copies' in out
+    assert ':   b/2.mp3' not in out
+    assert ':   a/link.mp3' not in out
+
+    index = ContentIndex(CacheDatabase(cache_file), root)
+    duplicates = index.duplicates(root / 'b/1.mp3', FileFingerprint.of(root / 'b/1.mp3'))
+    assert sorted(x[0] for x in duplicates) == [root / 'a/1.mp3', root / 'a/link.mp3']
+    assert index.duplicates(root / 'b/2.mp3', FileFingerprint.of(root / 'b/2.mp3')) == []
+    # Once the file changes, it's no longer known to be a duplicate
+    (root / 'b/1.mp3').write_bytes(data[:-1] + b'x')
+    assert index.duplicates(root / 'b/1.mp3', FileFingerprint.of(root / 'b/1.mp3')) == []
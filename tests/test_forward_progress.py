@@ -0,0 +1,54 @@
+from automedia.forward_progress import InputMode, RingBuffer, subprocess_forward_progress
+from automedia.jobqueue import JobQueue
+import hashlib
+import shutil
+import pytest
+
+MEDIA = 'tests/media/good.mp3'
+
+@pytest.mark.parametrize("mode", list(InputMode))
+def test_success(mode):
+    progress = []
+    errors = subprocess_forward_progress(MEDIA, ['cat'], shutil.which('cat'), progress_callback=progress.append, input_mode=mode)
+    assert errors == []
+    assert progress[-1] == 1
+
+@pytest.mark.parametrize("mode", list(InputMode))
+def test_exit_code(mode):
+    errors = subprocess_forward_progress(MEDIA, ['script'], 'tests/script-exit-1', input_mode=mode)
+    assert "Process failed with exit code 1" in errors
+
+@pytest.mark.parametrize("mode", list(InputMode))
+def test_error_stream(mode):
+    errors = subprocess_forward_progress(MEDIA, ['script'], 'tests/script-print-error', input_mode=mode)
+    assert errors == ["Process wrote to error stream: ERROR\n"]
+
+@pytest.mark.parametrize("mode", list(InputMode))
+def test_timeout(mode):
+    errors = subprocess_forward_progress(MEDIA, ['script'], 'tests/script-sleep', timeout=1, input_mode=mode)
+    assert errors == ["Process timed out reading from input stream"]
+
+@pytest.mark.parametrize("mode", list(InputMode))
+def test_missing_input(mode, tmp_path):
+    errors = subprocess_forward_progress(tmp_path / 'missing.mp3', ['cat'], shutil.which('cat'), input_mode=mode)
+    assert len(errors) == 1 and errors[0].startswith("Failed to start process")
+
+def test_hashing():
+    hasher = hashlib.sha256()
+    assert subprocess_forward_progress(MEDIA, ['cat'], shutil.which('cat'), hasher=hasher) == []
+    with open(MEDIA, 'rb') as f:
+        assert hasher.hexdigest() == hashlib.sha256(f.read()).hexdigest()
+
+def test_concurrent():
+    q = JobQueue(jobs=16)
+    results = []
+    for i in range(64):
+        q.submit(str(i), lambda q: results.append(subprocess_forward_progress(MEDIA, ['cat'], shutil.which('cat'))))
+    q.wait()
+    assert results == [[]] * 64
+
+def test_stderr_is_bounded():
+    buffer = RingBuffer(limit=10)
+    for i in range(100):
+        buffer.append(b'0123456789')
+    assert buffer.getvalue() == b'[990 bytes truncated]...0123456789'
@@ -0,0 +1,58 @@
+from automedia import main
+from automedia.cache import CacheDatabase
+from automedia.index import PathIndex
+from automedia.jobqueue import JobQueue
+from automedia.path_scan import PathScanner, SymlinkMode
+import os
+
+def make_tree(root):
+    for dir in ['a', 'a/b', 'c']:
+        (root / dir).mkdir(parents=True)
+    for file in ['1.mp3', 'a/2.flac', 'a/b/3.mp4', 'c/4.jpg']:
+        (root / file).write_bytes(b'data')
+
+def age(root):
+    # Move mtimes outside of the racy window so directory listings can be reused
+    for dir, _, _ in os.walk(root):
+        os.utime(dir, (0, 0))
+
+def test_changes(tmp_path, capsys):
+    root = tmp_path / 'root'
+    make_tree(root)
+    args = ['', '--root', str(root), '--cache-file', str(tmp_path / 'cache.sqlite'), 'changes']
+    assert main.do_main(args) == 0
+    assert 'Indexed 4 file(s)' in capsys.readouterr().out
+
+    (root / 'a/new.mp3').write_bytes(b'new')
+    (root / 'c/4.jpg').write_bytes(b'changed')
+    (root / 'a/b/3.mp4').unlink()
+    os.rmdir(root / 'a/b')
+    assert main.do_main(args) == 0
+    out = capsys.readouterr().out
+    assert 'Added: new.mp3' in out
+    assert 'Modified: 4.jpg' in out
+    assert 'Removed: b/3.mp4' in out
+    assert '1 added, 1 modified, 1 removed file(s)' in out
+
+    assert main.do_main(args) == 0
+    assert '0 added, 0 modified, 0 removed file(s)' in capsys.readouterr().out
+
+def test_unchanged_directories_are_not_listed(tmp_path, monkeypatch):
+    make_tree(tmp_path / 'root')
+    age(tmp_path / 'root')
+    index = PathIndex(CacheDatabase(tmp_path / 'cache.sqlite'), tmp_path / 'root', 'config')
+    scanner = PathScanner(
+        symlink_mode=SymlinkMode.Ignore,
+        supported_extension_matcher=lambda p: p.suffix != '.txt',
+        ignored_pattern_matcher=lambda p: False,
+        index=index)
+    q = JobQueue()
+    first = [scanner.scan(q, tmp_path / 'root' / dir) for dir in ['', 'a', 'c']]
+
+    def fail(*args):
+        raise Exception("Directory was re-read")
+    monkeypatch.setattr(os, 'scandir', fail)
+    second = [scanner.scan(q, tmp_path / 'root' / dir) for dir in ['', 'a', 'c']]
+    for a, b in zip(first, second):
+        assert a.media_list == b.media_list
+        assert a.directory_list == b.directory_list
@@ -0,0 +1,100 @@
+from automedia import main
+from automedia.jobqueue import JobQueue, LogFormat, LOG_BUFFER_LINES
+from threading import Barrier, Lock
+import json
+import pytest
+import time
+
+def submit_tree(q, depth, width, visited, lock):
+    if depth == 0:
+        with lock:
+            visited.append(q._name())
+        return
+    for i in range(width):
+        q.submit(str(i), lambda q: submit_tree(q, depth - 1, width, visited, lock))
+    q.wait()
+
+@pytest.mark.parametrize("jobs", [1, 2, 8])
+def test_nested_jobs(jobs):
+    q = JobQueue(jobs=jobs)
+    visited = []
+    q.submit(None, lambda q: submit_tree(q, 3, 3, visited, Lock()))
+    q.wait()
+    assert len(visited) == 27
+    assert len(set(visited)) == 27
+
+def test_jobs_run_in_parallel():
+    q = JobQueue(jobs=4)
+    barrier = Barrier(4, timeout=10)
+    for i in range(4):
+        q.submit(str(i), lambda q: barrier.wait())
+    q.wait()
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_error_count(jobs):
+    q = JobQueue(jobs=jobs)
+    for i in range(100):
+        q.submit(str(i), lambda q: q.error("failed"))
+    assert q.wait().errors == 100
+
+def test_logs_are_grouped(capsys):
+    q = JobQueue(jobs=4)
+    for i in range(20):
+        def job(q, i=i):
+            for line in range(10):
+                q.info(f"{i}-{line}")
+        q.submit(str(i), job)
+    q.wait()
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 200
+    for start in range(0, 200, 10):
+        assert len(set(line.split(':')[0] for line in lines[start:start + 10])) == 1
+
+def test_exception_propagates():
+    q = JobQueue(jobs=2)
+    def job(q):
+        raise ValueError("boom")
+    q.submit(None, job)
+    with pytest.raises(ValueError):
+        q.wait()
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_print_jobs(jobs):
+    result = main.do_main(['', '--symlinks=allowfile', '--root', 'tests/verify-test-2', '--jobs', str(jobs), 'print'])
+    assert result == 0
+
+def test_json_logs(capsys):
+    q = JobQueue(jobs=2, log_format=LogFormat.Json)
+    q.submit(None, lambda q: q.submit('a', lambda q: q.error("failed")) or q.submit('b', lambda q: q.error(["first", "second"])) or q.wait())
+    q.wait()
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted((x['level'], x['job'], x['message']) for x in lines) == [('error', '(root)/a', 'failed'), ('error', '(root)/b', 'first\nsecond')]
+
+def test_large_logs_are_streamed(capsys):
+    q = JobQueue()
+    def job(q):
+        for i in range(LOG_BUFFER_LINES * 2):
+            q.info(i)
+        assert len(q.logs) < LOG_BUFFER_LINES
+    q.submit(None, job)
+    q.wait()
+    assert len(capsys.readouterr().out.splitlines()) == LOG_BUFFER_LINES * 2
+
+def test_device_limit():
+    q = JobQueue(jobs=4, device_limit=lambda device: 1 if device == 'hdd' else None)
+    running = {'hdd': 0, 'ssd': 0}
+    peak = {'hdd': 0, 'ssd': 0}
+    lock = Lock()
+    def job(q, device):
+        with lock:
+            running[device] += 1
+            peak[device] = max(peak[device], running[device])
+        time.sleep(0.02)
+        with lock:
+            running[device] -= 1
+    for i in range(6):
+        for device in ['hdd', 'ssd']:
+            q.submit(f'{device}{i}', lambda q, device=device: job(q, device), device=device)
+    q.wait()
+    assert peak['hdd'] == 1
+    assert peak['ssd'] > 1
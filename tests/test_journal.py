@@ -0,0 +1,33 @@
+from automedia.journal import RunJournal
+
+def test_resume(tmp_path):
+    file = tmp_path / 'run.journal'
+    journal = RunJournal(file, tmp_path, 'verify full')
+    journal.record(tmp_path / 'a.mp3', 'good')
+    journal.record(tmp_path / 'sub' / 'b.mp3', 'bad')
+    journal.close()
+    # Simulate being interrupted part way through writing a line
+    with open(file, 'a') as f:
+        f.write('{"file": "c.mp3", "out')
+
+    journal = RunJournal(file, tmp_path, 'verify full', resume=True)
+    assert journal.outcome(tmp_path / 'a.mp3') == 'good'
+    assert journal.outcome(tmp_path / 'sub' / 'b.mp3') == 'bad'
+    assert journal.outcome(tmp_path / 'c.mp3') is None
+    # Entries after the cut short line survive resuming again
+    journal.record(tmp_path / 'd.mp3', 'good')
+    journal.close()
+    journal = RunJournal(file, tmp_path, 'verify full', resume=True)
+    assert journal.outcome(tmp_path / 'd.mp3') == 'good'
+    journal.close(completed=True)
+    assert not file.exists()
+
+def test_different_config_is_not_resumed(tmp_path):
+    file = tmp_path / 'run.journal'
+    journal = RunJournal(file, tmp_path, 'verify full')
+    journal.record(tmp_path / 'a.mp3', 'good')
+    journal.close()
+    journal = RunJournal(file, tmp_path, 'verify quick', resume=True)
+    assert journal.resumed_from is None
+    assert journal.outcome(tmp_path / 'a.mp3') is None
+    journal.close()
@@ -0,0 +1,32 @@
+from automedia.jobqueue import JobQueue
+from automedia.metrics import MetricsFormat
+import json
+import time
+
+def run_jobs():
+    q = JobQueue(jobs=2)
+    for i in range(20):
+        def job(q, i=i):
+            time.sleep(i / 1000)
+            q.add_metrics(bytes=1024 * 1024 * i, cpu_seconds=0.5)
+        q.submit(str(i), job)
+    q.submit('untracked', lambda q: None)
+    q.wait()
+    return q
+
+def test_summary(tmp_path):
+    q = run_jobs()
+    summary = q.pool.metrics.summary()
+    assert summary['jobs'] == 20
+    assert summary['bytes'] == 1024 * 1024 * 190
+    assert summary['cpu_seconds']['sum'] == 10
+    assert summary['slowest'][0]['job'] == '(root)/19'
+    assert len(summary['slowest']) == 10
+    assert q.pool.metrics.summary_lines()[0].startswith('Processed 20 file(s), 190MB')
+
+    q.pool.metrics.write(tmp_path / 'metrics.json', MetricsFormat.Json)
+    assert json.loads((tmp_path / 'metrics.json').read_text())['jobs'] == 20
+    q.pool.metrics.write(tmp_path / 'metrics.prom', MetricsFormat.Prometheus)
+    prom = (tmp_path / 'metrics.prom').read_text()
+    assert 'automedia_jobs_total 20\n' in prom
+    assert 'automedia_job_cpu_seconds_sum 10.0\n' in prom
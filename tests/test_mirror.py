@@ -0,0 +1,48 @@
+from automedia import main, mirror
+from automedia.mirror import is_identical, place_file
+import errno
+import os
+
+def test_place_file(tmp_path):
+    source = tmp_path / 'cover.jpg'
+    data = os.urandom(3 * 1024 * 1024 + 1)
+    source.write_bytes(data)
+    target = tmp_path / 'copy.jpg'
+    assert not is_identical(source, target)
+    assert place_file(source, target) in ['reflinked', 'copied']
+    assert target.read_bytes() == data
+    assert is_identical(source, target)
+    assert place_file(source, tmp_path / 'link.jpg', link=True) == 'linked'
+    assert is_identical(source, tmp_path / 'link.jpg')
+    assert not list(tmp_path.glob('.automedia-partial-*'))
+
+def test_transcode_companions(tmp_path, capsys):
+    root = tmp_path / 'root'
+    (root / 'album').mkdir(parents=True)
+    (root / 'album/cover.jpg').write_bytes(b'cover')
+    (root / 'album/notes.pdf').write_bytes(b'notes')
+    out = tmp_path / 'out'
+    args = ['', '--root', str(root), 'transcode', '--preset', 'aac-64k', '--output', str(out), '--prune', '--companions', 'copy']
+    assert main.do_main(args) == 0
+    assert '2 companion file(s) mirrored, 0 already identical' in capsys.readouterr().out
+    assert (out / 'album/cover.jpg').read_bytes() == b'cover'
+
+    (root / 'album/notes.pdf').unlink()
+    assert main.do_main(args) == 0
+    assert '0 companion file(s) mirrored, 1 already identical' in capsys.readouterr().out
+    assert not (out / 'album/notes.pdf').exists()
+
+def test_place_file_short_copy(tmp_path, monkeypatch):
+    def no_reflink(*args):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+    copy_file_range = os.copy_file_range
+    def short_copy(src, dst, count, offset_src, offset_dst):
+        # Stops part way through, as some filesystems do
+        return copy_file_range(src, dst, min(count, 1000), offset_src, offset_dst) if offset_src < 1000 else 0
+    monkeypatch.setattr(mirror.fcntl, 'ioctl', no_reflink)
+    monkeypatch.setattr(os, 'copy_file_range', short_copy)
+    source = tmp_path / 'cover.jpg'
+    data = os.urandom(1024 * 1024)
+    source.write_bytes(data)
+    assert place_file(source, tmp_path / 'copy.jpg') == 'copied'
+    assert (tmp_path / 'copy.jpg').read_bytes() == data
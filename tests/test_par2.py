@@ -0,0 +1,107 @@
+from automedia import main
+from automedia.par2 import Par2Operation, RecoveryList, PAR2_BYTES_PER_THREAD
+import os
+import pytest
+
+@pytest.fixture
+def fake_par2(monkeypatch):
+    runs = []
+    def run_par2(self, q, dir, args):
+        runs.append((dir.name, args))
+        if args[1] == 'create':
+            if 'fail' in dir.name:
+                q.error("PAR2 returned a non-zero errorcode: 1")
+                return False
+            name = args[args.index('--') + 1]
+            (dir / f'{name}.par2').write_bytes(b'par2')
+            (dir / f'{name}.vol00+05.par2').write_bytes(b'vol')
+        return True
+    monkeypatch.setattr(Par2Operation, 'run_par2', run_par2)
+    return runs
+
+def test_largest_directories_first(tmp_path, fake_par2):
+    for name, size in [('small', 10), ('large', PAR2_BYTES_PER_THREAD * 3), ('medium', 1000)]:
+        (tmp_path / name).mkdir()
+        with open(tmp_path / name / 'file.mp3', 'wb') as f:
+            f.truncate(size)
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', 'par2-create', '--threads', '2']) == 0
+    assert [dir for dir, _ in fake_par2] == ['large', 'medium', 'small']
+    assert [args[5] for _, args in fake_par2] == ['-t2', '-t1', '-t1']
+
+    # Everything is now up-to-date, so only verify has work to do
+    fake_par2.clear()
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', 'par2-create']) == 0
+    assert fake_par2 == []
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', '--jobs', '3', 'par2-verify']) == 0
+    assert len(fake_par2) == 3
+
+def par2(root, *args):
+    return main.do_main(['', '--root', str(root), '--no-cache'] + list(args))
+
+def test_unchanged_directories_are_not_reverified(tmp_path, fake_par2):
+    (tmp_path / 'a.mp3').write_bytes(b'a' * 100)
+    assert par2(tmp_path, 'par2-create') == 0
+    assert par2(tmp_path, 'par2-verify') == 0
+    assert len(fake_par2) == 2
+    assert par2(tmp_path, 'par2-verify') == 0
+    assert len(fake_par2) == 2
+    assert par2(tmp_path, 'par2-verify', '--force') == 0
+    assert len(fake_par2) == 3
+
+    # A modified file must be verified again
+    os.utime(tmp_path / 'a.mp3', ns=(0, 0))
+    assert par2(tmp_path, 'par2-verify') == 0
+    assert len(fake_par2) == 4
+    assert par2(tmp_path, 'par2-verify') == 0
+    assert len(fake_par2) == 4
+
+def test_create_only_regenerates_changed_contents(tmp_path, fake_par2):
+    (tmp_path / 'a.mp3').write_bytes(b'a' * 100)
+    (tmp_path / 'recovery.vol0+1.par2').write_bytes(b'stale')
+    assert par2(tmp_path, 'par2-create', '--hash') == 0
+    assert len(fake_par2) == 1
+
+    os.utime(tmp_path / 'a.mp3', ns=(0, 0))
+    assert par2(tmp_path, 'par2-create', '--hash') == 0
+    assert len(fake_par2) == 1
+    assert RecoveryList.read(tmp_path / 'recovery.filelist').entries['a.mp3'].mtime_ns == 0
+
+    (tmp_path / 'a.mp3').write_bytes(b'b' * 100)
+    assert par2(tmp_path, 'par2-create', '--hash') == 0
+    assert len(fake_par2) == 2
+    assert not (tmp_path / 'recovery.vol0+1.par2').exists()
+    assert (tmp_path / 'recovery.vol00+05.par2').exists()
+    assert not list(tmp_path.glob('*.automedia-new*'))
+
+def test_v1_file_list(tmp_path, fake_par2):
+    (tmp_path / 'a.mp3').write_bytes(b'a')
+    (tmp_path / 'recovery.par2').write_bytes(b'par2')
+    (tmp_path / 'recovery.filelist').write_text('[media-tools-v1]\na.mp3')
+    assert par2(tmp_path, 'par2-create') == 0
+    assert fake_par2 == []
+    assert par2(tmp_path, 'par2-verify') == 0
+    assert len(fake_par2) == 1
+    list = RecoveryList.read(tmp_path / 'recovery.filelist')
+    assert list.verified_at is not None
+    assert list.entries['a.mp3'].size == 1
+
+def test_failed_create_keeps_previous_files(tmp_path, fake_par2):
+    dir = tmp_path / 'fail'
+    dir.mkdir()
+    (dir / 'a.mp3').write_bytes(b'a')
+    (dir / 'recovery.par2').write_bytes(b'previous')
+    (dir / 'recovery.vol0+1.par2').write_bytes(b'previous')
+    (dir / 'recovery.filelist').write_text('[media-tools-v1]\nb.mp3')
+    assert par2(tmp_path, 'par2-create') == 1
+    assert (dir / 'recovery.par2').read_bytes() == b'previous'
+    assert (dir / 'recovery.vol0+1.par2').read_bytes() == b'previous'
+    assert sorted(x.name for x in dir.iterdir()) == ['a.mp3', 'recovery.filelist', 'recovery.par2', 'recovery.vol0+1.par2']
+
+def test_interrupted_file_list_write_is_ignored(tmp_path, fake_par2):
+    (tmp_path / 'a.mp3').write_bytes(b'a')
+    assert par2(tmp_path, 'par2-create') == 0
+    # Left behind if interrupted while writing the file list
+    (tmp_path / '.automedia-partial-recovery.filelist').write_text('partial')
+    assert par2(tmp_path, 'par2-create') == 0
+    assert len(fake_par2) == 1
+    assert 'a.mp3' in RecoveryList.read(tmp_path / 'recovery.filelist').entries
@@ -0,0 +1,74 @@
+from automedia import main
+from automedia.jobqueue import JobQueue
+from automedia.operation import Operation
+from automedia.path_scan import PathScanner, SymlinkMode
+from pathlib import Path
+from threading import Lock
+import os
+import pytest
+
+def make_scanner(symlink_mode=SymlinkMode.Allow):
+    extension_regex = main.compile_extension_regex(main.DEFAULT_EXTENSIONS)
+    ignore_regex = main.compile_ignore_regex(main.DEFAULT_IGNORE_FILES)
+    return PathScanner(
+        symlink_mode=symlink_mode,
+        supported_extension_matcher=lambda p: p.suffix and extension_regex.fullmatch(p.suffix),
+        ignored_pattern_matcher=lambda p: ignore_regex.fullmatch(p.name),
+        spam_files_matcher=lambda _: False)
+
+@pytest.fixture
+def tree(tmp_path):
+    for dir in ['a', 'a/b', 'c']:
+        (tmp_path / dir).mkdir()
+    for file in ['1.mp3', 'a/2.flac', 'a/b/3.MP4', 'c/notes.txt', 'c/.DS_Store', 'c/4.jpg']:
+        (tmp_path / file).write_bytes(b'data')
+    (tmp_path / 'empty.mp3').write_bytes(b'')
+    (tmp_path / 'empty.xyz').write_bytes(b'')
+    os.symlink(tmp_path / '1.mp3', tmp_path / 'link.mp3')
+    os.symlink(tmp_path / 'a', tmp_path / 'link-dir')
+    return tmp_path
+
+def test_scan(tree):
+    q = JobQueue()
+    results = make_scanner().scan(q, tree)
+    q.flush_logs()
+    assert results.media_list == [tree / '1.mp3', tree / 'link.mp3']
+    assert results.directory_list == [tree / 'a', tree / 'c', tree / 'link-dir']
+    assert results.unknown_extensions == []
+    assert results.media_stats[tree / 'link.mp3'].st_size == 4
+
+    results = make_scanner().scan(q, tree / 'c')
+    assert results.media_list == [tree / 'c/4.jpg']
+    assert results.unknown_extensions == ['.txt']
+
+@pytest.mark.parametrize("mode,media,dirs,errors", [
+    (SymlinkMode.Ignore, ['1.mp3'], ['a', 'c'], 0),
+    (SymlinkMode.Warn, ['1.mp3'], ['a', 'c'], 0),
+    (SymlinkMode.Error, ['1.mp3'], ['a', 'c'], 2),
+    (SymlinkMode.AllowFile, ['1.mp3', 'link.mp3'], ['a', 'c'], 1),
+    (SymlinkMode.AllowDir, ['1.mp3'], ['a', 'c', 'link-dir'], 1),
+])
+def test_symlink_modes(tree, mode, media, dirs, errors):
+    q = JobQueue()
+    results = make_scanner(mode).scan(q, tree)
+    q.flush_logs()
+    assert results.media_list == [tree / x for x in media]
+    assert results.directory_list == [tree / x for x in dirs]
+    assert q.results.errors == errors
+
+class CollectScans(Operation):
+    def __init__(self):
+        self.scans = {}
+        self.lock = Lock()
+    def operate_scan(self, q, dir, results):
+        with self.lock:
+            self.scans[dir] = results
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_process_dir(tree, jobs):
+    q = JobQueue(jobs=jobs)
+    op = CollectScans()
+    main.process_dir(q, make_scanner(SymlinkMode.Ignore), tree, op)
+    q.flush_logs()
+    assert set(op.scans.keys()) == {tree, tree / 'a', tree / 'a/b', tree / 'c'}
+    assert op.scans[tree / 'a/b'].media_list == [tree / 'a/b/3.MP4']
@@ -0,0 +1,33 @@
+from automedia.cache import FileFingerprint
+from automedia.schedule import ScheduleOrder, schedule
+from collections import Counter
+from pathlib import Path
+import random
+import pytest
+
+ROOT = Path('/media')
+
+def files(*specs):
+    return [(ROOT / name, FileFingerprint(size=size, mtime_ns=0, inode=i)) for i, (name, size) in enumerate(specs)]
+
+@pytest.mark.parametrize("order", list(ScheduleOrder))
+def test_every_file_is_scheduled(order):
+    input = files(('a/1.mp3', 3), ('a/2.mp3', 1), ('b/1.mp3', 2), ('c.mp3', 5))
+    output = schedule(input, order, ROOT, last_verified=lambda _: 0)
+    assert sorted(output) == sorted(input)
+
+def test_largest_first():
+    output = schedule(files(('1.mp3', 3), ('2.mp3', 1), ('3.mp3', 2)), ScheduleOrder.LargestFirst, ROOT)
+    assert [x[1].size for x in output] == [3, 2, 1]
+
+def test_least_recently_verified():
+    verified = {ROOT / '1.mp3': 20, ROOT / '2.mp3': 10}
+    output = schedule(files(('1.mp3', 1), ('2.mp3', 1), ('3.mp3', 1)), ScheduleOrder.LeastRecentlyVerified, ROOT, last_verified=lambda x: verified.get(x, 0))
+    assert [x[0].name for x in output] == ['3.mp3', '2.mp3', '1.mp3']
+
+def test_stratified_is_proportional():
+    input = files(*[(f'a/{i}.mp3', 1) for i in range(90)], *[(f'z/{i}.mp3', 1) for i in range(10)])
+    output = schedule(input, ScheduleOrder.Stratified, ROOT, rng=random.Random(1))
+    # Any stretch of the schedule covers both directories in proportion
+    first = Counter(x[0].parent.name for x in output[:20])
+    assert 1 <= first['z'] <= 3
@@ -1,4 +1,9 @@
-from automedia import main
+from automedia import ffmpeg_transcoder, main
+from automedia.ffprobe import MediaInfo
+from automedia.ffmpeg_transcoder import is_compatible, split_segments, transcode_threads, SMALL_FILE_SECONDS, SMALL_FILE_SIZE, SPLIT_MIN_SECONDS, SPLIT_SEGMENT_SECONDS
+from automedia.jobqueue import JobQueue
+from threading import Lock
+import os
 import pytest
 
 @pytest.mark.parametrize("dir", [1, 2])
@@ -12,3 +17,113 @@ def test_transcode_bad(tmp_path, dir):
     print(dir)
     result = main.do_main(['', '--symlinks=allowfile', '--root', f'tests/transcode-test-bad-{dir}', 'transcode', '--preset', 'aac-64k', '--output', str(tmp_path)])
     assert result == 1
+
+def test_transcode_incremental(tmp_path, capsys):
+    root = tmp_path / 'root'
+    root.mkdir()
+    for name in ['good-1.mp3', 'good-2.mp3']:
+        (root / name).write_bytes(open(f'tests/transcode-test-1/{name}', 'rb').read())
+    out = tmp_path / 'out'
+    args = ['', '--root', str(root), 'transcode', '--preset', 'aac-64k', '--output', str(out), '--incremental', '--prune']
+    assert main.do_main(args) == 0
+    assert 'up-to-date' not in capsys.readouterr().out
+    assert main.do_main(args) == 0
+    assert '2 up-to-date file(s) skipped' in capsys.readouterr().out
+
+    # Switching presets forces a re-encode
+    assert main.do_main(args[:5] + ['aac-128k'] + args[6:]) == 0
+    assert 'up-to-date' not in capsys.readouterr().out
+
+    (root / 'good-2.mp3').unlink()
+    assert main.do_main(args) == 0
+    assert (out / 'good-1.m4a').exists()
+    assert not (out / 'good-2.m4a').exists()
+
+def test_transcode_threads():
+    assert transcode_threads(1024, 180, jobs=1, cpus=16) == 1
+    assert transcode_threads(SMALL_FILE_SIZE, SMALL_FILE_SECONDS, jobs=1, cpus=16) == 16
+    assert transcode_threads(SMALL_FILE_SIZE, SMALL_FILE_SECONDS, jobs=4, cpus=16) == 4
+    assert transcode_threads(SMALL_FILE_SIZE, SMALL_FILE_SECONDS, jobs=32, cpus=16) == 1
+
+def test_split_segments():
+    assert split_segments(3600, 1) == [(0, 3600)]
+    assert split_segments(SPLIT_MIN_SECONDS - 1, 8) == [(0, SPLIT_MIN_SECONDS - 1)]
+    segments = split_segments(3600, 4)
+    assert len(segments) == 4
+    assert sum(seconds for _, seconds in segments) == pytest.approx(3600)
+    assert len(split_segments(SPLIT_MIN_SECONDS, 64)) == SPLIT_MIN_SECONDS // SPLIT_SEGMENT_SECONDS
+
+def test_is_compatible():
+    info = ffprobe_info('mp3', 128000)
+    assert is_compatible(MediaInfo.of(info), 'mp3', 128000)
+    # Within the tolerance for encoders overshooting
+    assert is_compatible(MediaInfo.of(ffprobe_info('mp3', 130000)), 'mp3', 128000)
+    assert not is_compatible(MediaInfo.of(info), 'mp3', 64000)
+    assert not is_compatible(MediaInfo.of(info), 'aac', 128000)
+    assert is_compatible(MediaInfo.of(ffprobe_info('flac', None)), 'flac')
+    assert not is_compatible(MediaInfo.of({}), 'flac')
+
+def ffprobe_info(codec, bitrate):
+    return {'format': {'format_name': codec}, 'streams': [{'codec_type': 'audio', 'codec_name': codec, 'bit_rate': bitrate}]}
+
+def test_transcode_compatible(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(ffmpeg_transcoder, 'ffprobe', lambda file: (ffprobe_info('mp3', 128000 if file.name.startswith('low') else 320000), []))
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'low.mp3').write_bytes(b'data')
+    out = tmp_path / 'out'
+    args = ['', '--root', str(root), '--cache-file', str(tmp_path / 'cache.sqlite'), 'transcode', '--preset', 'mp3-128k', '--output', str(out), '--incremental', '--compatible', 'link']
+    assert main.do_main(args) == 0
+    assert '0 compatible file(s) remuxed, 1 linked and 0 copied' in capsys.readouterr().out
+    assert (out / 'low.mp3').stat().st_ino == (root / 'low.mp3').stat().st_ino
+    assert main.do_main(args) == 0
+    assert '1 up-to-date file(s) skipped' in capsys.readouterr().out
+
+def test_transcode_removed_file(tmp_path):
+    q = JobQueue()
+    op = ffmpeg_transcoder.FFMPEGTranscoderOperation(tmp_path / 'out', ffmpeg_transcoder.FFMPEG_PRESETS['aac-64k'].args, 'm4a')
+    op.initialize(q, tmp_path)
+    op._job(q, {}, Lock(), tmp_path / 'removed.mp3')
+    op.finalize(q, tmp_path)
+    q.flush_logs()
+    assert q.results.errors == 1
+    assert not list((tmp_path / 'out').glob('*.m4a'))
+
+@pytest.mark.parametrize("split", list(ffmpeg_transcoder.SplitMode))
+def test_flac_is_never_split(tmp_path, split):
+    preset = ffmpeg_transcoder.FFMPEG_PRESETS['flac']
+    op = ffmpeg_transcoder.FFMPEGTranscoderOperation(tmp_path / 'out', preset.args, preset.ext, split=split, splittable=preset.splittable)
+    q = JobQueue()
+    op.initialize(q, tmp_path)
+    op.finalize(q, tmp_path)
+    q.flush_logs()
+    assert op.split == ffmpeg_transcoder.SplitMode.Never
+
+def test_transcode_split(tmp_path, monkeypatch):
+    commands = []
+    def run_ffmpeg_tool(args, executable, timeout):
+        commands.append(args)
+        with open(args[-1], 'wb') as f:
+            f.write(b'out')
+        return '', []
+    monkeypatch.setattr(ffmpeg_transcoder, 'run_ffmpeg_tool', run_ffmpeg_tool)
+    monkeypatch.setattr(ffmpeg_transcoder, 'ffprobe', lambda file: ({'format': {'duration': str(SPLIT_MIN_SECONDS)}, 'streams': [{'codec_type': 'audio', 'codec_name': 'mp3'}]}, []))
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'long.mp3').write_bytes(b'data')
+    args = ['', '--root', str(root), '--no-cache', '--jobs', '4', 'transcode', '--preset', 'aac-64k', '--output', str(tmp_path / 'out'), '--split', 'always']
+    assert main.do_main(args) == 0
+    # Each segment is encoded separately, then they are joined without re-encoding
+    segments, concat = commands[:-1], commands[-1]
+    assert sorted(float(x[x.index('-t') + 1]) for x in segments) == [SPLIT_MIN_SECONDS / 4] * 4
+    assert concat[concat.index('-c') + 1] == 'copy'
+    assert (tmp_path / 'out/long.m4a').read_bytes() == b'out'
+    assert not list((tmp_path / 'out').glob('.*parts'))
+
+    # Not split unless asked for, as every preset pads each join
+    def subprocess_forward_progress(input, args, executable, **kwargs):
+        return run_ffmpeg_tool(args, executable, None)[1]
+    monkeypatch.setattr(ffmpeg_transcoder, 'subprocess_forward_progress', subprocess_forward_progress)
+    commands.clear()
+    assert main.do_main(args[:-2] + ['--output', str(tmp_path / 'unsplit')]) == 0
+    assert len(commands) == 1 and '-t' not in commands[0]
@@ -1,5 +1,12 @@
-from automedia import main
+from automedia import ffmpeg_validator, main
+from automedia.ffmpeg_validator import FFMPEGValidateOperation, SamplePlan, SAMPLE_SEGMENT_SECONDS
+from automedia.jobqueue import JobQueue
+from automedia.journal import RunJournal
+from collections import defaultdict
+from threading import Lock
 import pytest
+import sqlite3
+import shutil
 
 @pytest.mark.parametrize("dir", [1, 2])
 def test_verify_good(dir):
@@ -10,3 +17,138 @@ def test_verify_good(dir):
 def test_verify_bad(dir):
     result = main.do_main(['', '--symlinks=allowfile', '--root', f'tests/verify-test-bad-{dir}', 'verify'])
     assert result == 1
+
+def test_verify_cache(tmp_path, capsys):
+    args = ['', '--symlinks=allowfile', '--root', 'tests/verify-test-2', '--cache-file', str(tmp_path / 'cache.sqlite'), 'verify']
+    assert main.do_main(args) == 0
+    assert 'unchanged' not in capsys.readouterr().out
+    assert main.do_main(args) == 0
+    assert '3 unchanged file(s) skipped' in capsys.readouterr().out
+    assert main.do_main(args + ['--force']) == 0
+    assert 'unchanged' not in capsys.readouterr().out
+
+def test_verify_checksum(tmp_path, capsys):
+    args = ['', '--symlinks=allowfile', '--root', 'tests/verify-test-2', '--cache-file', str(tmp_path / 'cache.sqlite'), 'verify', '--force', '--checksum', 'blake2b']
+    assert main.do_main(args) == 0
+    assert main.do_main(args) == 0
+
+@pytest.mark.parametrize("depth", ['quick', 'packets', 'full'])
+def test_verify_depth(tmp_path, depth):
+    args = ['', '--symlinks=allowfile', '--root', 'tests/verify-test-2', '--cache-file', str(tmp_path / 'cache.sqlite'), 'verify', '--depth', depth]
+    assert main.do_main(args) == 0
+
+def test_verify_batch(tmp_path, capsys):
+    for i in range(3):
+        shutil.copyfile('tests/verify-test-1/good.mp3', tmp_path / f'good-{i}.mp3')
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', 'verify', '--batch', '4']) == 0
+    shutil.copyfile('tests/verify-test-bad-2/bad.mp4', tmp_path / 'bad.mp4')
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', 'verify', '--batch', '4']) == 1
+    # The failing batch is split until the bad file is checked on its own
+    errors = [line for line in capsys.readouterr().out.splitlines() if line.startswith('E[')]
+    assert errors and all('/bad.mp4]' in line for line in errors)
+
+def test_verify_bad_headers():
+    assert main.do_main(['', '--symlinks=allowfile', '--root', 'tests/verify-test-bad-1', '--no-cache', 'verify', '--depth', 'quick']) == 1
+
+@pytest.mark.parametrize("length", [5, 95, 3600.5])
+def test_sample_plan_coverage(length):
+    plan = SamplePlan.of(length, 4, 0)
+    covered = []
+    for passes in range(plan.stride):
+        plan = SamplePlan.of(length, 4, passes)
+        assert all(seconds <= SAMPLE_SEGMENT_SECONDS for _, seconds in plan.segments)
+        covered += plan.segments
+    end = 0
+    for start, seconds in sorted(covered):
+        assert start <= end + 1e-6
+        end = max(end, start + seconds)
+    assert end == pytest.approx(length)
+
+def test_verify_removed_file(tmp_path):
+    # A file removed between the scan and its check is one bad file, rather than failing the run
+    q = JobQueue()
+    stats = defaultdict(int)
+    FFMPEGValidateOperation()._job(q, stats, Lock(), tmp_path / 'removed.mp3')
+    q.flush_logs()
+    assert stats['bad'] == 1
+
+@pytest.fixture
+def fake_ffmpeg(monkeypatch):
+    calls = []
+    def ffprobe(file):
+        calls.append(('probe', file.name))
+        return {}, []
+    def decode(file, args, executable, **kwargs):
+        calls.append(('decode', file.name))
+        return []
+    monkeypatch.setattr(ffmpeg_validator, 'ffprobe', ffprobe)
+    monkeypatch.setattr(ffmpeg_validator, 'subprocess_forward_progress', decode)
+    monkeypatch.setattr(ffmpeg_validator, 'run_ffmpeg_tool', lambda args, executable, timeout: calls.append(('batch', args.count('-i'))) or ('', []))
+    return calls
+
+@pytest.mark.parametrize("headers_first", [False, True])
+def test_verify_headers_first(tmp_path, fake_ffmpeg, headers_first):
+    for name in ['a.mp3', 'b.mp3']:
+        (tmp_path / name).write_bytes(b'data')
+    args = ['', '--root', str(tmp_path), '--no-cache', 'verify'] + (['--headers-first'] if headers_first else [])
+    assert main.do_main(args) == 0
+    # By default each file is only read once, by its decode
+    expected = [('decode', 'a.mp3'), ('decode', 'b.mp3')]
+    if headers_first:
+        expected = [('probe', 'a.mp3'), ('probe', 'b.mp3')] + expected
+    assert fake_ffmpeg == expected
+
+def test_verify_least_recently_verified(tmp_path, fake_ffmpeg):
+    root = tmp_path / 'root'
+    root.mkdir()
+    for name in ['a.mp3', 'b.mp3', 'c.mp3']:
+        (root / name).write_bytes(b'data')
+    cache_file = tmp_path / 'cache.sqlite'
+    args = ['', '--root', str(root), '--cache-file', str(cache_file), 'verify', '--force', '--headers-first', '--order', 'least-recently-verified']
+    assert main.do_main(args) == 0
+    with sqlite3.connect(cache_file) as db:
+        db.execute("UPDATE verified SET verified_at = 1 WHERE path = 'c.mp3'")
+    fake_ffmpeg.clear()
+    # The header checks record a new time, which mustn't change the order of the decodes
+    assert main.do_main(args) == 0
+    assert [name for kind, name in fake_ffmpeg if kind == 'decode'] == ['c.mp3', 'a.mp3', 'b.mp3']
+
+def test_verify_batch_skips_header_checks(tmp_path, fake_ffmpeg):
+    for i in range(5):
+        (tmp_path / f'{i}.mp3').write_bytes(b'data')
+    assert main.do_main(['', '--root', str(tmp_path), '--no-cache', 'verify', '--headers-first', '--batch', '4']) == 0
+    # One process per batch and nothing else
+    assert fake_ffmpeg == [('batch', 4), ('decode', '4.mp3')]
+
+def test_verify_resume_rechecks_bad_files(tmp_path, monkeypatch):
+    decoded = []
+    def decode(file, args, executable, **kwargs):
+        decoded.append(file.name)
+        return ["Invalid data found when processing input"] if file.name == 'bad.mp3' else []
+    monkeypatch.setattr(ffmpeg_validator, 'subprocess_forward_progress', decode)
+    root = tmp_path / 'root'
+    root.mkdir()
+    for name in ['bad.mp3', 'good.mp3']:
+        (root / name).write_bytes(b'data')
+    journal_file = tmp_path / 'run.journal'
+    journal = RunJournal(journal_file, root, 'verify full')
+    journal.record(root / 'bad.mp3', 'bad')
+    journal.record(root / 'good.mp3', 'good')
+    journal.close()
+    # The bad file is checked again, so the resumed run still fails
+    assert main.do_main(['', '--root', str(root), '--no-cache', '--journal-file', str(journal_file), '--resume', 'verify']) == 1
+    assert decoded == ['bad.mp3']
+
+def test_verify_invalid_args_keep_journal(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    journal_file = tmp_path / 'run.journal'
+    journal = RunJournal(journal_file, root, 'verify full')
+    journal.record(root / 'good.mp3', 'good')
+    journal.close()
+    contents = journal_file.read_bytes()
+    for args in [['--jobs', '0', 'verify'], ['verify', '--checksum', 'sha256']]:
+        with pytest.raises(SystemExit):
+            main.do_main(['', '--root', str(root), '--no-cache', '--journal-file', str(journal_file), *args])
+        # A mistyped run never starts, so leaves the interrupted run there to be resumed
+        assert journal_file.read_bytes() == contents
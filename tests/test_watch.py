@@ -0,0 +1,42 @@
+from automedia.jobqueue import JobQueue
+from automedia.path_scan import SymlinkMode
+from automedia.watch import Watcher
+from test_path_scan import make_scanner
+import os
+import pytest
+
+@pytest.fixture
+def watcher(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a/1.mp3').write_bytes(b'data')
+    watcher = Watcher(tmp_path, make_scanner(SymlinkMode.Warn), debounce=0.2, reconcile_interval=60)
+    q = JobQueue()
+    watcher.watch_tree(q, tmp_path)
+    q.flush_logs()
+    yield watcher
+    watcher.stop()
+
+def test_watch_changes(watcher, tmp_path):
+    (tmp_path / 'a/1.mp3').write_bytes(b'changed')
+    (tmp_path / 'a/.DS_Store').write_bytes(b'data')
+    (tmp_path / '2.mp3').write_bytes(b'data')
+    os.rename(tmp_path / '2.mp3', tmp_path / '3.mp3')
+    batch = watcher.next_batch()
+    assert batch.changes == {tmp_path / 'a': {'1.mp3'}, tmp_path: {'2.mp3', '3.mp3'}}
+    assert not batch.trees
+    assert not batch.reconcile
+
+def test_watch_new_trees(watcher, tmp_path):
+    (tmp_path / 'b/c').mkdir(parents=True)
+    (tmp_path / 'b/c/1.mp3').write_bytes(b'data')
+    os.symlink(tmp_path / 'a', tmp_path / 'link')
+    batch = watcher.next_batch()
+    q = JobQueue()
+    # Symlinks aren't followed by the scanner, so aren't watched or processed either
+    assert watcher.watch_new_trees(q, batch) == [tmp_path / 'b']
+    q.flush_logs()
+    assert batch.changes == {}
+
+    # The new tree is watched from now on
+    (tmp_path / 'b/c/2.mp3').write_bytes(b'data')
+    assert watcher.next_batch().changes == {tmp_path / 'b/c': {'2.mp3'}}